@@ -0,0 +1,125 @@
+"""
+Publishers of outbox records for model.outbox.OutboxRelay: AmqpPublisher for a real broker through aio-pika, and
+MemoryBroker, an in-process stand-in which keeps what it is sent.
+
+Every record becomes one persistent json message on a topic exchange, routed by the event as document.created or
+document.saved, with the record id as its message id. Messages are not mandatory, one which no queue is bound for is
+dropped by the broker like any other topic exchange would, rather than returned and sent again forever.
+
+    {"id": "<record id>", "event": "DocumentSaved", "document": {"_id": "...", "name": ..., "child_field": [...]}}
+"""
+from attr import attrs, Factory
+import asyncio
+import json
+import logging
+
+from model.repo import munge_object
+
+try:
+    import aio_pika
+    from pamqp import specification
+except ImportError:
+    aio_pika = None
+
+from typing import *
+
+
+logger = logging.getLogger(__name__)
+
+ROUTING_KEYS = {
+    'DocumentCreated': 'document.created',
+    'DocumentSaved': 'document.saved',
+}
+
+
+def message_body(record: Dict[str, Any]) -> bytes:
+    return json.dumps({
+        'id': str(record['_id']),
+        'event': record['event'],
+        'document': munge_object(record['document'])
+    }, default=str).encode('utf8')
+
+
+@attrs(slots=True, auto_attribs=True)
+class AmqpPublisher:
+    url: str
+    exchange_name: str = 'documents'
+    # seconds to wait for the broker to confirm a batch
+    confirm_timeout: float = 10.0
+    connection: Any = None
+    exchange: Any = None
+
+    async def connect(self) -> None:
+        if self.exchange is None:
+            assert aio_pika is not None, 'publishing to AMQP needs aio-pika'
+            self.connection = await aio_pika.connect_robust(self.url)
+            channel = await self.connection.channel(publisher_confirms=True)
+            self.exchange = await channel.declare_exchange(
+                self.exchange_name,
+                aio_pika.ExchangeType.TOPIC,
+                durable=True
+            )
+
+    async def publish(self, records: List[Dict[str, Any]]) -> None:
+        """
+        Send every record without waiting in between, then wait for all the confirms.
+
+        Raises a ConnectionError when the broker nacked or rejected a message, the whole batch is then sent again.
+        A message the broker returned as unroutable counts as delivered and is logged.
+        """
+        await self.connect()
+        confirms = await asyncio.wait_for(asyncio.gather(*[
+            self.exchange.publish(
+                aio_pika.Message(
+                    message_body(record),
+                    content_type='application/json',
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                    message_id=str(record['_id']),
+                    type=record['event']
+                ),
+                routing_key=ROUTING_KEYS[record['event']],
+                mandatory=False
+            )
+            for record in records
+        ]), self.confirm_timeout)
+
+        nacked = 0
+        for record, confirm in zip(records, confirms):
+            if isinstance(confirm, (specification.Basic.Nack, specification.Basic.Reject)):
+                nacked += 1
+            elif not isinstance(confirm, specification.Basic.Ack):
+                logger.warning("Message %s was returned unroutable by %r", record['_id'], self.exchange_name)
+        if nacked:
+            raise ConnectionError('the broker did not ack %d of %d messages' % (nacked, len(records)))
+
+    async def close(self) -> None:
+        if self.connection is not None:
+            await self.connection.close()
+        self.connection = self.exchange = None
+
+
+@attrs(slots=True, auto_attribs=True)
+class MemoryBroker:
+    """
+    Confirms every message at once and keeps them as (routing key, message id, decoded body).
+    """
+    messages: List[Tuple[str, str, Dict[str, Any]]] = Factory(list)
+    # publish calls to fail before confirming again, for exercising retries
+    failures: int = 0
+
+    async def publish(self, records: List[Dict[str, Any]]) -> None:
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('broker unavailable')
+        for record in records:
+            self.messages.append((
+                ROUTING_KEYS[record['event']],
+                str(record['_id']),
+                json.loads(message_body(record).decode('utf8'))
+            ))
+
+    async def close(self) -> None:
+        pass
+
+
+__all__ = ['ROUTING_KEYS', 'AmqpPublisher', 'MemoryBroker']
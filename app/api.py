@@ -1,29 +1,128 @@
 from sanic import Sanic
-from sanic.response import json
+from sanic.response import json, text
 from . import settings
-from sanic_graphql import GraphQLView
 from graphql.execution.executors.asyncio import AsyncioExecutor
+from graphql.backend import set_default_backend
 import motor.motor_asyncio
+import asyncio
+import time
 
 from model.repo import *
+from model import codec
+from model.cache import DocumentCache
+from model.eventemitter import Dispatcher, OVERFLOW_POLICIES
+from model.outbox import Outbox, OutboxRelay
+from .amqp import AmqpPublisher
 from . import gqlschema as gql
+from .backend import QueryCacheBackend
+from .cost import CostAnalysis
+from .metrics import ServiceMetrics, CONTENT_TYPE
+from .persisted import PersistedQueryStore, PersistedQueryView
+from .subscriptions import PROTOCOL, Connection, SubscriptionManager
 
 app = Sanic(__name__)
 
+service_metrics = ServiceMetrics()
+service_metrics.mongodb_pool_max_size.set(settings.MONGODB_MAX_POOL_SIZE)
+
+# GraphQLView has no backend option, graphql_server falls back to the default backend for every request
+query_cost_analysis = CostAnalysis(max_cost=settings.QUERY_MAX_COST, max_depth=settings.QUERY_MAX_DEPTH)
+query_cache_backend = QueryCacheBackend(
+    maxsize=settings.QUERY_CACHE_SIZE,
+    cost_analysis=query_cost_analysis,
+    operation_timer=service_metrics.graphql_operations
+)
+set_default_backend(query_cache_backend)
+
+persisted_queries = PersistedQueryStore.open(
+    maxsize=settings.PERSISTED_QUERY_CACHE_SIZE,
+    path=settings.PERSISTED_QUERY_FILE
+)
+
+subscription_manager = SubscriptionManager()
+
+
+@app.middleware('request')
+async def start_request_timer(request):
+    request['started'] = time.perf_counter()
+
+
+@app.middleware('response')
+async def observe_request_time(request, response):
+    started = request.get('started')
+    if started is None:
+        return
+    # the route pattern rather than the path, so ids do not end up in label values
+    route = request.uri_template if response.status != 404 else None
+    service_metrics.http_requests.observe(
+        time.perf_counter() - started,
+        (request.method, route or 'unmatched', str(response.status))
+    )
+
 
 @app.route("/")
 async def test(request):
     return json({"hello": "world"})
 
 
+@app.route("/metrics")
+async def metrics(request):
+    """
+    Prometheus metrics of the worker serving the request, labelled with its pid.
+    """
+    return text(service_metrics.render(), content_type=CONTENT_TYPE)
+
+
+@app.route("/stats")
+async def stats(request):
+    """
+    Cache and query cost statistics of the worker serving the request.
+    """
+    document_repo = gql.document_repo
+    return json({
+        "query_cache": query_cache_backend.stats(),
+        "query_cost": query_cost_analysis.stats(),
+        "persisted_queries": persisted_queries.stats(),
+        "document_cache": document_repo.cache.stats() if document_repo and document_repo.cache else None,
+        "indexes": document_repo.index_reconciler.stats() if document_repo and document_repo.index_reconciler else None,
+        "events": document_repo.dispatcher.stats() if document_repo and document_repo.dispatcher else None,
+        "outbox": app.outbox_relay.stats() if getattr(app, 'outbox_relay', None) else None,
+        "subscriptions": subscription_manager.stats(),
+    })
+
+
+@app.websocket("/subscriptions", subprotocols=[PROTOCOL])
+async def subscriptions(request, ws):
+    """
+    GraphQL subscriptions with the graphql-ws protocol.
+    """
+    await Connection(ws, subscription_manager, maxsize=settings.SUBSCRIPTION_BUFFER_SIZE).serve()
+
+
+@app.route("/ready")
+async def ready(request):
+    """
+    200 once this worker is connected and every declared index is built, 503 until then.
+    """
+    document_repo = gql.document_repo
+    reconciler = document_repo.index_reconciler if document_repo else None
+    if reconciler is None or not reconciler.ready():
+        return json({"ready": False, "indexes": reconciler.stats() if reconciler else None}, status=503)
+    return json({"ready": True, "indexes": reconciler.stats()})
+
+
 @app.listener('before_server_start')
 def init_graphql(app, loop):
     app.add_route(
-        GraphQLView.as_view(
+        PersistedQueryView.as_view(
             schema=gql.schema,
             graphiql=True,
             enable_async=True,
-            executor=AsyncioExecutor(loop=loop)
+            executor=AsyncioExecutor(loop=loop),
+            persisted_queries=persisted_queries,
+            max_age_cached=settings.PERSISTED_QUERY_MAX_AGE,
+            tracing_enabled=settings.GRAPHQL_TRACING,
+            middleware=[service_metrics.resolver_middleware()]
         ), 
         '/graphql'
     )
@@ -35,9 +134,23 @@ async def init_repos(app, loop):
     Make sure we instantiate repos with the correct collections after mongodb has connected.
 
     Make sure the repos are sent to the api for use in endpoints.
+
+    This runs in every worker process, so each worker gets its own motor client and connection pool bound to
+    its own event loop.
     """
     print(f'Connecting to mongodb: {settings.MONGODB_HOST!r}  {settings.MONGODB_PORT!r}')
-    mongodb = motor.motor_asyncio.AsyncIOMotorClient(settings.MONGODB_HOST, settings.MONGODB_PORT)
+    print(f'Mongodb pool: max {settings.MONGODB_MAX_POOL_SIZE!r} min {settings.MONGODB_MIN_POOL_SIZE!r} '
+          f'wait queue timeout {settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS!r}ms')
+    mongodb = motor.motor_asyncio.AsyncIOMotorClient(
+        settings.MONGODB_HOST,
+        settings.MONGODB_PORT,
+        io_loop=loop,
+        maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
+        minPoolSize=settings.MONGODB_MIN_POOL_SIZE,
+        waitQueueTimeoutMS=settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        event_listeners=service_metrics.mongodb_listeners()
+    )
+    app.mongodb = mongodb
 
     print(f'Connecting to database: {settings.MONGODB_DB_NAME!r}')
     db = mongodb[settings.MONGODB_DB_NAME]
@@ -45,14 +158,128 @@ async def init_repos(app, loop):
     print(f'Mongodb collection: {settings.MONGODB_DB_COLLECTION_NAME!r}')
     mongodb_collection = db[settings.MONGODB_DB_COLLECTION_NAME]
 
+    print(f'Document codec: {settings.DOCUMENT_CODEC!r}')
+    assert settings.DOCUMENT_CODEC in ('marshmallow', 'compiled'), 'DOCUMENT_CODEC must be marshmallow or compiled'
+    document_codec = codec.Document if settings.DOCUMENT_CODEC == 'compiled' else None
+
+    print(f'Lazy raw bson reads: {settings.DOCUMENT_RAW_BSON!r}')
+
+    print(f'Document cache: size {settings.DOCUMENT_CACHE_SIZE!r} ttl {settings.DOCUMENT_CACHE_TTL!r}s')
+    document_cache = None
+    if settings.DOCUMENT_CACHE_SIZE > 0:
+        document_cache = DocumentCache(maxsize=settings.DOCUMENT_CACHE_SIZE, ttl=settings.DOCUMENT_CACHE_TTL)
+
+    print(f'Collection scans: {settings.QUERY_COLLECTION_SCANS!r}')
+    assert settings.QUERY_COLLECTION_SCANS in ('reject', 'warn'), 'QUERY_COLLECTION_SCANS must be reject or warn'
+
+    print(f'Event queue: size {settings.EVENT_QUEUE_SIZE!r} overflow {settings.EVENT_QUEUE_OVERFLOW!r} '
+          f'batches of {settings.EVENT_BATCH_SIZE!r} after {settings.EVENT_BATCH_DELAY!r}s')
+    assert settings.EVENT_QUEUE_OVERFLOW in OVERFLOW_POLICIES, 'EVENT_QUEUE_OVERFLOW must be drop, block or coalesce'
+    dispatcher = Dispatcher(
+        maxsize=settings.EVENT_QUEUE_SIZE,
+        batch_size=settings.EVENT_BATCH_SIZE,
+        batch_delay=settings.EVENT_BATCH_DELAY,
+        overflow=settings.EVENT_QUEUE_OVERFLOW
+    )
+    service_metrics.watch_dispatcher(dispatcher)
+
+    outbox = None
+    if settings.AMQP_URL is not None:
+        print(f'Outbox collection: {settings.OUTBOX_COLLECTION_NAME!r} transactions {settings.OUTBOX_TRANSACTIONS!r}, '
+              f'relayed to AMQP exchange {settings.AMQP_EXCHANGE!r} in batches of {settings.OUTBOX_BATCH_SIZE!r}')
+        outbox = Outbox(
+            db[settings.OUTBOX_COLLECTION_NAME],
+            client=mongodb if settings.OUTBOX_TRANSACTIONS else None
+        )
+        await outbox.check_indices()
+        app.outbox_relay = OutboxRelay(
+            outbox,
+            AmqpPublisher(settings.AMQP_URL, settings.AMQP_EXCHANGE),
+            batch_size=settings.OUTBOX_BATCH_SIZE
+        )
+        app.outbox_relay.start()
+
     print('Creating repos')
-    mongodb_repo = DocumentRepo(collection=mongodb_collection)
+    mongodb_repo = DocumentRepo(
+        dispatcher=dispatcher,
+        outbox=outbox,
+        collection=mongodb_collection,
+        codec=document_codec,
+        raw_bson=settings.DOCUMENT_RAW_BSON,
+        cache=document_cache,
+        collection_scans=settings.QUERY_COLLECTION_SCANS
+    )
+
+    service_metrics.count_events(mongodb_repo)
 
-    mongodb_repo.check_indices()
+    print(f'Subscriptions: {settings.SUBSCRIPTION_SOURCE!r} buffer {settings.SUBSCRIPTION_BUFFER_SIZE!r}')
+    assert settings.SUBSCRIPTION_SOURCE in ('events', 'change_stream'), \
+        'SUBSCRIPTION_SOURCE must be events or change_stream'
+    # a worker's events are its own writes, subscribers of every worker would miss the writes of the others
+    assert settings.SUBSCRIPTION_SOURCE != 'events' or settings.API_WORKERS == 1, \
+        'SUBSCRIPTION_SOURCE events only sees every change with API_WORKERS at 1, use change_stream'
+    if settings.SUBSCRIPTION_SOURCE == 'change_stream':
+        app.subscription_feed = asyncio.ensure_future(
+            subscription_manager.follow(mongodb_collection, mongodb_repo._create_from_document)
+        )
+    else:
+        subscription_manager.attach(mongodb_repo)
+
+    await mongodb_repo.check_indices()
 
     print('Repos:', mongodb_repo)
     gql.set_repos(_document_repo=mongodb_repo)
 
 
+@app.listener('after_server_stop')
+async def close_repos(app, loop):
+    """
+    Deliver the events still queued, drop the repos and close this worker's mongodb connections.
+    """
+    document_repo = gql.document_repo
+    if document_repo is not None and document_repo.index_reconciler is not None:
+        document_repo.index_reconciler.cancel()
+    subscription_feed = getattr(app, 'subscription_feed', None)
+    if subscription_feed is not None:
+        subscription_feed.cancel()
+        app.subscription_feed = None
+    if document_repo is not None and document_repo.dispatcher is not None:
+        await document_repo.dispatcher.close()
+    gql.set_repos(None)
+
+    outbox_relay = getattr(app, 'outbox_relay', None)
+    if outbox_relay is not None:
+        print('Stopping the outbox relay')
+        await outbox_relay.stop()
+        await outbox_relay.publisher.close()
+        app.outbox_relay = None
+
+    mongodb = getattr(app, 'mongodb', None)
+    if mongodb is not None:
+        print('Closing mongodb connections')
+        mongodb.close()
+        app.mongodb = None
+
+
+def set_event_loop_policy():
+    """
+    Run the server on uvloop or not as USE_UVLOOP says. Only called when starting the server, so importing this
+    module leaves the policy of tests and tools alone.
+    """
+    # sanic switches to uvloop on import whenever it is installed, make the setting win either way
+    if settings.USE_UVLOOP:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+
+
 if __name__ == "__main__":
-    app.run(host=settings.API_HOST, port=int(settings.API_PORT), debug=True)
+    set_event_loop_policy()
+    app.run(
+        host=settings.API_HOST,
+        port=int(settings.API_PORT),
+        workers=settings.API_WORKERS,
+        debug=settings.DEBUG,
+        auto_reload=settings.AUTO_RELOAD
+    )
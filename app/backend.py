@@ -0,0 +1,190 @@
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import execute, ExecutionResult
+from graphql.language.base import parse
+from graphql.validation import validate
+from graphql.utils.get_operation_ast import get_operation_ast
+from collections import OrderedDict
+from functools import partial
+from promise import Promise, is_thenable
+import time
+
+from model.cache import LRUCache
+from model import tracing
+from .cost import CostAnalysis, QueryCostError
+from .tracing import traced_middleware
+
+from typing import *
+
+
+class ExtendedExecutionResult(ExecutionResult):
+    """
+    ExecutionResult which serializes its extensions and the extensions of its errors, which graphql-core drops.
+    """
+    __slots__ = ()
+
+    def to_dict(self, format_error=None, dict_class=OrderedDict):
+        response = super(ExtendedExecutionResult, self).to_dict(format_error=format_error, dict_class=dict_class)
+
+        for error, formatted in zip(self.errors or [], response.get('errors', [])):
+            extensions = getattr(error, 'extensions', None)
+            if extensions:
+                formatted['extensions'] = extensions
+
+        if self.extensions:
+            response['extensions'] = self.extensions
+
+        return response
+
+
+def with_extensions(result: ExecutionResult, extensions: Dict[str, Any]) -> ExtendedExecutionResult:
+    return ExtendedExecutionResult(
+        data=result.data,
+        errors=result.errors,
+        invalid=result.invalid,
+        extensions=dict(result.extensions, **extensions)
+    )
+
+
+# operation names come from clients, past this many label sets the names of new ones are recorded as 'other'
+MAX_OPERATION_LABELS = 100
+
+
+def operation_labels(operation_timer, operation) -> Tuple[str, str]:
+    """
+    The (operation type, operation name) labels of operation in the operation_timer histogram.
+    """
+    if operation is None:
+        return ('unknown', 'anonymous')
+    labels = (operation.operation, operation.name.value if operation.name is not None else 'anonymous')
+    if labels not in operation_timer.counts and len(operation_timer.counts) >= MAX_OPERATION_LABELS:
+        return (operation.operation, 'other')
+    return labels
+
+
+def timed_execute(schema, document_ast, *args, operation_timer=None, **kwargs):
+    """
+    execute, observing the time until the result is ready in the operation_timer histogram when there is one.
+    """
+    if operation_timer is None:
+        return execute(schema, document_ast, *args, **kwargs)
+
+    labels = operation_labels(operation_timer, get_operation_ast(document_ast, kwargs.get('operation_name')))
+
+    started = time.perf_counter()
+    result = execute(schema, document_ast, *args, **kwargs)
+
+    def observe(result):
+        operation_timer.observe(time.perf_counter() - started, labels)
+        return result
+
+    if is_thenable(result):
+        return Promise.resolve(result).then(observe)
+    return observe(result)
+
+
+def execute_validated(schema,
+                      document_ast,
+                      validation_errors,
+                      *args,
+                      cost_analysis: CostAnalysis=None,
+                      operation_timer=None,
+                      **kwargs):
+    """
+    Execute a document which has already been validated, validation_errors being the result of that validation.
+
+    With a cost_analysis the operation is measured first, operations over budget are rejected without being
+    executed and the cost of the others is returned in the cost extension. With an operation_timer, a
+    metrics.Histogram, the execution time of every operation is recorded. While a tracing.Trace is active every
+    resolver is traced and the trace is returned in the tracing extension.
+    """
+    if validation_errors:
+        return ExecutionResult(errors=validation_errors, invalid=True)
+
+    cost = None
+    if cost_analysis is not None:
+        try:
+            cost = cost_analysis.check(
+                schema,
+                document_ast,
+                operation_name=kwargs.get('operation_name'),
+                variables=kwargs.get('variables')
+            )
+        except QueryCostError as e:
+            return ExtendedExecutionResult(errors=[e], invalid=True)
+
+    trace = tracing.current_trace.get()
+    if trace is not None:
+        kwargs['middleware'] = traced_middleware(kwargs.get('middleware'), trace)
+
+    result = timed_execute(schema, document_ast, *args, operation_timer=operation_timer, **kwargs)
+    if cost is None and trace is None:
+        return result
+
+    extensions = {}
+    if cost is not None:
+        extensions['cost'] = {
+            'requestedQueryCost': cost.cost, 'maximumAvailable': cost_analysis.max_cost, 'depth': cost.depth
+        }
+
+    def extend(result):
+        if trace is not None:
+            trace.finish()
+            extensions['tracing'] = trace.to_dict()
+        return with_extensions(result, extensions)
+
+    if is_thenable(result):
+        return Promise.resolve(result).then(extend)
+    return extend(result)
+
+
+class QueryCacheBackend(GraphQLBackend):
+    """
+    GraphQL backend which parses and validates every distinct query string once.
+
+    The parsed document and its validation errors are kept in an LRU keyed by schema and query string, a hit goes
+    straight to execution. Query strings which fail to parse are not cached. The traces of operations served from
+    the cache have null parsing and validation.
+    """
+
+    def __init__(self, maxsize: int=512, cost_analysis: Optional[CostAnalysis]=None, operation_timer=None):
+        self.cache = LRUCache(maxsize=maxsize, ttl=float('inf'))
+        self.cost_analysis = cost_analysis
+        self.operation_timer = operation_timer
+
+    def document_from_string(self, schema, document_string):
+        key = (schema, document_string)
+
+        document = self.cache.get(key)
+        if document is None:
+            with tracing.phase('parsing'):
+                document_ast = parse(document_string)
+            with tracing.phase('validation'):
+                validation_errors = validate(schema, document_ast)
+            document = GraphQLDocument(
+                schema=schema,
+                document_string=document_string,
+                document_ast=document_ast,
+                execute=partial(
+                    execute_validated,
+                    schema,
+                    document_ast,
+                    validation_errors,
+                    cost_analysis=self.cost_analysis,
+                    operation_timer=self.operation_timer
+                )
+            )
+            self.cache.set(key, document)
+
+        return document
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+__all__ = [
+    'ExtendedExecutionResult',
+    'QueryCacheBackend'
+]
@@ -0,0 +1,205 @@
+"""
+Static cost and depth analysis of GraphQL operations, run after validation and before execution.
+
+The cost of a field is its own cost plus the cost of its selections times the number of items the field is expected
+to return. Fields returning objects cost 1 and scalars 0 unless listed in field_costs. List sizes come from
+list_sizes, either read from an argument such as first or a fixed estimate; lists which are not listed count as one
+item. Introspection fields are free and do not count towards the depth.
+"""
+from attr import attrs, Factory
+from graphql.error import GraphQLError
+from graphql.language import ast
+from graphql.type import GraphQLList, GraphQLNonNull, GraphQLObjectType, GraphQLInterfaceType, GraphQLUnionType
+from graphql.utils.get_operation_ast import get_operation_ast
+from graphql.utils.value_from_ast import value_from_ast
+
+from .gqlschema import DEFAULT_PAGE_SIZE
+
+from typing import *
+
+
+# 'Type.field' -> (argument giving the number of items or None, number of items if the argument is not given),
+# list arguments count their items
+DEFAULT_LIST_SIZES = {
+    'Query.documents': ('first', DEFAULT_PAGE_SIZE),
+    'Document.childField': ('first', 20),
+    'Mutation.createDocuments': ('documents', 1),
+    'Mutation.setDocumentsArchived': ('ids', 1),
+}
+
+DEFAULT_FIELD_COSTS = {
+    'Mutation.createDocument': 10,
+    'Mutation.setDocumentArchived': 10,
+    'Mutation.createDocuments': 10,
+    'Mutation.setDocumentsArchived': 10,
+    'Mutation.addChildField': 10,
+    'Mutation.removeChildField': 10,
+    'Mutation.editChildField': 10,
+}
+
+
+class QueryCostError(GraphQLError):
+    """
+    Raised for operations over the cost or depth budget, extensions describe which limit was hit.
+    """
+
+    def __init__(self, message, extensions):
+        super(QueryCostError, self).__init__(message)
+        self.extensions = extensions
+
+
+def named_type(graphql_type):
+    while isinstance(graphql_type, (GraphQLList, GraphQLNonNull)):
+        graphql_type = graphql_type.of_type
+    return graphql_type
+
+
+@attrs(slots=True, auto_attribs=True)
+class Cost:
+    cost: int
+    depth: int
+
+
+@attrs(slots=True, auto_attribs=True)
+class CostAnalysis:
+    """
+    Computes the cost and depth of operations and rejects those over max_cost or max_depth, 0 disables a limit.
+
+    Keeps totals of the analysed requests for capacity planning.
+    """
+    max_cost: int = 10000
+    max_depth: int = 10
+    field_costs: Dict[str, int] = Factory(lambda: dict(DEFAULT_FIELD_COSTS))
+    list_sizes: Dict[str, Tuple[Optional[str], int]] = Factory(lambda: dict(DEFAULT_LIST_SIZES))
+    requests: int = 0
+    rejected: int = 0
+    total_cost: int = 0
+    highest_cost: int = 0
+
+    def measure(self, schema, document_ast, operation_name=None, variables=None) -> Optional[Cost]:
+        """
+        Cost and depth of the operation, None if the operation can not be found.
+        """
+        operation = get_operation_ast(document_ast, operation_name)
+        if operation is None:
+            return None
+
+        if operation.operation == 'mutation':
+            root_type = schema.get_mutation_type()
+        elif operation.operation == 'subscription':
+            root_type = schema.get_subscription_type()
+        else:
+            root_type = schema.get_query_type()
+        if root_type is None:
+            return None
+
+        fragments = {
+            definition.name.value: definition
+            for definition in document_ast.definitions
+            if isinstance(definition, ast.FragmentDefinition)
+        }
+        return self.selection_cost(schema, fragments, variables or {}, root_type, operation.selection_set, set())
+
+    def selection_cost(self, schema, fragments, variables, parent_type, selection_set, visited) -> Cost:
+        cost = Cost(0, 0)
+        if selection_set is None:
+            return cost
+
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                selection_cost = self.field_cost(schema, fragments, variables, parent_type, selection, visited)
+            else:
+                if isinstance(selection, ast.FragmentSpread):
+                    name = selection.name.value
+                    if name in visited or name not in fragments:
+                        continue
+                    fragment = fragments[name]
+                    fragment_visited = visited | {name}
+                else:
+                    fragment = selection
+                    fragment_visited = visited
+
+                fragment_type = parent_type
+                if fragment.type_condition is not None:
+                    fragment_type = schema.get_type(fragment.type_condition.name.value)
+                selection_cost = self.selection_cost(
+                    schema, fragments, variables, fragment_type, fragment.selection_set, fragment_visited
+                )
+
+            cost.cost += selection_cost.cost
+            cost.depth = max(cost.depth, selection_cost.depth)
+
+        return cost
+
+    def field_cost(self, schema, fragments, variables, parent_type, field_ast, visited) -> Cost:
+        name = field_ast.name.value
+        if name.startswith('__'):
+            return Cost(0, 0)
+
+        if not isinstance(parent_type, (GraphQLObjectType, GraphQLInterfaceType)) or name not in parent_type.fields:
+            return Cost(0, 1)
+
+        field = parent_type.fields[name]
+        field_type = named_type(field.type)
+        key = '%s.%s' % (parent_type.name, name)
+
+        is_composite = isinstance(field_type, (GraphQLObjectType, GraphQLInterfaceType, GraphQLUnionType))
+        own_cost = self.field_costs.get(key, 1 if is_composite else 0)
+
+        items = 1
+        if key in self.list_sizes:
+            argument_name, items = self.list_sizes[key]
+            for argument in field_ast.arguments or []:
+                if argument.name.value == argument_name and argument_name in field.args:
+                    value = value_from_ast(argument.value, field.args[argument_name].type, variables)
+                    if isinstance(value, list):
+                        items = len(value)
+                    elif value is not None:
+                        items = value
+
+        children = self.selection_cost(schema, fragments, variables, field_type, field_ast.selection_set, visited)
+        return Cost(own_cost + max(items, 0) * children.cost, children.depth + 1)
+
+    def check(self, schema, document_ast, operation_name=None, variables=None) -> Optional[Cost]:
+        """
+        Measure the operation and record it, raising QueryCostError if it is over budget.
+        """
+        cost = self.measure(schema, document_ast, operation_name, variables)
+        if cost is None:
+            return None
+
+        self.requests += 1
+        self.total_cost += cost.cost
+        self.highest_cost = max(self.highest_cost, cost.cost)
+
+        if self.max_depth and cost.depth > self.max_depth:
+            self.rejected += 1
+            raise QueryCostError(
+                "Query depth %d exceeds the maximum of %d" % (cost.depth, self.max_depth),
+                {'code': 'QUERY_TOO_DEEP', 'depth': cost.depth, 'maxDepth': self.max_depth}
+            )
+
+        if self.max_cost and cost.cost > self.max_cost:
+            self.rejected += 1
+            raise QueryCostError(
+                "Query cost %d exceeds the maximum of %d" % (cost.cost, self.max_cost),
+                {'code': 'QUERY_TOO_COMPLEX', 'cost': cost.cost, 'maxCost': self.max_cost}
+            )
+
+        return cost
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'total_cost': self.total_cost,
+            'highest_cost': self.highest_cost,
+            'mean_cost': self.total_cost / self.requests if self.requests else 0.0,
+        }
+
+
+__all__ = [
+    'QueryCostError',
+    'Cost',
+    'CostAnalysis'
+]
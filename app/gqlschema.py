@@ -1,9 +1,28 @@
 import graphene
+from graphql.language import ast
+from graphql.execution.values import get_argument_values
 import model.model as model
 import model.repo as repo
+import model.query as query
+from model.loader import DocumentLoader
+from model.tracing import traced
 
 document_repo = None
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BULK_SIZE = 1000
+
+# graphql field name -> mongodb field name, for the fields of the Document type
+DOCUMENT_FIELDS = {
+    'id': '_id',
+    'name': 'name',
+    'age': 'age',
+    'archived': 'archived',
+    'childField': 'child_field',
+    'childFieldCount': repo.CHILD_FIELD_COUNT,
+}
+
 
 def set_repos(_document_repo=None):
     global document_repo
@@ -11,6 +30,73 @@ def set_repos(_document_repo=None):
     document_repo = _document_repo
 
 
+def selected_fields(info, field_asts):
+    """
+    Yield the fields selected below field_asts, expanding fragments.
+    """
+    for field_ast in field_asts:
+        if field_ast.selection_set is None:
+            continue
+
+        for selection in field_ast.selection_set.selections:
+            if isinstance(selection, ast.Field):
+                yield selection
+            elif isinstance(selection, ast.FragmentSpread):
+                yield from selected_fields(info, [info.fragments[selection.name.value]])
+            elif isinstance(selection, ast.InlineFragment):
+                yield from selected_fields(info, [selection])
+
+
+def child_field_selection(info, field_ast):
+    """
+    The mongodb field needed for a childField selection, a repo.Slice when it only asks for the first children.
+    """
+    field_def = info.schema.get_type('Document').fields[field_ast.name.value]
+    args = get_argument_values(field_def.args, field_ast.arguments, info.variable_values)
+    first, offset = args.get('first'), args.get('offset') or 0
+    if first is None or first < 0 or offset < 0:
+        return 'child_field'
+    return repo.Slice('child_field', first, offset)
+
+
+def document_fields(info, *path):
+    """
+    Work out which mongodb fields are needed to resolve the documents returned by the current field.
+
+    path leads from the current field to the Document type, i.e. ('edges', 'node') for a DocumentConnection.
+    """
+    field_asts = info.field_asts
+    for name in path:
+        field_asts = [field for field in selected_fields(info, field_asts) if field.name.value == name]
+
+    fields = set()
+    for field in selected_fields(info, field_asts):
+        if field.name.value == 'childField':
+            fields.add(child_field_selection(info, field))
+        elif field.name.value in DOCUMENT_FIELDS:
+            fields.add(DOCUMENT_FIELDS[field.name.value])
+    return fields
+
+
+def get_document_loader(info):
+    """
+    Return the DocumentLoader for the request being executed, creating it on first use.
+
+    The loader is kept in the request context so batching and caching never leak between requests.
+    """
+    global document_repo
+    assert(document_repo is not None)
+
+    context = info.context
+    if context is None:
+        return DocumentLoader(document_repo)
+
+    loader = context.get('document_loader')
+    if loader is None:
+        loader = context['document_loader'] = DocumentLoader(document_repo)
+    return loader
+
+
 class Date(graphene.ObjectType):
     month = graphene.Int()
     year = graphene.Int()
@@ -34,52 +120,149 @@ class ChildField(graphene.ObjectType):
         )
 
 
+# Queries resolve the Document fields straight from the model.Document (or lazy.LazyDocument) returned by the
+# repo since the attribute names match, from_model is only needed where the type is part of a union.
 class Document(graphene.ObjectType):
     id = graphene.ID()
     name = graphene.String()
     age = graphene.Int()
-    child_field = graphene.List(ChildField)
+    child_field = graphene.List(
+        ChildField,
+        first=graphene.Int(description="Number of child fields, all of them by default"),
+        offset=graphene.Int(description="Number of child fields to skip, defaults to 0")
+    )
+    child_field_count = graphene.Int()
     archived = graphene.Boolean()
 
     @classmethod
+    @traced
     def from_model(cls, document):
+        # the model child fields resolve as they are, only the ones which are selected are looked at
         return cls(
             id=document.id,
             name=document.name,
             age=document.age,
-            child_field=[ChildField.from_model(s) for s in document.child_field],
+            child_field=document.child_field,
+            child_field_count=document.child_field_count,
             archived=document.archived
         )
 
+    def resolve_child_field(self, info, first=None, offset=None):
+        offset = offset or 0
+        if offset < 0 or (first is not None and first < 0):
+            raise ValueError("first and offset can not be negative")
+
+        if self.child_field is None:
+            return None
+        # a sliced read loads the children from child_field_offset on, Document objects made by from_model have all
+        start = offset - (getattr(self, 'child_field_offset', None) or 0)
+        return self.child_field[start:None if first is None else start + first]
+
+    def resolve_child_field_count(self, info):
+        if self.child_field_count is not None:
+            return self.child_field_count
+        return len(self.child_field or [])
+
+
+class DocumentConnection(graphene.relay.Connection):
+    class Meta:
+        node = Document
+
+
+class DocumentSortField(graphene.Enum):
+    ID = '_id'
+    NAME = 'name'
+    AGE = 'age'
+
+
+class SortDirection(graphene.Enum):
+    ASC = 1
+    DESC = -1
+
+
+class DocumentFilterInput(graphene.InputObjectType):
+    archived = graphene.Boolean()
+    age_min = graphene.Int(description="Lowest age, inclusive")
+    age_max = graphene.Int(description="Highest age, inclusive")
+    name_prefix = graphene.String(description="Case sensitive start of the name")
+
+    def to_query(self):
+        return query.DocumentFilter(
+            archived=self.archived,
+            age_min=self.age_min,
+            age_max=self.age_max,
+            name_prefix=self.name_prefix
+        )
+
+
+class DocumentSortInput(graphene.InputObjectType):
+    field = DocumentSortField(required=True)
+    direction = SortDirection(default_value=1)
+
+    def to_query(self):
+        return query.DocumentSort(field=self.field, direction=self.direction)
+
 
 class Query(graphene.ObjectType):
-    documents = graphene.List(Document)
+    documents = graphene.Field(
+        DocumentConnection,
+        first=graphene.Int(description="Page size, defaults to %d" % DEFAULT_PAGE_SIZE),
+        after=graphene.String(description="endCursor of the previous page, made with the same filter and sort"),
+        filter=DocumentFilterInput(),
+        sort=DocumentSortInput(description="Defaults to id order")
+    )
     document = graphene.Field(Document, id=graphene.ID())
 
-    async def resolve_documents(self, args, context=None, info=None):
+    async def resolve_documents(self, info, first=None, after=None, filter=None, sort=None):
         global document_repo
         assert(document_repo is not None)
 
-        results = []
-        async for document in document_repo.find():
-            results.append(Document.from_model(document))
-        return results
+        first = DEFAULT_PAGE_SIZE if first is None else first
+        if not 0 <= first <= MAX_PAGE_SIZE:
+            raise ValueError("first must be between 0 and %d" % MAX_PAGE_SIZE)
 
-    async def resolve_document(self, args, id, context=None, info=None):
-        global document_repo
-        assert (document_repo is not None)
+        document_filter = filter.to_query() if filter is not None else None
+        document_sort = sort.to_query() if sort is not None else None
+        cursor = (document_sort or query.DocumentSort()).cursor
 
+        # fetch one extra document to find out whether there is a next page
+        edges = []
         try:
-            document = await document_repo.find_by_id(id)
+            fields = document_fields(info, 'edges', 'node')
+            async for document in document_repo.find(limit=first + 1,
+                                                     after=after,
+                                                     fields=fields,
+                                                     filter=document_filter,
+                                                     sort=document_sort):
+                edges.append(DocumentConnection.Edge(node=document, cursor=cursor(document)))
+        except repo.InvalidId:
+            raise ValueError("after is not a valid cursor")
+        except query.QueryPlanError as exc:
+            raise ValueError(str(exc))
+
+        has_next_page = len(edges) > first
+        edges = edges[:first]
+
+        return DocumentConnection(
+            edges=edges,
+            page_info=graphene.relay.PageInfo(
+                has_next_page=has_next_page,
+                has_previous_page=after is not None,
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None
+            )
+        )
+
+    async def resolve_document(self, info, id):
+        try:
+            document = await get_document_loader(info).load(id, fields=document_fields(info))
         except repo.InvalidId as exc:
             return Errors([Error('id', ['invalid'])])
 
         if not document:
             return Errors([Error('id', ['not found'])])
 
-        result = Document.from_model(document)
-
-        return result
+        return document
 
 
 class Error(graphene.ObjectType):
@@ -124,6 +307,38 @@ class CreateDocument(graphene.Mutation):
         return Document.from_model(result)
 
 
+def bulk_response(result):
+    if isinstance(result, repo.RepoError):
+        return Errors.from_exception(result)
+    return Document.from_model(result)
+
+
+def check_bulk_size(items):
+    if len(items) > MAX_BULK_SIZE:
+        raise ValueError("at most %d items can be sent at once" % MAX_BULK_SIZE)
+
+
+class CreateDocuments(graphene.Mutation):
+    """
+    Create several documents at once, returning a Document or Errors for each of them in order.
+    """
+    class Arguments:
+        documents = graphene.List(graphene.NonNull(CreateDocumentInput), required=True)
+
+    Output = graphene.List(DocumentResponse)
+
+    async def mutate(self, info, documents):
+        global document_repo
+        assert(document_repo is not None)
+
+        check_bulk_size(documents)
+        results = await document_repo.create_many([
+            {'name': document.name, 'age': document.age, 'archived': document.archived}
+            for document in documents
+        ])
+        return [bulk_response(result) for result in results]
+
+
 class SetDocumentArchivedInput(graphene.InputObjectType):
     id = graphene.ID(required=True)
     archived = graphene.Boolean(required=True)
@@ -140,19 +355,35 @@ class SetDocumentArchived(graphene.Mutation):
         assert(document_repo is not None)
 
         try:
-            document = await document_repo.find_by_id(set_archived.id)
+            result = await document_repo.set_archived(set_archived.id, set_archived.archived)
         except repo.InvalidId as exc:
             return Errors([Error('id', ['invalid'])])
 
-        if not document:
+        if not result:
             return Errors([Error('id', ['not found'])])
 
-        document.set_archived(set_archived.archived)
-        result = await document_repo.save(document)
-            
         return Document.from_model(result)
 
 
+class SetDocumentsArchived(graphene.Mutation):
+    """
+    Archive or unarchive several documents at once, returning a Document or Errors for each id in order.
+    """
+    class Arguments:
+        ids = graphene.List(graphene.NonNull(graphene.ID), required=True)
+        archived = graphene.Boolean(required=True)
+
+    Output = graphene.List(DocumentResponse)
+
+    async def mutate(self, info, ids, archived):
+        global document_repo
+        assert(document_repo is not None)
+
+        check_bulk_size(ids)
+        results = await document_repo.set_archived_many(ids, archived)
+        return [bulk_response(result) for result in results]
+
+
 class DateInput(graphene.InputObjectType):
     month = graphene.Int(required=True)
     year = graphene.Int(required=True)
@@ -178,22 +409,19 @@ class AddChildField(graphene.Mutation):
         assert(document_repo is not None)
 
         try:
-            document = await document_repo.find_by_id(add_child_field.document_id)
+            result = await document_repo.add_child_field(
+                add_child_field.document_id,
+                model.ChildField(
+                    name=add_child_field.name,
+                    date=add_child_field.date.to_model(),
+                )
+            )
         except repo.InvalidId as exc:
             return Errors([Error('id', ['invalid'])])
 
-        if not document:
+        if not result:
             return Errors([Error('id', ['not found'])])
 
-        document.add_child_field(
-            model.ChildField(
-                name=add_child_field.name,
-                date=add_child_field.date.to_model(),
-            )
-        )
-
-        result = await document_repo.save(document)
-
         return Document.from_model(result)
 
 
@@ -213,19 +441,17 @@ class RemoveChildField(graphene.Mutation):
         assert(document_repo is not None)
 
         try:
-            document = await document_repo.find_by_id(remove_child_field.document_id)
+            result = await document_repo.remove_child_field(
+                remove_child_field.document_id,
+                remove_child_field.child_field_id
+            )
         except repo.InvalidId as exc:
             return Errors([Error('id', ['invalid'])])
-
-        if not document:
-            return Errors([Error('id', ['not found'])])
-
-        try:
-            document.remove_child_field(remove_child_field.child_field_id)
         except KeyError as exc:
             return Errors([Error('contract_id', ['not found'])])
 
-        result = await document_repo.save(document)
+        if not result:
+            return Errors([Error('id', ['not found'])])
 
         return Document.from_model(result)
 
@@ -252,24 +478,21 @@ class EditChildField(graphene.Mutation):
         assert(document_repo is not None)
 
         try:
-            document = await document_repo.find_by_id(edit_child_field.document_id)
+            result = await document_repo.update_child_field(
+                edit_child_field.document_id,
+                model.ChildField(
+                    id=edit_child_field.child_field.id,
+                    name=edit_child_field.child_field.name,
+                    date=edit_child_field.child_field.date.to_model()
+                )
+            )
         except repo.InvalidId as exc:
             return Errors([Error('id', ['invalid'])])
-
-        if not document:
-            return Errors([Error('id', ['not found'])])
-
-        try:
-            document.update_child_field(model.ChildField(
-                id=edit_child_field.child_field.id,
-                name=edit_child_field.child_field.name,
-                date=edit_child_field.child_field.date.to_model()
-            ))
-
         except KeyError as exc:
             return Errors([Error('contract_id', ['not found'])])
 
-        result = await document_repo.save(document)
+        if not result:
+            return Errors([Error('id', ['not found'])])
 
         return Document.from_model(result)
 
@@ -277,13 +500,33 @@ class EditChildField(graphene.Mutation):
 class Mutation(graphene.ObjectType):
     create_document = CreateDocument.Field()
     set_document_archived = SetDocumentArchived.Field()
+    create_documents = CreateDocuments.Field()
+    set_documents_archived = SetDocumentsArchived.Field()
 
     add_child_field = AddChildField.Field()
     remove_child_field = RemoveChildField.Field()
     edit_child_field = EditChildField.Field()
 
 
-schema = graphene.Schema(query=Query, mutation=Mutation)
+class Subscription(graphene.ObjectType):
+    """
+    Served over websockets by app/subscriptions.py, which runs the selection of a subscription once for every change
+    it matches with the changed Document as the root value.
+    """
+    document_changed = graphene.Field(Document, id=graphene.ID(required=True))
+    documents_changed = graphene.Field(Document, filter=DocumentFilterInput())
+
+    def resolve_document_changed(self, info, id):
+        return self
+
+    def resolve_documents_changed(self, info, filter=None):
+        return self
+
+
+schema = graphene.Schema(query=Query, mutation=Mutation, subscription=Subscription)
+
+# subscription operations are executed against this schema, as queries of the Subscription type
+change_schema = graphene.Schema(query=Subscription)
 
 
 __all__ = [
@@ -291,11 +534,18 @@ __all__ = [
     'DateInput',
     'ChildField',
     'Document',
+    'DocumentConnection',
+    'DocumentFilterInput',
+    'DocumentSortField',
+    'DocumentSortInput',
+    'SortDirection',
     'DocumentResponse',
     'SetDocumentArchived',
     'SetDocumentArchivedInput',
     'CreateDocument',
     'CreateDocumentInput',
+    'CreateDocuments',
+    'SetDocumentsArchived',
     'AddChildField',
     'AddChildFieldInput',
     'EditChildField',
@@ -307,6 +557,8 @@ __all__ = [
     'Errors',
     'Query',
     'Mutation',
-    'schema'
+    'Subscription',
+    'schema',
+    'change_schema'
 ]
 
@@ -0,0 +1,422 @@
+"""
+Load generator for the /graphql route, replaying a weighted mix of the operations in sample_graphql_queries/.
+
+    python3 -m app.loadtest --concurrency 32 --duration 30
+    python3 -m app.loadtest --rate 500 --duration 30 --mix query_all_documents=5 query_single_document=3
+    python3 -m app.loadtest --url http://localhost:8000/graphql --concurrency 64
+
+Without --url the app is started in a child process. --store memory, the default, serves --documents random
+documents with --children child fields each from an in-memory stand-in collection which does not apply writes,
+--store mongodb connects with the MONGODB_* settings like app.api. The ids the operations need are looked up with a
+documents query before the run.
+
+--concurrency runs a closed loop of that many clients, each sending its next request when the last one returned.
+--rate runs an open loop, requests are sent on schedule whatever the server is doing and their latency is counted
+from the time they were due, so a server which falls behind shows in the percentiles instead of slowing the load
+down. An operation fails on a status other than 200, errors in the response or a broken connection, Errors results
+of the mutations count as successes.
+"""
+from attr import attrs, Factory
+from argparse import ArgumentParser
+from urllib.parse import urlsplit
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+
+from typing import *
+
+
+SAMPLE_QUERIES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample_graphql_queries')
+
+IDS_QUERY = "query { documents(first: %d) { edges { node { id childField(first: 1) { id } } } } }"
+
+
+def load_queries(path: str=SAMPLE_QUERIES) -> Dict[str, str]:
+    """
+    The sample operations by file name without the .txt.
+    """
+    queries = {}
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.txt'):
+            with open(os.path.join(path, name), encoding='utf8') as f:
+                queries[name[:-len('.txt')]] = f.read()
+    return queries
+
+
+def fill_placeholders(query: str, document_id: str, child_field_id: Optional[str]=None) -> str:
+    query = query.replace('<object id of document>', document_id)
+    if child_field_id is not None:
+        query = query.replace('<object id of child_field>', child_field_id)
+    return query
+
+
+def parse_mix(mix: Iterable[str], queries: Dict[str, str]) -> Dict[str, float]:
+    """
+    name=weight arguments to weights by operation name, every sample operation with weight 1 when there are none.
+    """
+    weights = {}
+    for item in mix:
+        name, _, weight = item.partition('=')
+        if name not in queries:
+            raise ValueError('unknown operation %r, pick from %s' % (name, ', '.join(queries)))
+        weights[name] = float(weight or 1)
+    return weights or {name: 1.0 for name in queries}
+
+
+def percentile(ordered: Sequence[float], fraction: float) -> float:
+    """
+    Nearest rank percentile of an ordered sequence.
+    """
+    if not ordered:
+        return float('nan')
+    return ordered[min(len(ordered), max(1, math.ceil(fraction * len(ordered)))) - 1]
+
+
+@attrs(slots=True, auto_attribs=True)
+class OperationStats:
+    latencies: List[float] = Factory(list)
+    errors: int = 0
+    # the first few distinct failures, to tell what went wrong
+    error_samples: List[str] = Factory(list)
+
+    def record(self, latency: float, error: Optional[str]=None) -> None:
+        self.latencies.append(latency)
+        if error is not None:
+            self.errors += 1
+            if len(self.error_samples) < 3 and error not in self.error_samples:
+                self.error_samples.append(error)
+
+    def summary(self, duration: float) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+        count = len(ordered)
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'error_rate': self.errors / count if count else 0.0,
+            'throughput': count / duration if duration else 0.0,
+            'p50_ms': percentile(ordered, 0.50) * 1000,
+            'p95_ms': percentile(ordered, 0.95) * 1000,
+            'p99_ms': percentile(ordered, 0.99) * 1000,
+            'max_ms': (ordered[-1] if ordered else float('nan')) * 1000,
+            'error_samples': self.error_samples,
+        }
+
+
+class Connection:
+    """
+    A keep-alive HTTP/1.1 connection which posts json and reads back responses with a Content-Length.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def post(self, path: str, body: bytes) -> Tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        try:
+            self.writer.write((
+                'POST %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                % (path, self.host, self.port, len(body))
+            ).encode('latin1') + body)
+
+            status_line = await self.reader.readline()
+            if not status_line:
+                raise ConnectionError('connection closed by the server')
+            status = int(status_line.split()[1])
+
+            length, close = None, False
+            while True:
+                line = await self.reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin1').partition(':')
+                name = name.strip().lower()
+                if name == 'content-length':
+                    length = int(value)
+                elif name == 'connection' and value.strip().lower() == 'close':
+                    close = True
+
+            if length is None:
+                content, close = await self.reader.read(), True
+            else:
+                content = await self.reader.readexactly(length)
+        except BaseException:
+            self.close()
+            raise
+
+        if close:
+            self.close()
+        return status, content
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+def check_response(status: int, content: bytes) -> Optional[str]:
+    """
+    None for a successful operation, otherwise what went wrong.
+    """
+    if status != 200:
+        return 'HTTP %d: %s' % (status, content[:200].decode('utf8', 'replace'))
+    errors = json.loads(content.decode('utf8')).get('errors')
+    if errors:
+        return '; '.join(str(error.get('message')) for error in errors)
+    return None
+
+
+@attrs(slots=True, auto_attribs=True)
+class LoadTest:
+    url: str
+    queries: Dict[str, str]
+    weights: Dict[str, float]
+    # document id -> id of its first child field, None for documents without any
+    ids: Dict[str, Optional[str]] = Factory(dict)
+    rng: random.Random = Factory(random.Random)
+    stats: Dict[str, OperationStats] = Factory(dict)
+    # latencies are only recorded after the warmup
+    recording: bool = False
+
+    @property
+    def address(self) -> Tuple[str, int, str]:
+        url = urlsplit(self.url)
+        return url.hostname, url.port or 80, url.path or '/'
+
+    def connect(self) -> Connection:
+        host, port, _ = self.address
+        return Connection(host, port)
+
+    async def fetch_ids(self, count: int=100) -> None:
+        connection = self.connect()
+        try:
+            status, content = await connection.post(self.address[2], json.dumps({'query': IDS_QUERY % count}).encode())
+        finally:
+            connection.close()
+        error = check_response(status, content)
+        if error is not None:
+            raise RuntimeError('could not list documents: %s' % error)
+
+        for edge in json.loads(content.decode('utf8'))['data']['documents']['edges']:
+            child_fields = edge['node']['childField'] or []
+            self.ids[edge['node']['id']] = child_fields[0]['id'] if child_fields else None
+        if not self.ids:
+            raise RuntimeError('there are no documents to run the operations against, import some with model.bulk')
+
+    def next_request(self) -> Tuple[str, bytes]:
+        names = list(self.weights)
+        name = self.rng.choices(names, weights=[self.weights[name] for name in names])[0]
+        document_id = self.rng.choice(list(self.ids))
+        query = fill_placeholders(self.queries[name], document_id, self.ids[document_id])
+        return name, json.dumps({'query': query}).encode('utf8')
+
+    async def send(self, connection: Connection, name: str, body: bytes, started: float) -> None:
+        try:
+            error = check_response(*await connection.post(self.address[2], body))
+        except (OSError, ValueError, asyncio.IncompleteReadError) as exc:
+            error = '%s: %s' % (type(exc).__name__, exc)
+
+        if self.recording:
+            self.stats.setdefault(name, OperationStats()).record(time.perf_counter() - started, error)
+
+    async def closed_loop(self, concurrency: int, deadline: float) -> None:
+        async def client():
+            connection = self.connect()
+            try:
+                while time.perf_counter() < deadline:
+                    name, body = self.next_request()
+                    await self.send(connection, name, body, time.perf_counter())
+            finally:
+                connection.close()
+
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+
+    async def open_loop(self, rate: float, connections: int, deadline: float) -> None:
+        idle = asyncio.Queue()
+        for _ in range(connections):
+            idle.put_nowait(self.connect())
+
+        async def request(name, body, due):
+            # waiting for a free connection counts towards the latency
+            connection = await idle.get()
+            try:
+                await self.send(connection, name, body, due)
+            finally:
+                idle.put_nowait(connection)
+
+        pending = set()
+        due = time.perf_counter()
+        while due < deadline:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            name, body = self.next_request()
+            task = asyncio.ensure_future(request(name, body, due))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            due += self.rng.expovariate(rate)
+
+        if pending:
+            await asyncio.wait(pending)
+        while not idle.empty():
+            idle.get_nowait().close()
+
+    async def run(self,
+                  duration: float,
+                  warmup: float=0.0,
+                  concurrency: Optional[int]=None,
+                  rate: Optional[float]=None,
+                  connections: int=64) -> float:
+        """
+        Run the warmup and then the measured load, returning the measured duration in seconds.
+        """
+        async def load(seconds):
+            deadline = time.perf_counter() + seconds
+            if rate is not None:
+                await self.open_loop(rate, connections, deadline)
+            else:
+                await self.closed_loop(concurrency or 1, deadline)
+
+        if warmup > 0:
+            await load(warmup)
+
+        self.recording = True
+        started = time.perf_counter()
+        await load(duration)
+        return time.perf_counter() - started
+
+    def report(self, duration: float) -> Dict[str, Any]:
+        total = OperationStats()
+        for stats in self.stats.values():
+            total.latencies.extend(stats.latencies)
+            total.errors += stats.errors
+        return {
+            'duration': duration,
+            'total': dict(total.summary(duration), error_samples=[]),
+            'operations': {name: self.stats[name].summary(duration) for name in sorted(self.stats)},
+        }
+
+
+def print_report(report: Dict[str, Any], out=sys.stdout) -> None:
+    columns = ('requests', 'throughput', 'error_rate', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+    print(f'{"operation":<36}' + ''.join(f'{column:>12}' for column in columns), file=out)
+    rows = list(report['operations'].items()) + [('total', report['total'])]
+    for name, summary in rows:
+        print(f'{name:<36}' + ''.join(
+            f'{summary[column]:>12d}' if isinstance(summary[column], int) else f'{summary[column]:>12.3f}'
+            for column in columns
+        ), file=out)
+        for sample in summary['error_samples']:
+            print(f'    {sample}', file=out)
+
+
+def serve(port: int, store: str, documents: int, children: int) -> None:
+    """
+    Run app.api on port, with its repo over a MemoryCollection of random documents for the memory store.
+    """
+    from . import api
+
+    if store == 'memory':
+        from model.memory import MemoryCollection, random_documents
+        from model.repo import DocumentRepo
+        from . import gqlschema as gql
+
+        async def init_memory_repos(app, loop):
+            collection = MemoryCollection.of(random_documents(documents, children))
+            gql.set_repos(_document_repo=DocumentRepo(collection=collection))
+
+        listeners = api.app.listeners['before_server_start']
+        listeners[listeners.index(api.init_repos)] = init_memory_repos
+
+    api.set_event_loop_policy()
+    api.app.run(host='127.0.0.1', port=port, workers=1, debug=False, access_log=False)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float=30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help="graphql endpoint of a running service, started here when left out")
+    parser.add_argument('--store', choices=['memory', 'mongodb'], default='memory')
+    parser.add_argument('--documents', type=int, default=1000, help="documents in the memory store")
+    parser.add_argument('--children', type=int, default=20, help="child fields per document in the memory store")
+    parser.add_argument('--mix', nargs='*', default=[], metavar='NAME=WEIGHT',
+                        help="operations to send and their weights, all sample operations equally by default")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument('--concurrency', type=int, help="clients of the closed loop, 16 by default")
+    load.add_argument('--rate', type=float, help="requests per second of the open loop")
+    parser.add_argument('--connections', type=int, default=64, help="connection limit of the open loop")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of measured load")
+    parser.add_argument('--warmup', type=float, default=5.0, help="seconds of unmeasured load before that")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="write the report to this file")
+    args = parser.parse_args(argv)
+
+    queries = load_queries()
+    try:
+        weights = parse_mix(args.mix, queries)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    server = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        server = multiprocessing.Process(target=serve, args=(port, args.store, args.documents, args.children))
+        server.start()
+        wait_for_port(port)
+        url = 'http://127.0.0.1:%d/graphql' % port
+
+    try:
+        test = LoadTest(url, queries, weights, rng=random.Random(args.seed))
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test.fetch_ids())
+        print(f'Load testing {url} with {"%g requests/s" % args.rate if args.rate else "%d clients" % (args.concurrency or 16)}'
+              f' for {args.duration:g}s after {args.warmup:g}s of warmup', file=sys.stderr)
+        duration = loop.run_until_complete(test.run(
+            args.duration,
+            warmup=args.warmup,
+            concurrency=args.concurrency or 16,
+            rate=args.rate,
+            connections=args.connections
+        ))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    report = test.report(duration)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Prometheus metrics for the /metrics route, in the text exposition format.
+
+Every worker process keeps its own metrics and labels them with its pid, sum over the worker label to get totals.
+Counters and gauges are plain dicts, pymongo's monitoring listeners run on motor's worker threads so they take a
+lock of their own, and rendering iterates over copies of the dicts. Histograms also update lists of bucket counts
+in place, they lock around every observation and render from a copy taken under the same lock.
+
+Resolvers are timed when they are on the root types or return objects, the attribute lookups behind scalar fields
+are left alone so timing stays cheap enough to leave on.
+"""
+from attr import attrs, attrib, Factory
+from bisect import bisect_left
+from graphql.type import GraphQLScalarType, GraphQLEnumType
+from inspect import isawaitable
+from promise import Promise, is_thenable
+from pymongo import monitoring
+import os
+import threading
+import time
+
+from .cost import named_type
+
+from typing import *
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[Any], extra: str='') -> str:
+    """
+    {name="value",...} for the labels of a sample, extra being already formatted labels to add.
+    """
+    labels = ['%s="%s"' % (name, escape(value)) for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+@attrs(slots=True, auto_attribs=True)
+class Counter:
+    """
+    function, when given, is called at render time for the values instead.
+    """
+    name: str
+    help: str
+    labelnames: Tuple[str, ...] = ()
+    values: Dict[Tuple, float] = Factory(dict)
+    function: Optional[Callable[[], Dict[Tuple, float]]] = None
+    type = 'counter'
+
+    def inc(self, labels: Tuple=(), amount: float=1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self, extra: str='') -> Iterator[str]:
+        values = self.function() if self.function is not None else self.values
+        for labels, value in list(values.items()):
+            yield '%s%s %s' % (self.name, format_labels(self.labelnames, labels, extra), format_value(value))
+
+
+@attrs(slots=True, auto_attribs=True)
+class Gauge(Counter):
+    """
+    A Counter which can go down.
+    """
+    type = 'gauge'
+
+    def set(self, value: float, labels: Tuple=()) -> None:
+        self.values[labels] = value
+
+
+@attrs(slots=True, auto_attribs=True)
+class Histogram:
+    name: str
+    help: str
+    labelnames: Tuple[str, ...] = ()
+    buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    # labels -> [count per bucket, the last one for values above every bucket], labels -> sum of the values
+    counts: Dict[Tuple, List[int]] = Factory(dict)
+    sums: Dict[Tuple, float] = Factory(dict)
+    lock: Any = attrib(factory=threading.Lock, repr=False)
+    type = 'histogram'
+
+    def observe(self, value: float, labels: Tuple=()) -> None:
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.get(labels)
+            if counts is None:
+                counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+                self.sums[labels] = 0.0
+            counts[bucket] += 1
+            self.sums[labels] += value
+
+    def snapshot(self) -> List[Tuple[Tuple, List[int], float]]:
+        """
+        (labels, counts, sum) of every label set, consistent with each other.
+        """
+        with self.lock:
+            return [(labels, list(counts), self.sums[labels]) for labels, counts in self.counts.items()]
+
+    def samples(self, extra: str='') -> Iterator[str]:
+        for labels, counts, values_sum in self.snapshot():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                le = 'le="%s"' % format_value(bound)
+                le = '%s,%s' % (extra, le) if extra else le
+                yield '%s_bucket%s %d' % (self.name, format_labels(self.labelnames, labels, le), total)
+            label_set = format_labels(self.labelnames, labels, extra)
+            yield '%s_sum%s %s' % (self.name, label_set, repr(values_sum))
+            yield '%s_count%s %d' % (self.name, label_set, total)
+
+
+@attrs(slots=True, auto_attribs=True)
+class Registry:
+    metrics: List[Any] = Factory(list)
+    # added to every sample by the worker which rendered it
+    worker: str = Factory(lambda: str(os.getpid()))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        worker = 'worker="%s"' % escape(self.worker)
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, escape(metric.help)))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.samples(worker))
+        return '\n'.join(lines) + '\n'
+
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    pymongo command listener recording the duration of every command, and the failed ones separately.
+    """
+
+    def __init__(self, histogram: Histogram, failures: Counter):
+        self.histogram = histogram
+        self.failures = failures
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.histogram.observe(event.duration_micros / 1e6, (event.command_name,))
+
+    def failed(self, event):
+        self.histogram.observe(event.duration_micros / 1e6, (event.command_name,))
+        with self.lock:
+            self.failures.inc((event.command_name,))
+
+
+class ResolverTimer:
+    """
+    graphql-core middleware recording the time spent in resolvers, including the awaiting of async ones.
+    """
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        # (parent type name, field name) -> whether the field is timed
+        self.timed = {}
+
+    def is_timed(self, info) -> bool:
+        schema = info.schema
+        if info.parent_type in (schema.get_query_type(), schema.get_mutation_type(), schema.get_subscription_type()):
+            return True
+        return not isinstance(named_type(info.return_type), (GraphQLScalarType, GraphQLEnumType))
+
+    def resolve(self, next, root, info, **args):
+        key = (info.parent_type.name, info.field_name)
+        timed = self.timed.get(key)
+        if timed is None:
+            timed = self.timed[key] = self.is_timed(info)
+        if not timed:
+            return next(root, info, **args)
+
+        started = time.perf_counter()
+        result = next(root, info, **args)
+        # graphql-core hands middleware promises, which can not be awaited outside of the promise library
+        if is_thenable(result):
+            def rejected(error):
+                self.histogram.observe(time.perf_counter() - started, key)
+                raise error
+            return Promise.resolve(result).then(lambda value: self.observe(value, key, started), rejected)
+        if isawaitable(result):
+            return self.observe_awaitable(result, key, started)
+        return self.observe(result, key, started)
+
+    def observe(self, value, key, started):
+        self.histogram.observe(time.perf_counter() - started, key)
+        return value
+
+    async def observe_awaitable(self, result, key, started):
+        try:
+            return await result
+        finally:
+            self.histogram.observe(time.perf_counter() - started, key)
+
+
+@attrs(slots=True, auto_attribs=True)
+class ServiceMetrics:
+    """
+    The metrics of the service and the hooks which collect them.
+    """
+    registry: Registry = Factory(Registry)
+    http_requests: Histogram = attrib(init=False)
+    graphql_operations: Histogram = attrib(init=False)
+    graphql_resolvers: Histogram = attrib(init=False)
+    mongodb_commands: Histogram = attrib(init=False)
+    mongodb_command_failures: Counter = attrib(init=False)
+    mongodb_pool_max_size: Gauge = attrib(init=False)
+    repo_events: Counter = attrib(init=False)
+    repo_event_queue_depth: Gauge = attrib(init=False)
+    repo_event_queue_high_water: Gauge = attrib(init=False)
+    repo_event_dispatch: Counter = attrib(init=False)
+
+    def __attrs_post_init__(self):
+        register = self.registry.register
+        self.http_requests = register(Histogram(
+            'http_request_duration_seconds', 'HTTP request latency', ('method', 'route', 'status')
+        ))
+        self.graphql_operations = register(Histogram(
+            'graphql_operation_duration_seconds', 'GraphQL operation execution time', ('operation', 'name')
+        ))
+        self.graphql_resolvers = register(Histogram(
+            'graphql_resolver_duration_seconds', 'GraphQL resolver time', ('type', 'field')
+        ))
+        self.mongodb_commands = register(Histogram(
+            'mongodb_command_duration_seconds', 'MongoDB command latency', ('command',)
+        ))
+        self.mongodb_command_failures = register(Counter(
+            'mongodb_command_failures_total', 'MongoDB commands which failed', ('command',)
+        ))
+        self.mongodb_pool_max_size = register(Gauge(
+            'mongodb_pool_max_size', 'Connection pool size limit of each worker'
+        ))
+        self.repo_events = register(Counter(
+            'repo_events_total', 'Events emitted by the document repo', ('event',)
+        ))
+        self.repo_event_queue_depth = register(Gauge(
+            'repo_event_queue_depth', 'Events queued for deferred listeners'
+        ))
+        self.repo_event_queue_high_water = register(Gauge(
+            'repo_event_queue_high_water', 'Most events queued for deferred listeners at once'
+        ))
+        self.repo_event_dispatch = register(Counter(
+            'repo_event_dispatch_total', 'Events for deferred listeners by what became of them', ('outcome',)
+        ))
+
+    def mongodb_listeners(self) -> List[Any]:
+        """
+        Listeners to hand to the motor client as event_listeners.
+        """
+        return [CommandTimer(self.mongodb_commands, self.mongodb_command_failures)]
+
+    def resolver_middleware(self) -> ResolverTimer:
+        return ResolverTimer(self.graphql_resolvers)
+
+    def count_events(self, emitter, names: Iterable[str]=('DocumentCreated', 'DocumentSaved')) -> None:
+        for name in names:
+            emitter.on(name, lambda *args, name=name, **kwargs: self.repo_events.inc((name,)))
+
+    def watch_dispatcher(self, dispatcher) -> None:
+        """
+        Read the queue depth and outcome counts of an eventemitter.Dispatcher at render time.
+        """
+        self.repo_event_queue_depth.function = lambda: {(): len(dispatcher.queue)}
+        self.repo_event_queue_high_water.function = lambda: {(): dispatcher.high_water}
+        self.repo_event_dispatch.function = lambda: {
+            (outcome,): getattr(dispatcher, outcome) for outcome in ('delivered', 'dropped', 'coalesced', 'failed')
+        }
+
+    def render(self) -> str:
+        return self.registry.render()
+
+
+__all__ = [
+    'CONTENT_TYPE',
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'Registry',
+    'CommandTimer',
+    'ResolverTimer',
+    'ServiceMetrics'
+]
@@ -0,0 +1,224 @@
+"""
+Automatic persisted queries for the /graphql route.
+
+A client sends extensions.persistedQuery.sha256Hash instead of the query text. A known hash is swapped for its query
+before execution, an unknown one gets a PersistedQueryNotFound error and the client retries with hash and query,
+which registers the query once it parsed, validated, passed cost analysis and ran. Hash-only GET requests carry no
+body, so proxies and browsers can cache them.
+"""
+from attr import attrs, attrib, Factory
+from sanic_graphql import GraphQLView
+from graphql_server import HttpQueryError
+from hashlib import sha256
+import asyncio
+import json
+import os
+import threading
+
+from model.cache import LRUCache
+from model import tracing
+from .tracing import tracing_requested
+
+from typing import *
+
+
+PERSISTED_QUERY_VERSION = 1
+
+
+def query_hash(query: str) -> str:
+    return sha256(query.encode('utf8')).hexdigest()
+
+
+@attrs(slots=True, auto_attribs=True)
+class PersistedQueryStore:
+    """
+    sha256 hash -> query text, held in an LRU and appended to an optional file of json lines.
+
+    The file is read back when the store is opened, so registered queries survive restarts and are shared by
+    workers started after they were registered. It is rewritten with just the queries in the LRU when it is opened
+    and whenever it reached twice maxsize lines, so it stays about as big as the LRU. Writes run on the default
+    executor, a query a worker appends while another rewrites the file may be lost, its client registers it again.
+    """
+    cache: LRUCache = Factory(lambda: LRUCache(maxsize=1024, ttl=float('inf')))
+    path: Optional[str] = None
+    # lines in the file, as far as this store knows
+    lines: int = 0
+    lock: Any = attrib(factory=threading.Lock, repr=False)
+
+    @classmethod
+    def open(cls, maxsize: int=1024, path: Optional[str]=None) -> 'PersistedQueryStore':
+        store = cls(LRUCache(maxsize=maxsize, ttl=float('inf')), path)
+        if path and os.path.exists(path):
+            with open(path, encoding='utf8') as lines:
+                for line in lines:
+                    if line.strip():
+                        store.lines += 1
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # cut short by a worker which died while appending
+                            continue
+                        store.cache.set(entry['sha256Hash'], entry['query'])
+            if store.lines > len(store.cache.entries):
+                entries = store.entries()
+                store.write(entries, replace=True)
+                store.lines = len(entries)
+        return store
+
+    def get(self, sha256_hash: str) -> Optional[str]:
+        return self.cache.get(sha256_hash)
+
+    async def register(self, sha256_hash: str, query: str) -> None:
+        """
+        Raises ValueError if the hash is not the sha256 of the query.
+        """
+        if query_hash(query) != sha256_hash:
+            raise ValueError('provided sha does not match query')
+
+        if sha256_hash in self:
+            return
+
+        self.cache.set(sha256_hash, query)
+        if self.path:
+            replace = self.lines + 1 >= 2 * self.cache.maxsize
+            # the entries are copied on the event loop, which is the only thread changing the LRU
+            entries = self.entries() if replace else [(sha256_hash, query)]
+            self.lines = len(entries) if replace else self.lines + 1
+            await asyncio.get_event_loop().run_in_executor(None, self.write, entries, replace)
+
+    def entries(self) -> List[Tuple[str, str]]:
+        """
+        (hash, query) of every query in the LRU, least recently used first.
+        """
+        return [(sha256_hash, query) for sha256_hash, (_, query) in self.cache.entries.items()]
+
+    def write(self, entries: List[Tuple[str, str]], replace: bool) -> None:
+        """
+        Append entries to the file, or replace its contents with them.
+        """
+        data = ''.join(json.dumps({'sha256Hash': sha256_hash, 'query': query}) + '\n' for sha256_hash, query in entries)
+        with self.lock:
+            if not replace:
+                with open(self.path, 'a', encoding='utf8') as lines:
+                    lines.write(data)
+                return
+            with open(self.path + '.tmp', 'w', encoding='utf8') as lines:
+                lines.write(data)
+            os.replace(self.path + '.tmp', self.path)
+
+    def __contains__(self, sha256_hash) -> bool:
+        return sha256_hash in self.cache.entries
+
+    def stats(self) -> Dict[str, int]:
+        return self.cache.stats()
+
+
+def persisted_query(data: Mapping) -> Optional[Dict[str, Any]]:
+    """
+    The persistedQuery extension of a request, or None. GET requests send extensions as a json string.
+    """
+    extensions = data.get('extensions')
+    if isinstance(extensions, str):
+        try:
+            extensions = json.loads(extensions)
+        except ValueError:
+            raise HttpQueryError(400, 'Extensions sent invalid JSON.')
+    if not isinstance(extensions, dict):
+        return None
+    return extensions.get('persistedQuery')
+
+
+def resolve_persisted_query(store: PersistedQueryStore, data: Mapping) -> Optional[str]:
+    """
+    The query text for a request.
+
+    Returns None for requests which do not use persisted queries, raises HttpQueryError for unknown hashes and
+    hashes which do not match the query. A query sent with its hash is left for the caller to register once it ran.
+    """
+    extension = persisted_query(data)
+    if extension is None:
+        return None
+
+    if extension.get('version') != PERSISTED_QUERY_VERSION:
+        raise HttpQueryError(400, 'Unsupported persisted query version')
+
+    sha256_hash = extension.get('sha256Hash')
+    if not isinstance(sha256_hash, str):
+        raise HttpQueryError(400, 'Persisted query sha256Hash is required')
+
+    query = data.get('query')
+    if query:
+        if query_hash(query) != sha256_hash:
+            raise HttpQueryError(400, 'provided sha does not match query')
+        return query
+
+    query = store.get(sha256_hash)
+    if query is None:
+        # apollo clients look for this exact message to retry with the query text
+        raise HttpQueryError(200, 'PersistedQueryNotFound')
+    return query
+
+
+class PersistedQueryView(GraphQLView):
+    """
+    GraphQLView which resolves automatic persisted queries from persisted_queries before running them.
+
+    A query sent with its hash is registered only when it got a 200 response, queries which do not parse or
+    validate or are over the cost budget get a 400 and are not. Successful hash-only GET requests get a
+    Cache-Control header allowing them to be cached for max_age_cached seconds, 0 leaves the header out. With
+    tracing_enabled, requests with the X-GraphQL-Tracing header are traced.
+    """
+    persisted_queries = None
+    max_age_cached = 60
+    tracing_enabled = False
+    # the query this request sent with its hash, a view is made per request
+    unregistered = None
+
+    def parse_body(self, request):
+        data = super(PersistedQueryView, self).parse_body(request)
+        if isinstance(data, list):
+            return data
+
+        params = data if request.method != 'GET' else request.args
+        query = resolve_persisted_query(self.persisted_queries, params)
+        if query is None:
+            return data
+        if params.get('query'):
+            self.unregistered = query
+
+        data = dict(data)
+        data['query'] = query
+        return data
+
+    async def dispatch_request(self, request, *args, **kwargs):
+        token = tracing.start() if self.tracing_enabled and tracing_requested(request) else None
+        try:
+            response = await super(PersistedQueryView, self).dispatch_request(request, *args, **kwargs)
+        finally:
+            if token is not None:
+                tracing.stop(token)
+
+        if self.unregistered is not None and response.status == 200:
+            await self.persisted_queries.register(query_hash(self.unregistered), self.unregistered)
+
+        cacheable = (
+            request.method == 'GET' and response.status == 200 and self.max_age_cached
+            and not request.args.get('query')
+        )
+        if cacheable:
+            try:
+                extension = persisted_query(request.args)
+            except HttpQueryError:
+                extension = None
+            if extension and extension.get('sha256Hash') in self.persisted_queries:
+                response.headers['Cache-Control'] = 'public, max-age=%d' % self.max_age_cached
+
+        return response
+
+
+__all__ = [
+    'query_hash',
+    'PersistedQueryStore',
+    'resolve_persisted_query',
+    'PersistedQueryView'
+]
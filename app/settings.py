@@ -12,4 +12,33 @@ MONGODB_DB_COLLECTION_NAME = os.getenv("MONGODB_DB_COLLECTION_NAME")
 API_PORT = os.getenv("API_PORT")
 API_HOST = os.getenv("API_HOST")
 DEBUG = True if os.getenv("DEBUG").lower() in ['true', 'yes'] else False
-AUTO_RELOAD =True if os.getenv("AUTO_RELOAD").lower() in ['true', 'yes'] else False
\ No newline at end of file
+AUTO_RELOAD =True if os.getenv("AUTO_RELOAD").lower() in ['true', 'yes'] else False
+DOCUMENT_CODEC = os.getenv("DOCUMENT_CODEC", "marshmallow").lower()
+DOCUMENT_RAW_BSON = True if os.getenv("DOCUMENT_RAW_BSON", "false").lower() in ['true', 'yes'] else False
+DOCUMENT_CACHE_SIZE = int(os.getenv("DOCUMENT_CACHE_SIZE", "0"))
+DOCUMENT_CACHE_TTL = float(os.getenv("DOCUMENT_CACHE_TTL", "60"))
+API_WORKERS = int(os.getenv("API_WORKERS", "1")) or os.cpu_count()
+USE_UVLOOP = True if os.getenv("USE_UVLOOP", "true").lower() in ['true', 'yes'] else False
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS")
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(MONGODB_WAIT_QUEUE_TIMEOUT_MS) if MONGODB_WAIT_QUEUE_TIMEOUT_MS else None
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "512"))
+PERSISTED_QUERY_CACHE_SIZE = int(os.getenv("PERSISTED_QUERY_CACHE_SIZE", "1024"))
+PERSISTED_QUERY_FILE = os.getenv("PERSISTED_QUERY_FILE") or None
+PERSISTED_QUERY_MAX_AGE = int(os.getenv("PERSISTED_QUERY_MAX_AGE", "60"))
+QUERY_MAX_COST = int(os.getenv("QUERY_MAX_COST", "10000"))
+QUERY_MAX_DEPTH = int(os.getenv("QUERY_MAX_DEPTH", "10"))
+QUERY_COLLECTION_SCANS = os.getenv("QUERY_COLLECTION_SCANS", "reject").lower()
+GRAPHQL_TRACING = True if os.getenv("GRAPHQL_TRACING", "false").lower() in ['true', 'yes'] else False
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "10000"))
+EVENT_QUEUE_OVERFLOW = os.getenv("EVENT_QUEUE_OVERFLOW", "drop").lower()
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "100"))
+EVENT_BATCH_DELAY = float(os.getenv("EVENT_BATCH_DELAY", "0"))
+AMQP_URL = os.getenv("AMQP_URL") or None
+AMQP_EXCHANGE = os.getenv("AMQP_EXCHANGE", "documents")
+OUTBOX_COLLECTION_NAME = os.getenv("OUTBOX_COLLECTION_NAME", "outbox")
+OUTBOX_TRANSACTIONS = True if os.getenv("OUTBOX_TRANSACTIONS", "true").lower() in ['true', 'yes'] else False
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+SUBSCRIPTION_SOURCE = os.getenv("SUBSCRIPTION_SOURCE", "events" if API_WORKERS == 1 else "change_stream").lower()
+SUBSCRIPTION_BUFFER_SIZE = int(os.getenv("SUBSCRIPTION_BUFFER_SIZE", "100"))
@@ -0,0 +1,361 @@
+"""
+GraphQL subscriptions over websockets, speaking the graphql-ws protocol of subscriptions-transport-ws which Apollo
+Client and GraphiQL use.
+
+Changes come from the repo's DocumentCreated and DocumentSaved events, delivered in batches by its deferred
+dispatcher so mutations never wait for subscribers. Those are the writes of one worker, with several workers
+follow() a mongodb change stream instead, which needs a replica set. Subscriptions with the same query, operation name and
+variables share a Topic, which executes its selection once per change and hands the serialized payload to every
+subscriber. Subscribers only add their operation id around it.
+
+Every connection buffers up to maxsize messages it has not sent yet, keyed by operation and document. A newer
+change of a document replaces the one waiting in the buffer, and when the buffer is full of distinct documents the
+oldest is dropped. A slow consumer gets the latest state of what changed instead of every step, without holding up
+the other consumers or growing without bound.
+"""
+from attr import attrs, attrib, Factory
+from collections import OrderedDict
+from graphql.error import GraphQLError, format_error
+from graphql.execution import execute
+from graphql.execution.executors.asyncio import AsyncioExecutor
+from graphql.execution.values import get_argument_values, get_variable_values
+from graphql.language.base import parse
+from graphql.utils.get_operation_ast import get_operation_ast
+from graphql.validation import validate
+import asyncio
+import copy
+import json
+import random
+import traceback
+
+from model.cache import LRUCache
+from model.eventemitter import Event, EventEmitter
+from . import gqlschema as gql
+
+from typing import *
+
+
+PROTOCOL = 'graphql-ws'
+
+GQL_CONNECTION_INIT = 'connection_init'
+GQL_CONNECTION_ACK = 'connection_ack'
+GQL_CONNECTION_ERROR = 'connection_error'
+GQL_CONNECTION_TERMINATE = 'connection_terminate'
+GQL_START = 'start'
+GQL_DATA = 'data'
+GQL_ERROR = 'error'
+GQL_COMPLETE = 'complete'
+GQL_STOP = 'stop'
+
+EVENTS = ('DocumentCreated', 'DocumentSaved')
+
+
+def message(type: str, id: Optional[str]=None, payload: Any=None) -> str:
+    data = {'type': type}
+    if id is not None:
+        data['id'] = id
+    if payload is not None:
+        data['payload'] = payload
+    return json.dumps(data)
+
+
+class SubscriptionError(Exception):
+    def __init__(self, errors: List[Any]):
+        super(SubscriptionError, self).__init__(errors)
+        self.errors = errors
+
+
+@attrs(slots=True, auto_attribs=True, cmp=False)
+class Topic:
+    key: Tuple[str, Optional[str], str]
+    # the operation as a query of gql.change_schema
+    document_ast: Any
+    operation_name: Optional[str]
+    variables: Dict[str, Any]
+    field: str
+    # the document id of documentChanged, None for documentsChanged
+    document_id: Optional[str] = None
+    filter: Any = None
+    # (connection, operation id) of every subscriber
+    subscribers: Set[Tuple['Connection', str]] = Factory(set)
+
+    def matches(self, document) -> bool:
+        if self.document_id is not None:
+            return document.id == self.document_id
+        return self.filter is None or self.filter.matches(document)
+
+    async def execute(self, document) -> str:
+        """
+        The serialized payload of the data message for a change of document.
+        """
+        result = await execute(
+            gql.change_schema,
+            self.document_ast,
+            executor=AsyncioExecutor(),
+            root=gql.Document.from_model(document),
+            context_value={},
+            variable_values=self.variables,
+            operation_name=self.operation_name,
+            return_promise=True
+        )
+        return json.dumps(result.to_dict())
+
+
+@attrs(slots=True, auto_attribs=True)
+class SubscriptionManager:
+    # parsed subscription operations by query string, as (document ast, validation errors)
+    documents: LRUCache = attrib(factory=lambda: LRUCache(maxsize=512, ttl=float('inf')), repr=False)
+    topics: Dict[Tuple, Topic] = attrib(factory=dict, repr=False)
+    # document id -> the documentChanged topics about it
+    by_document: Dict[str, Set[Topic]] = attrib(factory=dict, repr=False)
+    # seconds before the change stream is opened again after an error, doubling up to max_backoff
+    backoff: float = 0.1
+    max_backoff: float = 30.0
+    executions: int = 0
+    messages: int = 0
+    feed_failures: int = 0
+
+    def attach(self, emitter: EventEmitter) -> None:
+        for name in EVENTS:
+            emitter.on(name, self.publish, batch=True)
+
+    def detach(self, emitter: EventEmitter) -> None:
+        for name in EVENTS:
+            emitter.off(name, self.publish)
+
+    def parse(self, query: str):
+        document = self.documents.get(query)
+        if document is None:
+            try:
+                document_ast = parse(query)
+            except GraphQLError as exc:
+                raise SubscriptionError([exc])
+            document = (document_ast, validate(gql.schema, document_ast))
+            self.documents.set(query, document)
+        return document
+
+    def topic(self, query: str, variables: Optional[Dict[str, Any]], operation_name: Optional[str]) -> Topic:
+        """
+        The Topic of a subscription operation, raising a SubscriptionError for invalid ones.
+        """
+        variables = variables or {}
+        key = (query, operation_name, json.dumps(variables, sort_keys=True))
+        topic = self.topics.get(key)
+        if topic is not None:
+            return topic
+
+        document_ast, errors = self.parse(query)
+        if errors:
+            raise SubscriptionError(errors)
+
+        operation = get_operation_ast(document_ast, operation_name)
+        if operation is None:
+            raise SubscriptionError([GraphQLError('Must provide a valid operation name')])
+        if operation.operation != 'subscription':
+            raise SubscriptionError([GraphQLError(
+                'Only subscriptions are served over websockets, send queries and mutations to /graphql'
+            )])
+        if len(operation.selection_set.selections) != 1:
+            raise SubscriptionError([GraphQLError('A subscription must select exactly one field')])
+
+        field_ast = operation.selection_set.selections[0]
+        field_def = gql.schema.get_subscription_type().fields[field_ast.name.value]
+        try:
+            variable_values = get_variable_values(gql.schema, operation.variable_definitions or [], variables)
+        except GraphQLError as exc:
+            raise SubscriptionError([exc])
+        args = get_argument_values(field_def.args, field_ast.arguments, variable_values)
+
+        query_operation = copy.copy(operation)
+        query_operation.operation = 'query'
+        definitions = [query_operation if definition is operation else definition
+                       for definition in document_ast.definitions]
+        query_ast = copy.copy(document_ast)
+        query_ast.definitions = definitions
+
+        document_filter = args.get('filter')
+        topic = Topic(
+            key=key,
+            document_ast=query_ast,
+            operation_name=operation_name,
+            variables=variables,
+            field=field_ast.name.value,
+            document_id=args.get('id'),
+            filter=document_filter.to_query() if document_filter is not None else None
+        )
+        self.topics[key] = topic
+        if topic.document_id is not None:
+            self.by_document.setdefault(topic.document_id, set()).add(topic)
+        return topic
+
+    def subscribe(self, connection: 'Connection', id: str, payload: Dict[str, Any]) -> Topic:
+        topic = self.topic(payload.get('query') or '', payload.get('variables'), payload.get('operationName'))
+        topic.subscribers.add((connection, id))
+        return topic
+
+    def unsubscribe(self, connection: 'Connection', id: str, topic: Topic) -> None:
+        topic.subscribers.discard((connection, id))
+        if not topic.subscribers:
+            del self.topics[topic.key]
+            if topic.document_id is not None:
+                topics = self.by_document[topic.document_id]
+                topics.discard(topic)
+                if not topics:
+                    del self.by_document[topic.document_id]
+
+    async def follow(self, collection, decode: Callable[[Dict[str, Any]], Any]) -> None:
+        """
+        Publish the inserts and updates of collection's change stream, decode turning mongodb documents into models.
+
+        Runs until cancelled. When the stream or publishing fails the error is printed and the stream opened again
+        after a backoff, resuming after the last change which was published so none are missed in between.
+        """
+        resume_token = None
+        delay = self.backoff
+
+        while True:
+            try:
+                async with collection.watch(full_document='updateLookup', resume_after=resume_token) as stream:
+                    async for change in stream:
+                        if change['operationType'] == 'invalidate':
+                            # the collection was dropped or renamed, a stream can not resume after that
+                            resume_token = None
+                            continue
+                        document = change.get('fullDocument')
+                        if document is not None:
+                            name = 'DocumentCreated' if change['operationType'] == 'insert' else 'DocumentSaved'
+                            await self.publish([Event(name, (decode(document),))])
+                        resume_token = change['_id']
+                        delay = self.backoff
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.feed_failures += 1
+                traceback.print_exc()
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, self.max_backoff)
+
+    def matching(self, document) -> Iterator[Topic]:
+        yield from self.by_document.get(document.id, ())
+        for topic in self.topics.values():
+            if topic.document_id is None and topic.matches(document):
+                yield topic
+
+    async def publish(self, events) -> None:
+        """
+        Batch listener of the repo's events, a change of a document which is in the batch twice is sent once.
+        """
+        documents = OrderedDict()
+        for event in events:
+            document = event.args[0]
+            documents.pop(document.id, None)
+            documents[document.id] = document
+
+        for document in documents.values():
+            for topic in list(self.matching(document)):
+                payload = await topic.execute(document)
+                self.executions += 1
+                for connection, id in list(topic.subscribers):
+                    connection.offer(id, document.id, payload)
+                    self.messages += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'topics': len(self.topics),
+            'subscribers': sum(len(topic.subscribers) for topic in self.topics.values()),
+            'executions': self.executions,
+            'messages': self.messages,
+            'feed_failures': self.feed_failures,
+        }
+
+
+@attrs(slots=True, auto_attribs=True, cmp=False)
+class Connection:
+    """
+    One websocket, whose messages are sent from a task of its own out of a buffer of up to maxsize data messages.
+    """
+    websocket: Any
+    manager: SubscriptionManager
+    maxsize: int = 100
+    # operation id -> its topic
+    operations: Dict[str, Topic] = Factory(dict)
+    # (operation id, document id) -> data message
+    pending: Dict[Tuple[str, str], str] = Factory(OrderedDict)
+    ready: asyncio.Event = Factory(asyncio.Event)
+    conflated: int = 0
+    dropped: int = 0
+
+    def offer(self, id: str, document_id: str, payload: str) -> None:
+        key = (id, document_id)
+        if key in self.pending:
+            del self.pending[key]
+            self.conflated += 1
+        elif len(self.pending) >= self.maxsize:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+        # the payload is already json, only the envelope is serialized per subscriber
+        self.pending[key] = '{"type": "%s", "id": %s, "payload": %s}' % (GQL_DATA, json.dumps(id), payload)
+        self.ready.set()
+
+    async def send_pending(self) -> None:
+        while True:
+            if not self.pending:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            _, data = self.pending.popitem(last=False)
+            await self.websocket.send(data)
+
+    def start(self, id: str, payload: Dict[str, Any]) -> Optional[str]:
+        """
+        Subscribe operation id, returning the error message to send if it is not a valid subscription.
+        """
+        if id in self.operations:
+            self.stop(id)
+        try:
+            self.operations[id] = self.manager.subscribe(self, id, payload or {})
+        except SubscriptionError as exc:
+            return message(GQL_ERROR, id, [
+                format_error(error) if isinstance(error, GraphQLError) else {'message': str(error)}
+                for error in exc.errors
+            ])
+        return None
+
+    def stop(self, id: str) -> None:
+        topic = self.operations.pop(id, None)
+        if topic is not None:
+            self.manager.unsubscribe(self, id, topic)
+            for key in [key for key in self.pending if key[0] == id]:
+                del self.pending[key]
+
+    async def serve(self) -> None:
+        sender = asyncio.ensure_future(self.send_pending())
+        try:
+            while True:
+                try:
+                    received = json.loads(await self.websocket.recv())
+                    type, id = received.get('type'), received.get('id')
+                except (ValueError, AttributeError):
+                    await self.websocket.send(message(GQL_CONNECTION_ERROR, payload={'message': 'Invalid message'}))
+                    continue
+
+                if type == GQL_CONNECTION_INIT:
+                    await self.websocket.send(message(GQL_CONNECTION_ACK))
+                elif type == GQL_START:
+                    error = self.start(id, received.get('payload'))
+                    if error is not None:
+                        await self.websocket.send(error)
+                elif type == GQL_STOP:
+                    self.stop(id)
+                    await self.websocket.send(message(GQL_COMPLETE, id))
+                elif type == GQL_CONNECTION_TERMINATE:
+                    break
+                else:
+                    await self.websocket.send(message(GQL_ERROR, id, [{'message': 'Unknown message type %r' % type}]))
+        finally:
+            sender.cancel()
+            for id in list(self.operations):
+                self.stop(id)
+
+
+__all__ = ['PROTOCOL', 'SubscriptionError', 'Topic', 'SubscriptionManager', 'Connection']
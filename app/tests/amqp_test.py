@@ -0,0 +1,99 @@
+from pamqp import specification
+import unittest
+import asyncio
+
+from model import model, repo
+from model.memory import MemoryCollection
+from model.outbox import Outbox, OutboxRelay
+from model.tests.outbox_test import OutboxCollection
+from app.amqp import AmqpPublisher, MemoryBroker
+
+
+class Exchange:
+    """
+    Confirms every message published to it with confirm(message id), the aio-pika default being a Basic.Ack.
+    """
+    def __init__(self, confirm=lambda message_id: specification.Basic.Ack()):
+        self.confirm = confirm
+        self.published = []
+
+    async def publish(self, message, routing_key, mandatory=True):
+        self.published.append((message.message_id, mandatory))
+        return self.confirm(message.message_id)
+
+
+class AmqpTest(unittest.TestCase):
+    def test_relay_to_broker(self):
+        outbox = Outbox(OutboxCollection())
+        document_repo = repo.DocumentRepo(collection=MemoryCollection(), outbox=outbox)
+        broker = MemoryBroker()
+
+        async def run_test():
+            document = await document_repo.create(
+                name='Luke',
+                child_field=[model.ChildField(model.Date(5, 2019), 'X-Wing')]
+            )
+            await OutboxRelay(outbox, broker).relay_once()
+            return document
+
+        document = asyncio.get_event_loop().run_until_complete(run_test())
+
+        [(routing_key, message_id, body)] = broker.messages
+        self.assertEqual(routing_key, 'document.created')
+        self.assertEqual(body['id'], message_id)
+        self.assertEqual(body['event'], 'DocumentCreated')
+        self.assertEqual(body['document']['_id'], document.id)
+        self.assertEqual(body['document']['name'], 'Luke')
+        self.assertEqual(body['document']['child_field'][0]['name'], 'X-Wing')
+
+    def make_relay(self, confirm):
+        self.outbox = Outbox(OutboxCollection())
+        self.document_repo = repo.DocumentRepo(collection=MemoryCollection(), outbox=self.outbox)
+        self.exchange = Exchange(confirm)
+        return OutboxRelay(self.outbox, AmqpPublisher('amqp://', exchange=self.exchange))
+
+    def test_returned_messages_are_delivered(self):
+        returned = []
+
+        def confirm(message_id):
+            # what aiormq resolves the confirmation of a mandatory message no queue is bound for with
+            if not returned:
+                returned.append(message_id)
+                return object()
+            return specification.Basic.Ack()
+
+        relay = self.make_relay(confirm)
+
+        async def run_test():
+            await self.document_repo.create_many([{'name': 'Luke'}, {'name': 'Leia'}])
+            with self.assertLogs('app.amqp', 'WARNING'):
+                self.assertEqual(await relay.relay_once(), 2)
+            self.assertEqual(await relay.relay_once(), 0)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual([mandatory for _, mandatory in self.exchange.published], [False, False])
+        self.assertEqual(self.outbox.collection.data, [])
+
+    def test_nacked_batch_is_sent_again(self):
+        nacked = []
+
+        def confirm(message_id):
+            if not nacked:
+                nacked.append(message_id)
+                return specification.Basic.Nack()
+            return specification.Basic.Ack()
+
+        relay = self.make_relay(confirm)
+
+        async def run_test():
+            await self.document_repo.create_many([{'name': 'Luke'}, {'name': 'Leia'}])
+            with self.assertRaises(ConnectionError):
+                await relay.relay_once()
+            self.assertEqual(await relay.relay_once(), 2)
+            self.assertEqual(await relay.relay_once(), 0)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(len(self.exchange.published), 4)
+        self.assertEqual(self.outbox.collection.data, [])
@@ -10,8 +10,10 @@ import asyncio
 from graphql.execution.executors.asyncio import AsyncioExecutor
 
 from attr import attrs, attrib, Factory, fields
-from model import model, schema
-from model.repo import RepoError
+from model import model, schema, query, repo, codec
+from model.cache import DocumentCache
+from model.memory import MemoryCollection
+from model.repo import RepoError, Slice, CHILD_FIELD_COUNT
 from typing import *
 from bson import ObjectId
 from pymongo import ReturnDocument
@@ -33,6 +35,7 @@ def to_dict(data):
 @attrs(slots=True, auto_attribs=True)
 class InMemoryDocumentRepo:
     data: List[model.Document] = Factory(list)
+    requested_fields: List[Any] = Factory(list)
 
     def set_data(self, documents):
         for d in documents:
@@ -43,13 +46,59 @@ class InMemoryDocumentRepo:
             if d.id == document_id:
                 return deepcopy(d)
 
-    async def find_by_id(self, document_id:str) -> Optional[model.Document]:
-        return self._find_by_id(document_id)
-
-    async def find(self, criteria=None) -> Iterator[model.Document]:
+    def _project(self, document:model.Document, fields) -> model.Document:
+        # mimic a mongodb projection, fields which are not loaded get their model defaults
+        self.requested_fields.append(fields)
+        if fields is None:
+            return document
+        kwargs = {f: getattr(document, f) for f in ['age', 'archived', 'child_field'] if f in fields}
+        slices = [field for field in fields if isinstance(field, Slice)]
+        if slices and 'child_field' not in fields:
+            start = min(field.skip for field in slices)
+            kwargs['child_field'] = document.child_field[start:max(field.skip + field.limit for field in slices)]
+            kwargs['child_field_offset'] = start
+        if CHILD_FIELD_COUNT in fields:
+            kwargs['child_field_count'] = len(document.child_field)
+        return model.Document(id=document.id, name=document.name, **kwargs)
+
+    async def find_by_id(self, document_id:str, fields=None) -> Optional[model.Document]:
+        document = self._find_by_id(document_id)
+        return self._project(document, fields) if document is not None else None
+
+    async def find_by_ids(self, document_ids:List[str], fields=None) -> Dict[str, model.Document]:
+        results = {}
+        for document_id in document_ids:
+            document = self._find_by_id(str(ObjectId(document_id)))
+            if document is not None:
+                results[document.id] = self._project(document, fields)
+        return results
+
+    async def find(self, criteria=None, limit=None, after=None, fields=None, filter=None, sort=None) -> Iterator[model.Document]:
         assert(criteria is None)
-        for d in self.data:
-            yield deepcopy(d)
+        sort = sort or query.DocumentSort()
+        documents = sorted(self.data, key=lambda d: ObjectId(d.id))
+        if filter is not None:
+            documents = [d for d in documents if filter.matches(d)]
+        if sort.field != '_id':
+            # the sort is stable so equal values stay in _id order, missing values go first like in mongodb
+            documents.sort(key=lambda d: (getattr(d, sort.field) is not None, getattr(d, sort.field) or 0))
+            if fields is not None:
+                fields = set(fields) | {sort.field}
+        if sort.direction == query.pymongo.DESCENDING:
+            documents.reverse()
+        if after is not None:
+            sort.after_criteria(after)
+            if sort.field == '_id':
+                after = ObjectId(after)
+                if sort.direction == query.pymongo.ASCENDING:
+                    documents = [d for d in documents if ObjectId(d.id) > after]
+                else:
+                    documents = [d for d in documents if ObjectId(d.id) < after]
+            else:
+                cursors = [sort.cursor(d) for d in documents]
+                documents = documents[cursors.index(after) + 1:]
+        for d in documents[:limit or None]:
+            yield self._project(deepcopy(d), fields)
 
     async def find_by_name(self, name:str):
         for document in self.data:
@@ -73,6 +122,15 @@ class InMemoryDocumentRepo:
         self.data.append(result)
         return result
 
+    async def create_many(self, documents:List[Dict[str, Any]]) -> List[Union[model.Document, RepoError]]:
+        results = []
+        for document in documents:
+            try:
+                results.append(await self.create(**document))
+            except RepoError as exc:
+                results.append(exc)
+        return results
+
     def _save(self, document:model.Document) -> model.Document:
         result = deepcopy(document)
 
@@ -95,6 +153,34 @@ class InMemoryDocumentRepo:
     async def save(self, document:model.Document) -> model.Document:
         return self._save(document)
 
+    def _update(self, document_id:str, update) -> Optional[model.Document]:
+        for document in self.data:
+            if document.id == str(ObjectId(document_id)):
+                update(document)
+                return deepcopy(document)
+
+    async def set_archived(self, document_id:str, archived:bool) -> Optional[model.Document]:
+        return self._update(document_id, lambda d: d.set_archived(archived))
+
+    async def set_archived_many(self, document_ids:List[str], archived:bool) -> List[Union[model.Document, RepoError]]:
+        results = []
+        for document_id in document_ids:
+            if not ObjectId.is_valid(document_id):
+                results.append(RepoError({'id': ['invalid']}))
+                continue
+            result = self._update(document_id, lambda d: d.set_archived(archived))
+            results.append(result if result is not None else RepoError({'id': ['not found']}))
+        return results
+
+    async def add_child_field(self, document_id:str, child_field:model.ChildField) -> Optional[model.Document]:
+        return self._update(document_id, lambda d: d.add_child_field(child_field))
+
+    async def remove_child_field(self, document_id:str, child_field_id:str) -> Optional[model.Document]:
+        return self._update(document_id, lambda d: d.remove_child_field(child_field_id))
+
+    async def update_child_field(self, document_id:str, child_field:model.ChildField) -> Optional[model.Document]:
+        return self._update(document_id, lambda d: d.update_child_field(child_field))
+
 
 
 class GQLTest(unittest.TestCase):
@@ -107,10 +193,12 @@ class GQLTest(unittest.TestCase):
     def tearDown(self):
         gql.set_repos(None)
 
-    def execute(self, query):
+    def execute(self, query, variables=None):
         # execute query
         fut = gql.schema.execute(
             query,
+            variables=variables,
+            context={},
             executor=AsyncioExecutor(),
             return_promise=True,
         )
@@ -125,16 +213,37 @@ class Document(GQLTest):
     DOCUMENTS_QUERY = """
     query{
       documents{
-        id
-        name
-        age
-        childField{
-          name
-          date{
-            month
-            year
+        edges{
+          node{
+            id
+            name
+            age
+            childField{
+              name
+              date{
+                month
+                year
+              }
+            }
+          }
+        }
+      }
+    }
+    """
+
+    DOCUMENTS_PAGE_QUERY = """
+    query($first: Int, $after: String){
+      documents(first: $first, after: $after){
+        edges{
+          cursor
+          node{
+            name
           }
         }
+        pageInfo{
+          hasNextPage
+          endCursor
+        }
       }
     }
     """
@@ -163,23 +272,106 @@ class Document(GQLTest):
         self.assertEqual(result.errors, None)
 
         self.assertEqual(to_dict(result.data), {
-            'documents':[
-                {
-                    'id': d.id,
-                    'name':d.name,
-                    'age':d.age,
-                    'childField':[
-                        {
-                            'name': "Luke Skywalker",
-                            'date': {
-                                'month': 8,
-                                'year': 2018
-                            }
+            'documents':{
+                'edges':[
+                    {
+                        'node':{
+                            'id': d.id,
+                            'name':d.name,
+                            'age':d.age,
+                            'childField':[
+                                {
+                                    'name': "Luke Skywalker",
+                                    'date': {
+                                        'month': 8,
+                                        'year': 2018
+                                    }
+                                }
+                            ]
                         }
-                    ]
-                } for d in documents
-            ]
+                    } for d in documents
+                ]
+            }
+        })
+
+    def test_paginate_documents(self):
+        documents = [self.document_repo._save(model.Document(name="Clone %d" % i)) for i in range(5)]
+
+        names = []
+        after = None
+        has_next_page = True
+        while has_next_page:
+            result = self.execute(self.DOCUMENTS_PAGE_QUERY, variables={'first': 2, 'after': after})
+            self.assertEqual(result.errors, None)
+
+            page = to_dict(result.data)['documents']
+            self.assertTrue(len(page['edges']) <= 2)
+            names.extend(edge['node']['name'] for edge in page['edges'])
+
+            has_next_page = page['pageInfo']['hasNextPage']
+            after = page['pageInfo']['endCursor']
+
+        self.assertEqual(names, [d.name for d in documents])
+
+    def test_paginate_documents_invalid_cursor(self):
+        result = self.execute(self.DOCUMENTS_PAGE_QUERY, variables={'first': 2, 'after': 'not-a-cursor'})
+
+        self.assertEqual(len(result.errors), 1)
+        self.assertEqual(result.data, {'documents': None})
+
+    DOCUMENTS_FILTER_QUERY = """
+    query($first: Int, $after: String, $filter: DocumentFilterInput, $sort: DocumentSortInput){
+      documents(first: $first, after: $after, filter: $filter, sort: $sort){
+        edges{
+          node{
+            name
+          }
+        }
+        pageInfo{
+          hasNextPage
+          endCursor
+        }
+      }
+    }
+    """
+
+    def test_filter_and_sort_documents(self):
+        for name, age, archived in [("Yoda", 900, False), ("Luke", 19, False), ("Leia", 19, True),
+                                    ("Lando", None, False), ("Rey", 19, False)]:
+            self.document_repo._save(model.Document(name=name, age=age, archived=archived))
+
+        names = []
+        after = None
+        has_next_page = True
+        while has_next_page:
+            result = self.execute(self.DOCUMENTS_FILTER_QUERY, variables={
+                'first': 2,
+                'after': after,
+                'filter': {'archived': False, 'ageMax': 100},
+                'sort': {'field': 'AGE', 'direction': 'DESC'}
+            })
+            self.assertEqual(result.errors, None)
+
+            page = to_dict(result.data)['documents']
+            names.extend(edge['node']['name'] for edge in page['edges'])
+            has_next_page = page['pageInfo']['hasNextPage']
+            after = page['pageInfo']['endCursor']
+
+        self.assertEqual(names, ["Rey", "Luke"])
+
+        result = self.execute(self.DOCUMENTS_FILTER_QUERY, variables={
+            'filter': {'namePrefix': 'L'},
+            'sort': {'field': 'NAME'}
         })
+        self.assertEqual(result.errors, None)
+        self.assertEqual([edge['node']['name'] for edge in to_dict(result.data)['documents']['edges']],
+                         ["Lando", "Leia", "Luke"])
+
+    def test_sorted_documents_invalid_cursor(self):
+        result = self.execute(self.DOCUMENTS_FILTER_QUERY, variables={'after': 'not-a-cursor', 'sort': {'field': 'AGE'}})
+
+        self.assertEqual(len(result.errors), 1)
+        self.assertEqual(result.data, {'documents': None})
 
     @given(st.from_type(model.Document))
     def test_get_document(self, document):
@@ -200,6 +392,137 @@ class Document(GQLTest):
         self.assertEqual(result.errors, None)
         self.assertEqual(to_dict(result.data), {'document':{ 'id': document.id, 'name':document.name }})
 
+    def test_get_aliased_documents(self):
+        documents = [self.document_repo._save(model.Document(name="Clone %d" % i)) for i in range(3)]
+
+        ALIASED_DOCUMENTS_QUERY = """
+        query {
+            first: document(id:"%s") { name }
+            second: document(id:"%s") { name }
+            again: document(id:"%s") { name }
+        }
+        """ % (documents[0].id, documents[1].id, documents[0].id)
+
+        result = self.execute(ALIASED_DOCUMENTS_QUERY)
+
+        self.assertEqual(result.errors, None)
+        self.assertEqual(to_dict(result.data), {
+            'first': {'name': documents[0].name},
+            'second': {'name': documents[1].name},
+            'again': {'name': documents[0].name},
+        })
+
+    def test_documents_projection(self):
+        self.document_repo._save(model.Document(name="Anakin Skywalker", age=99))
+
+        result = self.execute(self.DOCUMENTS_PAGE_QUERY)
+        self.assertEqual(result.errors, None)
+        self.assertEqual(self.document_repo.requested_fields, [{'name'}])
+
+        self.document_repo.requested_fields = []
+        result = self.execute(self.DOCUMENTS_QUERY)
+        self.assertEqual(result.errors, None)
+        self.assertEqual(self.document_repo.requested_fields, [{'_id', 'name', 'age', 'child_field'}])
+
+    def test_child_field_page(self):
+        document = self.document_repo._save(model.Document(
+            name="Anakin Skywalker",
+            child_field=[model.ChildField(name="Child %d" % i, date=model.Date(month=1, year=2000)) for i in range(50)]
+        ))
+
+        CHILD_FIELD_PAGE_QUERY = """
+        query($first: Int) {
+            document(id:"%s") {
+                ... on Document {
+                    childFieldCount
+                    childField(first: $first, offset: 10) { name }
+                    again: childField(first: 2) { name }
+                }
+            }
+        }
+        """ % document.id
+
+        result = self.execute(CHILD_FIELD_PAGE_QUERY, variables={'first': 3})
+
+        self.assertEqual(result.errors, None)
+        self.assertEqual(to_dict(result.data), {'document': {
+            'childFieldCount': 50,
+            'childField': [{'name': "Child %d" % i} for i in range(10, 13)],
+            'again': [{'name': "Child 0"}, {'name': "Child 1"}],
+        }})
+        self.assertEqual(self.document_repo.requested_fields, [
+            frozenset({CHILD_FIELD_COUNT, Slice('child_field', 3, 10), Slice('child_field', 2)})
+        ])
+
+    def test_child_field_page_from_offset(self):
+        document = self.document_repo._save(model.Document(
+            name="Anakin Skywalker",
+            child_field=[model.ChildField(name="Child %d" % i, date=model.Date(month=1, year=2000)) for i in range(50)]
+        ))
+
+        result = self.execute("""
+        query {
+            document(id:"%s") {
+                ... on Document {
+                    childField(first: 3, offset: 40) { name }
+                    next: childField(first: 2, offset: 43) { name }
+                }
+            }
+        }
+        """ % document.id)
+
+        self.assertEqual(result.errors, None)
+        self.assertEqual(to_dict(result.data), {'document': {
+            'childField': [{'name': "Child %d" % i} for i in range(40, 43)],
+            'next': [{'name': "Child 43"}, {'name': "Child 44"}],
+        }})
+        # only children 40 to 44 are loaded
+        self.assertEqual(self.document_repo.requested_fields, [
+            frozenset({Slice('child_field', 3, 40), Slice('child_field', 2, 43)})
+        ])
+
+    def test_empty_child_field_page(self):
+        document = self.document_repo._save(model.Document(
+            name="Anakin Skywalker",
+            child_field=[model.ChildField(name="Child %d" % i, date=model.Date(month=1, year=2000)) for i in range(3)]
+        ))
+
+        result = self.execute("""
+        query {
+            document(id:"%s") {
+                ... on Document {
+                    name
+                    childField(first: 0, offset: 1) { name }
+                }
+            }
+        }
+        """ % document.id)
+
+        self.assertEqual(result.errors, None)
+        self.assertEqual(to_dict(result.data), {'document': {'name': "Anakin Skywalker", 'childField': []}})
+
+    def test_document_projection_with_fragments(self):
+        document = self.document_repo._save(model.Document(name="Anakin Skywalker", age=99))
+
+        FRAGMENT_QUERY = """
+        query {
+            document(id:"%s") {
+                ...DocumentAge
+                ... on Document { archived }
+            }
+        }
+
+        fragment DocumentAge on Document {
+            age
+        }
+        """ % document.id
+
+        result = self.execute(FRAGMENT_QUERY)
+
+        self.assertEqual(result.errors, None)
+        self.assertEqual(to_dict(result.data), {'document': {'age': 99, 'archived': False}})
+        self.assertEqual(self.document_repo.requested_fields, [frozenset({'age', 'archived'})])
+
     CREATE_DOCUMENT_MUTATION = """
     mutation {
       createDocument(document:{
@@ -465,6 +788,152 @@ class Document(GQLTest):
             }
         })
 
+    def test_remove_child_field_errors(self):
+        document = self.document_repo._save(model.Document(name="Anakin Skywalker"))
+
+        REMOVE_CHILD_FIELD_MUTATION = """
+        mutation {
+          removeChildField(removeChildField:{
+            documentId: "%s"
+            childFieldId: "%s"
+          })
+          {
+            ... on Errors{
+              errors{
+                field
+                messages
+              }
+            }
+          }
+        }
+        """
+
+        cases = [
+            ((document.id, str(ObjectId())), {'field': 'contract_id', 'messages': ['not found']}),
+            ((document.id, 'not an id'), {'field': 'contract_id', 'messages': ['not found']}),
+            ((str(ObjectId()), str(ObjectId())), {'field': 'id', 'messages': ['not found']}),
+            (('not an id', str(ObjectId())), {'field': 'id', 'messages': ['invalid']}),
+        ]
+
+        for ids, error in cases:
+            result = self.execute(REMOVE_CHILD_FIELD_MUTATION % ids)
+            self.assertEqual(result.errors, None)
+            self.assertEqual(to_dict(result.data), {'removeChildField': {'errors': [error]}})
+
+    BULK_RESPONSE_FIELDS = """
+            __typename
+            ... on Document {
+              name
+              archived
+            }
+            ... on Errors {
+              errors {
+                field
+                messages
+              }
+            }
+    """
+
+    def test_create_documents(self):
+        self.document_repo._save(model.Document(name="Anakin Skywalker"))
+
+        result = self.execute("""
+        mutation($documents: [CreateDocumentInput!]!) {
+          createDocuments(documents: $documents) {%s}
+        }
+        """ % self.BULK_RESPONSE_FIELDS, variables={
+            'documents': [{'name': 'Luke Skywalker'}, {'name': 'Anakin Skywalker'}, {'name': 'Leia Organa'}]
+        })
+
+        self.assertEqual(result.errors, None)
+        self.assertEqual(to_dict(result.data), {'createDocuments': [
+            {'__typename': 'Document', 'name': 'Luke Skywalker', 'archived': None},
+            {'__typename': 'Errors', 'errors': [{'field': 'name', 'messages': ['already exists']}]},
+            {'__typename': 'Document', 'name': 'Leia Organa', 'archived': None},
+        ]})
+        self.assertEqual(len(self.document_repo.data), 3)
+
+    def test_create_documents_too_many(self):
+        result = self.execute("""
+        mutation($documents: [CreateDocumentInput!]!) {
+          createDocuments(documents: $documents) {%s}
+        }
+        """ % self.BULK_RESPONSE_FIELDS, variables={
+            'documents': [{'name': str(i)} for i in range(gql.MAX_BULK_SIZE + 1)]
+        })
+
+        self.assertEqual(len(result.errors), 1)
+        self.assertEqual(self.document_repo.data, [])
+
+    def test_set_documents_archived(self):
+        document = self.document_repo._save(model.Document(name="Anakin Skywalker"))
+
+        result = self.execute("""
+        mutation($ids: [ID!]!) {
+          setDocumentsArchived(ids: $ids, archived: true) {%s}
+        }
+        """ % self.BULK_RESPONSE_FIELDS, variables={'ids': [document.id, str(ObjectId()), 'not an id']})
+
+        self.assertEqual(result.errors, None)
+        self.assertEqual(to_dict(result.data), {'setDocumentsArchived': [
+            {'__typename': 'Document', 'name': 'Anakin Skywalker', 'archived': True},
+            {'__typename': 'Errors', 'errors': [{'field': 'id', 'messages': ['not found']}]},
+            {'__typename': 'Errors', 'errors': [{'field': 'id', 'messages': ['invalid']}]},
+        ]})
+
+
+@attrs(slots=True, auto_attribs=True)
+class CountingCollection(MemoryCollection):
+    finds: int = 0
+
+    def find(self, *args, **kwargs):
+        self.finds += 1
+        return MemoryCollection.find(self, *args, **kwargs)
+
+
+class CachedDocument(GQLTest):
+    def setUp(self):
+        super(CachedDocument, self).setUp()
+        self.luke = model.Document(name="Luke Skywalker", age=19)
+        self.collection = CountingCollection.of([self.luke])
+        self.cache = DocumentCache()
+        gql.set_repos(_document_repo=repo.DocumentRepo(collection=self.collection, cache=self.cache))
+
+    def test_document_queries_fill_the_cache(self):
+        for _ in range(3):
+            # a new context per query, so only the cache can save the later ones a round trip
+            fut = gql.schema.execute(
+                'query { document(id: "%s") { name age } }' % self.luke.id,
+                context={},
+                executor=AsyncioExecutor(),
+                return_promise=True,
+            )
+            result = asyncio.get_event_loop().run_until_complete(fut)
+
+            self.assertEqual(result.errors, None)
+            self.assertEqual(to_dict(result.data), {'document': {'name': 'Luke Skywalker', 'age': 19}})
+
+        self.assertEqual(self.collection.finds, 1)
+        self.assertEqual(self.cache.stats(), {'size': 1, 'hits': 2, 'misses': 1, 'evictions': 0})
+
+    def test_sliced_reads_go_around_the_cache(self):
+        self.luke.child_field = [model.ChildField(name="Child %d" % i, date=model.Date(1, 2000)) for i in range(10)]
+        self.collection.data[ObjectId(self.luke.id)] = self.luke.to_bson()
+
+        for document_codec in [None, codec.Document]:
+            gql.document_repo.codec = document_codec
+            for _ in range(2):
+                result = self.execute('query { document(id: "%s") { childField(first: 2, offset: 7) { name } } }'
+                                      % self.luke.id)
+
+                self.assertEqual(result.errors, None)
+                self.assertEqual(to_dict(result.data), {'document': {'childField': [
+                    {'name': "Child 7"}, {'name': "Child 8"}
+                ]}})
+
+        self.assertEqual(self.collection.finds, 4)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,119 @@
+import app.gqlschema as gql
+import unittest
+import asyncio
+from unittest.mock import patch
+from graphql.execution.executors.asyncio import AsyncioExecutor
+
+from model import model
+from app.backend import QueryCacheBackend
+from app.cost import CostAnalysis
+import app.backend
+from .api_test import InMemoryDocumentRepo, to_dict
+
+
+class QueryCacheBackendTest(unittest.TestCase):
+    QUERY = """
+    query {
+        documents {
+            edges { node { name } }
+        }
+    }
+    """
+
+    def setUp(self):
+        self.document_repo = InMemoryDocumentRepo()
+        self.document_repo._save(model.Document(name="Anakin Skywalker"))
+        gql.set_repos(_document_repo=self.document_repo)
+        self.backend = QueryCacheBackend(maxsize=2)
+
+    def tearDown(self):
+        gql.set_repos(None)
+
+    def execute(self, query):
+        fut = gql.schema.execute(
+            query,
+            backend=self.backend,
+            context={},
+            executor=AsyncioExecutor(),
+            return_promise=True,
+        )
+        return asyncio.get_event_loop().run_until_complete(fut)
+
+    def test_parses_and_validates_once(self):
+        with patch.object(app.backend, 'validate', wraps=app.backend.validate) as validate:
+            first = self.execute(self.QUERY)
+            second = self.execute(self.QUERY)
+
+        self.assertEqual(first.errors, None)
+        self.assertEqual(to_dict(first.data), to_dict(second.data))
+        self.assertEqual(to_dict(second.data), {'documents': {'edges': [{'node': {'name': 'Anakin Skywalker'}}]}})
+        self.assertEqual(validate.call_count, 1)
+        self.assertEqual(self.backend.stats(), {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0, 'hit_rate': 0.5})
+
+    def test_validation_errors_are_cached(self):
+        for _ in range(2):
+            result = self.execute("query { nope }")
+            self.assertTrue(result.invalid)
+            self.assertEqual(len(result.errors), 1)
+
+        self.assertEqual(self.backend.stats()['hits'], 1)
+
+    def test_syntax_errors_are_not_cached(self):
+        result = self.execute("query {")
+
+        self.assertTrue(result.invalid)
+        self.assertEqual(self.backend.stats()['size'], 0)
+
+
+class CostAnalysisBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.document_repo = InMemoryDocumentRepo()
+        self.document_repo._save(model.Document(name="Anakin Skywalker"))
+        gql.set_repos(_document_repo=self.document_repo)
+        self.cost_analysis = CostAnalysis(max_cost=100, max_depth=5)
+        self.backend = QueryCacheBackend(cost_analysis=self.cost_analysis)
+
+    def tearDown(self):
+        gql.set_repos(None)
+
+    def execute(self, query, variables=None):
+        fut = gql.schema.execute(
+            query,
+            backend=self.backend,
+            context={},
+            variables=variables,
+            executor=AsyncioExecutor(),
+            return_promise=True,
+        )
+        return asyncio.get_event_loop().run_until_complete(fut)
+
+    def test_cost_extension(self):
+        result = self.execute("query { documents(first: 10) { edges { node { name } } } }")
+
+        self.assertEqual(result.errors, None)
+        self.assertEqual(to_dict(result.data), {'documents': {'edges': [{'node': {'name': 'Anakin Skywalker'}}]}})
+        self.assertEqual(
+            result.to_dict()['extensions'],
+            {'cost': {'requestedQueryCost': 21, 'maximumAvailable': 100, 'depth': 4}}
+        )
+
+    def test_too_complex_is_not_executed(self):
+        with patch.object(InMemoryDocumentRepo, 'find') as find:
+            result = self.execute(
+                "query Page($first: Int) { documents(first: $first) { edges { node { name } } } }",
+                variables={'first': 500}
+            )
+
+        find.assert_not_called()
+        self.assertTrue(result.invalid)
+        self.assertEqual(result.to_dict()['errors'], [{
+            'message': 'Query cost 1001 exceeds the maximum of 100',
+            'extensions': {'code': 'QUERY_TOO_COMPLEX', 'cost': 1001, 'maxCost': 100},
+        }])
+        self.assertEqual(self.cost_analysis.stats()['rejected'], 1)
+
+    def test_too_deep(self):
+        result = self.execute("query { documents(first: 1) { edges { node { childField { date { year } } } } } }")
+
+        self.assertTrue(result.invalid)
+        self.assertEqual(result.to_dict()['errors'][0]['extensions']['code'], 'QUERY_TOO_DEEP')
@@ -0,0 +1,79 @@
+import app.gqlschema as gql
+import unittest
+from graphql.language.base import parse
+
+from app.cost import *
+
+
+class CostAnalysisTest(unittest.TestCase):
+    def setUp(self):
+        self.analysis = CostAnalysis()
+
+    def measure(self, query, **kwargs):
+        return self.analysis.measure(gql.schema, parse(query), **kwargs)
+
+    def test_scalars_are_free(self):
+        self.assertEqual(self.measure("query { document(id: \"1\") { ... on Document { name age } } }"), Cost(1, 2))
+
+    def test_page_size_multiplies(self):
+        query = "query { documents(first: 5) { edges { node { name childField { name } } } } }"
+        # documents 1 + 5 * (edges 1 + node 1 + childField 1 * 20 items of 0)
+        self.assertEqual(self.measure(query), Cost(1 + 5 * 3, 5))
+
+    def test_page_size_from_variables_and_default(self):
+        query = "query Page($first: Int) { documents(first: $first) { edges { node { name } } } }"
+
+        self.assertEqual(self.measure(query, variables={'first': 7}).cost, 1 + 7 * 2)
+        self.assertEqual(self.measure(query).cost, 1 + gql.DEFAULT_PAGE_SIZE * 2)
+
+    def test_child_field_estimate(self):
+        query = "query { document(id: \"1\") { ... on Document { childField { date { year } } } } }"
+        # document 1 + childField (1 + 20 * date 1)
+        self.assertEqual(self.measure(query), Cost(1 + 1 + 20, 4))
+
+        query = "query { document(id: \"1\") { ... on Document { childField(first: 3) { date { year } } } } }"
+        self.assertEqual(self.measure(query), Cost(1 + 1 + 3, 4))
+
+    def test_aliases_add_up(self):
+        query = "query { %s }" % " ".join('d%d: document(id: "%d") { ... on Document { name } }' % (i, i) for i in range(50))
+
+        self.assertEqual(self.measure(query).cost, 50)
+
+    def test_fragments(self):
+        query = """
+        query { documents(first: 2) { edges { node { ...Parts ...Parts } } } }
+        fragment Parts on Document { childField { name } }
+        """
+        self.assertEqual(self.measure(query), Cost(1 + 2 * (1 + 1 + 2 * 1), 5))
+
+    def test_mutation_cost(self):
+        query = 'mutation { createDocument(document: {name: "x"}) { ... on Document { id } } }'
+
+        self.assertEqual(self.measure(query).cost, 10)
+
+    def test_list_argument_size(self):
+        query = 'mutation { setDocumentsArchived(ids: ["1", "2", "3"], archived: true) { ... on Document { childField { name } } } }'
+
+        self.assertEqual(self.measure(query).cost, 10 + 3 * 1)
+
+    def test_introspection_is_free(self):
+        self.assertEqual(self.measure("query { __schema { types { fields { type { ofType { name } } } } } }"), Cost(0, 0))
+
+    def test_check_limits(self):
+        analysis = CostAnalysis(max_cost=10, max_depth=3)
+        schema_query = "query { documents(first: 1) { edges { node { name } } } }"
+
+        with self.assertRaises(QueryCostError) as error:
+            analysis.check(gql.schema, parse(schema_query))
+        self.assertEqual(error.exception.extensions, {'code': 'QUERY_TOO_DEEP', 'depth': 4, 'maxDepth': 3})
+
+        analysis.max_depth = 0
+        self.assertEqual(analysis.check(gql.schema, parse(schema_query)), Cost(3, 4))
+
+        with self.assertRaises(QueryCostError) as error:
+            analysis.check(gql.schema, parse("query { documents(first: 20) { edges { node { name } } } }"))
+        self.assertEqual(error.exception.extensions['code'], 'QUERY_TOO_COMPLEX')
+
+        self.assertEqual(analysis.stats()['requests'], 3)
+        self.assertEqual(analysis.stats()['rejected'], 2)
+        self.assertEqual(analysis.stats()['highest_cost'], 41)
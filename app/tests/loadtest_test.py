@@ -0,0 +1,28 @@
+import unittest
+
+from app import loadtest
+
+
+class LoadTestTest(unittest.TestCase):
+    def test_percentile(self):
+        ordered = [float(n) for n in range(1, 101)]
+        self.assertEqual(loadtest.percentile(ordered, 0.50), 50.0)
+        self.assertEqual(loadtest.percentile(ordered, 0.99), 99.0)
+        self.assertEqual(loadtest.percentile([3.0], 0.95), 3.0)
+
+    def test_parse_mix(self):
+        queries = {'a': '', 'b': ''}
+        self.assertEqual(loadtest.parse_mix([], queries), {'a': 1.0, 'b': 1.0})
+        self.assertEqual(loadtest.parse_mix(['b=3', 'a'], queries), {'b': 3.0, 'a': 1.0})
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix(['c=1'], queries)
+
+    def test_sample_queries_have_placeholders_filled(self):
+        for name, query in loadtest.load_queries().items():
+            filled = loadtest.fill_placeholders(query, 'document', 'child')
+            self.assertNotIn('<object id of', filled, name)
+
+    def test_check_response(self):
+        self.assertIsNone(loadtest.check_response(200, b'{"data": {}}'))
+        self.assertEqual(loadtest.check_response(200, b'{"errors": [{"message": "boom"}]}'), 'boom')
+        self.assertTrue(loadtest.check_response(500, b'oops').startswith('HTTP 500'))
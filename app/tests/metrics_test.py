@@ -0,0 +1,150 @@
+import app.gqlschema as gql
+import unittest
+from unittest import mock
+import asyncio
+from graphql.execution.executors.asyncio import AsyncioExecutor
+
+from attr import attrs
+from model import model
+from model.eventemitter import Dispatcher, Event, EventEmitter
+from app.backend import QueryCacheBackend
+from app.metrics import *
+from .api_test import InMemoryDocumentRepo
+
+
+@attrs(slots=True, auto_attribs=True)
+class CommandEvent:
+    command_name: str
+    duration_micros: int
+
+
+class MetricsTest(unittest.TestCase):
+    def test_render(self):
+        registry = Registry(worker='7')
+        counter = registry.register(Counter('events_total', 'Events', ('event',)))
+        counter.inc(('saved',))
+        counter.inc(('saved',), 2)
+        registry.register(Gauge('pool_size', 'Pool size', function=lambda: {(): 10}))
+
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP events_total Events',
+            '# TYPE events_total counter',
+            'events_total{event="saved",worker="7"} 3',
+            '# HELP pool_size Pool size',
+            '# TYPE pool_size gauge',
+            'pool_size{worker="7"} 10',
+        ]) + '\n')
+
+    def test_histogram_buckets(self):
+        histogram = Histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, ('/"graphql"',))
+
+        self.assertEqual(list(histogram.samples('worker="1"')), [
+            'latency_seconds_bucket{route="/\\"graphql\\"",worker="1",le="0.1"} 2',
+            'latency_seconds_bucket{route="/\\"graphql\\"",worker="1",le="1"} 3',
+            'latency_seconds_bucket{route="/\\"graphql\\"",worker="1",le="+Inf"} 4',
+            'latency_seconds_sum{route="/\\"graphql\\"",worker="1"} 2.65',
+            'latency_seconds_count{route="/\\"graphql\\"",worker="1"} 4',
+        ])
+
+    def test_histogram_snapshot_is_a_copy(self):
+        histogram = Histogram('latency_seconds', 'Latency', buckets=(0.1,))
+        histogram.observe(0.05)
+        snapshot = histogram.snapshot()
+
+        # pymongo's listener threads keep observing while /metrics renders the snapshot
+        histogram.observe(0.5)
+
+        self.assertEqual(snapshot, [((), [1, 0], 0.05)])
+        self.assertEqual(histogram.snapshot(), [((), [1, 1], 0.55)])
+
+    def test_command_timer(self):
+        metrics = ServiceMetrics()
+        timer = metrics.mongodb_listeners()[0]
+        timer.succeeded(CommandEvent('find', 1500))
+        timer.failed(CommandEvent('insert', 200))
+
+        self.assertEqual(metrics.mongodb_commands.counts[('find',)][metrics.mongodb_commands.buckets.index(0.0025)], 1)
+        self.assertEqual(metrics.mongodb_command_failures.values, {('insert',): 1})
+        self.assertIn('mongodb_command_failures_total{command="insert"', metrics.render())
+
+    def test_count_events(self):
+        metrics = ServiceMetrics()
+        emitter = EventEmitter()
+        metrics.count_events(emitter)
+
+        emitter.emit('DocumentSaved', model.Document(name="Leia"))
+        emitter.emit('DocumentSaved', model.Document(name="Luke"))
+        emitter.emit('DocumentCreated', model.Document(name="Han"))
+
+        self.assertEqual(metrics.repo_events.values, {('DocumentSaved',): 2, ('DocumentCreated',): 1})
+
+    def test_watch_dispatcher(self):
+        metrics = ServiceMetrics()
+        dispatcher = Dispatcher(maxsize=1)
+        dispatcher.on('DocumentSaved', lambda document: None)
+        metrics.watch_dispatcher(dispatcher)
+
+        async def run_test():
+            dispatcher.put_nowait(Event('DocumentSaved', (model.Document(name="Leia"),)))
+            dispatcher.put_nowait(Event('DocumentSaved', (model.Document(name="Luke"),)))
+            self.assertIn('repo_event_queue_depth{worker=', metrics.render())
+            await dispatcher.close()
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+        rendered = metrics.render()
+        self.assertIn('repo_event_dispatch_total{outcome="delivered",worker="%s"} 1' % metrics.registry.worker, rendered)
+        self.assertIn('repo_event_dispatch_total{outcome="dropped",worker="%s"} 1' % metrics.registry.worker, rendered)
+
+
+class ResolverTimerTest(unittest.TestCase):
+    QUERY = """
+    query Names {
+        documents {
+            edges { node { name childField { name } } }
+        }
+    }
+    """
+
+    def setUp(self):
+        self.document_repo = InMemoryDocumentRepo()
+        self.document_repo._save(model.Document(name="Anakin Skywalker"))
+        gql.set_repos(_document_repo=self.document_repo)
+        self.metrics = ServiceMetrics()
+
+    def tearDown(self):
+        gql.set_repos(None)
+
+    def execute(self, query):
+        fut = gql.schema.execute(
+            query,
+            backend=QueryCacheBackend(operation_timer=self.metrics.graphql_operations),
+            context={},
+            executor=AsyncioExecutor(),
+            middleware=[self.metrics.resolver_middleware()],
+            return_promise=True,
+        )
+        return asyncio.get_event_loop().run_until_complete(fut)
+
+    def test_resolvers_and_operations_are_timed(self):
+        result = self.execute(self.QUERY)
+        self.assertIsNone(result.errors)
+
+        timed = set(self.metrics.graphql_resolvers.counts)
+        self.assertIn(('Query', 'documents'), timed)
+        self.assertIn(('Document', 'childField'), timed)
+        # scalar fields are not worth timing
+        self.assertNotIn(('Document', 'name'), timed)
+
+        self.assertEqual(list(self.metrics.graphql_operations.counts), [('query', 'Names')])
+
+    def test_operation_names_are_bounded(self):
+        with mock.patch('app.backend.MAX_OPERATION_LABELS', 2):
+            for name in ('First', 'Second', 'Third', 'Fourth', 'First'):
+                self.assertIsNone(self.execute('query %s { documents { edges { node { name } } } }' % name).errors)
+
+        self.assertEqual(self.metrics.graphql_operations.counts.keys(), {
+            ('query', 'First'), ('query', 'Second'), ('query', 'other')
+        })
+        self.assertEqual(sum(self.metrics.graphql_operations.counts[('query', 'other')]), 2)
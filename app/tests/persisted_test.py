@@ -0,0 +1,176 @@
+import app.gqlschema as gql
+import unittest
+import asyncio
+import json
+import os
+import tempfile
+from urllib.parse import quote
+from sanic.request import Request
+from multidict import CIMultiDict
+from graphql import get_default_backend, set_default_backend
+from graphql.execution.executors.asyncio import AsyncioExecutor
+
+from model import model
+from app.backend import QueryCacheBackend
+from app.cost import CostAnalysis
+from app.persisted import *
+from .api_test import InMemoryDocumentRepo
+
+
+QUERY = "query { documents { edges { node { name } } } }"
+
+
+def extensions(sha256_hash, version=1):
+    return {'persistedQuery': {'version': version, 'sha256Hash': sha256_hash}}
+
+
+def register(store, query, sha256_hash=None):
+    asyncio.get_event_loop().run_until_complete(store.register(sha256_hash or query_hash(query), query))
+
+
+class PersistedQueryStoreTest(unittest.TestCase):
+    def test_register(self):
+        store = PersistedQueryStore()
+        register(store, QUERY)
+
+        self.assertEqual(store.get(query_hash(QUERY)), QUERY)
+        self.assertIn(query_hash(QUERY), store)
+        self.assertEqual(store.get(query_hash("query { x }")), None)
+
+    def test_register_hash_mismatch(self):
+        store = PersistedQueryStore()
+        with self.assertRaises(ValueError):
+            register(store, QUERY, query_hash("query { x }"))
+        self.assertNotIn(query_hash("query { x }"), store)
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'persisted.jsonl')
+
+            store = PersistedQueryStore.open(path=path)
+            register(store, QUERY)
+            register(store, QUERY)
+
+            with open(path) as lines:
+                self.assertEqual(len(lines.readlines()), 1)
+
+            reopened = PersistedQueryStore.open(path=path)
+            self.assertEqual(reopened.get(query_hash(QUERY)), QUERY)
+
+    def test_file_is_compacted(self):
+        queries = ['query { q%d: documents { edges { cursor } } }' % i for i in range(5)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'persisted.jsonl')
+
+            store = PersistedQueryStore.open(maxsize=2, path=path)
+            for query in queries[:3]:
+                register(store, query)
+            # the fourth line would make twice maxsize, the file is rewritten with the two queries in the LRU
+            register(store, queries[3])
+            with open(path) as lines:
+                self.assertEqual([json.loads(line)['query'] for line in lines], queries[2:4])
+
+            register(store, queries[4])
+            with open(path) as lines:
+                self.assertEqual(len(lines.readlines()), 3)
+
+            # reopening keeps the most recent queries and drops the rest from the file
+            reopened = PersistedQueryStore.open(maxsize=2, path=path)
+            self.assertEqual([reopened.get(query_hash(query)) for query in queries[3:]], queries[3:])
+            with open(path) as lines:
+                self.assertEqual([json.loads(line)['query'] for line in lines], queries[3:])
+
+
+class PersistedQueryViewTest(unittest.TestCase):
+    def setUp(self):
+        self.document_repo = InMemoryDocumentRepo()
+        self.document_repo._save(model.Document(name="Anakin Skywalker"))
+        gql.set_repos(_document_repo=self.document_repo)
+
+        self.loop = asyncio.new_event_loop()
+        self.store = PersistedQueryStore()
+        self.view = PersistedQueryView.as_view(
+            schema=gql.schema,
+            enable_async=True,
+            executor=AsyncioExecutor(loop=self.loop),
+            persisted_queries=self.store,
+            max_age_cached=30
+        )
+
+    def tearDown(self):
+        gql.set_repos(None)
+        self.loop.close()
+
+    def request(self, method, body=None, args=None):
+        url = '/graphql'
+        if args:
+            url += '?' + '&'.join('%s=%s' % (k, quote(json.dumps(v))) for k, v in args.items())
+        headers = CIMultiDict({'content-type': 'application/json'}) if body is not None else CIMultiDict()
+        request = Request(url.encode('utf8'), headers, '1.1', method, None)
+        if body is not None:
+            request.body = json.dumps(body).encode('utf8')
+
+        response = self.loop.run_until_complete(self.view(request))
+        return response, json.loads(response.body)
+
+    def test_query_without_extension(self):
+        response, result = self.request('POST', {'query': QUERY})
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(result['data']['documents']['edges'], [{'node': {'name': 'Anakin Skywalker'}}])
+        self.assertEqual(self.store.stats()['size'], 0)
+
+    def test_hash_only_miss_then_register(self):
+        sha256_hash = query_hash(QUERY)
+
+        response, result = self.request('POST', {'extensions': extensions(sha256_hash)})
+        self.assertEqual(result, {'errors': [{'message': 'PersistedQueryNotFound'}]})
+
+        response, result = self.request('POST', {'query': QUERY, 'extensions': extensions(sha256_hash)})
+        self.assertEqual(result['data']['documents']['edges'], [{'node': {'name': 'Anakin Skywalker'}}])
+
+        response, result = self.request('POST', {'extensions': extensions(sha256_hash)})
+        self.assertEqual(result['data']['documents']['edges'], [{'node': {'name': 'Anakin Skywalker'}}])
+        self.assertNotIn('Cache-Control', response.headers)
+
+    def test_invalid_query_is_not_registered(self):
+        for query in ('query { nope }', 'query {'):
+            response, result = self.request('POST', {'query': query, 'extensions': extensions(query_hash(query))})
+
+            self.assertEqual(response.status, 400)
+            self.assertNotIn(query_hash(query), self.store)
+
+    def test_query_over_budget_is_not_registered(self):
+        backend = get_default_backend()
+        set_default_backend(QueryCacheBackend(cost_analysis=CostAnalysis(max_cost=1)))
+        try:
+            response, result = self.request('POST', {'query': QUERY, 'extensions': extensions(query_hash(QUERY))})
+        finally:
+            set_default_backend(backend)
+
+        self.assertEqual(response.status, 400)
+        self.assertNotIn(query_hash(QUERY), self.store)
+
+    def test_hash_mismatch(self):
+        response, result = self.request('POST', {'query': QUERY, 'extensions': extensions(query_hash("query { x }"))})
+
+        self.assertEqual(response.status, 400)
+        self.assertEqual(result, {'errors': [{'message': 'provided sha does not match query'}]})
+
+    def test_unsupported_version(self):
+        response, result = self.request('POST', {'extensions': extensions(query_hash(QUERY), version=2)})
+
+        self.assertEqual(response.status, 400)
+
+    def test_get_is_cacheable(self):
+        sha256_hash = query_hash(QUERY)
+
+        response, result = self.request('GET', args={'extensions': extensions(sha256_hash)})
+        self.assertEqual(result, {'errors': [{'message': 'PersistedQueryNotFound'}]})
+        self.assertNotIn('Cache-Control', response.headers)
+
+        register(self.store, QUERY)
+
+        response, result = self.request('GET', args={'extensions': extensions(sha256_hash)})
+        self.assertEqual(result['data']['documents']['edges'], [{'node': {'name': 'Anakin Skywalker'}}])
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=30')
@@ -0,0 +1,199 @@
+import unittest
+import asyncio
+import json
+import pymongo.errors
+
+from model import model, repo
+from model.eventemitter import Event
+from model.memory import MemoryCollection
+from app.subscriptions import Connection, SubscriptionManager
+
+
+class WebSocket:
+    def __init__(self, received=()):
+        self.received = asyncio.Queue()
+        for message in received:
+            self.received.put_nowait(json.dumps(message))
+        self.sent = []
+
+    async def recv(self):
+        return await self.received.get()
+
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+
+
+class ChangeStream:
+    def __init__(self, changes):
+        self.changes = list(changes)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.changes:
+            # waits for changes which never come
+            await asyncio.Event().wait()
+        change = self.changes.pop(0)
+        if isinstance(change, Exception):
+            raise change
+        return change
+
+
+class WatchedCollection:
+    """
+    Hands out one ChangeStream per watch, from streams, and records where each one resumed after.
+    """
+    def __init__(self, streams):
+        self.streams = list(streams)
+        self.resumed_after = []
+
+    def watch(self, full_document=None, resume_after=None):
+        self.resumed_after.append(resume_after)
+        return ChangeStream(self.streams.pop(0))
+
+
+def change(token, operation, document):
+    return {'_id': {'_data': token}, 'operationType': operation, 'fullDocument': document.to_bson()}
+
+
+DOCUMENT_CHANGED = 'subscription($id: ID!) { documentChanged(id: $id) { name archived } }'
+DOCUMENTS_CHANGED = 'subscription { documentsChanged(filter: {ageMin: 18}) { name } }'
+
+
+def data(connection):
+    return [json.loads(message) for message in connection.pending.values()]
+
+
+class SubscriptionsTest(unittest.TestCase):
+    def setUp(self):
+        self.luke = model.Document(name='Luke', age=19)
+        self.leia = model.Document(name='Leia', age=12)
+        self.manager = SubscriptionManager()
+
+    def run_async(self, coroutine):
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def connect(self, maxsize=100):
+        return self.run_async(self.make_connection(maxsize))
+
+    async def make_connection(self, maxsize):
+        return Connection(WebSocket(), self.manager, maxsize=maxsize)
+
+    def test_one_execution_per_topic(self):
+        first, second = self.connect(), self.connect()
+        self.assertIsNone(first.start('1', {'query': DOCUMENT_CHANGED, 'variables': {'id': self.luke.id}}))
+        self.assertIsNone(second.start('a', {'query': DOCUMENT_CHANGED, 'variables': {'id': self.luke.id}}))
+        self.assertIsNone(second.start('b', {'query': DOCUMENTS_CHANGED}))
+
+        self.run_async(self.manager.publish([Event('DocumentSaved', (self.luke,)), Event('DocumentSaved', (self.leia,))]))
+
+        self.assertEqual(self.manager.stats(), {'topics': 2, 'subscribers': 3, 'executions': 2, 'messages': 3, 'feed_failures': 0})
+        self.assertEqual(data(first), [
+            {'type': 'data', 'id': '1', 'payload': {'data': {'documentChanged': {'name': 'Luke', 'archived': False}}}}
+        ])
+        self.assertEqual(data(second), [
+            {'type': 'data', 'id': 'a', 'payload': {'data': {'documentChanged': {'name': 'Luke', 'archived': False}}}},
+            {'type': 'data', 'id': 'b', 'payload': {'data': {'documentsChanged': {'name': 'Luke'}}}},
+        ])
+
+        first.stop('1')
+        second.stop('a')
+        second.stop('b')
+        self.assertEqual((self.manager.topics, self.manager.by_document), ({}, {}))
+
+    def test_invalid_operations(self):
+        connection = self.connect()
+        for query in ('query { documents { edges { node { id } } } }', 'subscription { nope }', 'subscription {'):
+            error = json.loads(connection.start('1', {'query': query}))
+            self.assertEqual((error['type'], error['id']), ('error', '1'))
+            self.assertTrue(error['payload'][0]['message'])
+        self.assertEqual(connection.operations, {})
+
+    def test_slow_consumers_get_the_latest_changes(self):
+        connection = self.connect(maxsize=2)
+        connection.start('1', {'query': DOCUMENTS_CHANGED})
+        han = model.Document(name='Han', age=30)
+
+        async def run_test():
+            await self.manager.publish([Event('DocumentSaved', (self.luke,))])
+            await self.manager.publish([Event('DocumentSaved', (model.Document('Luke Skywalker', 19, id=self.luke.id),))])
+            await self.manager.publish([Event('DocumentCreated', (han,))])
+            await self.manager.publish([Event('DocumentSaved', (model.Document('Ben', 60),))])
+
+        self.run_async(run_test())
+
+        self.assertEqual([message['payload']['data']['documentsChanged']['name'] for message in data(connection)],
+                         ['Han', 'Ben'])
+        self.assertEqual((connection.conflated, connection.dropped), (1, 1))
+
+    def test_repo_events(self):
+        document_repo = repo.DocumentRepo(collection=MemoryCollection.of([self.luke]))
+        self.manager.attach(document_repo)
+        connection = self.connect()
+        connection.start('1', {'query': DOCUMENT_CHANGED, 'variables': {'id': self.luke.id}})
+
+        async def run_test():
+            await document_repo.set_archived(self.luke.id, True)
+            await document_repo.dispatcher.close()
+
+        self.run_async(run_test())
+        self.assertEqual(len(data(connection)), 1)
+
+    def test_protocol(self):
+        async def run_test():
+            websocket = WebSocket([
+                {'type': 'connection_init'},
+                {'type': 'start', 'id': '1', 'payload': {'query': DOCUMENTS_CHANGED}},
+            ])
+            connection = Connection(websocket, self.manager)
+            serving = asyncio.ensure_future(connection.serve())
+
+            await asyncio.sleep(0.01)
+            await self.manager.publish([Event('DocumentCreated', (self.luke,))])
+            await asyncio.sleep(0.01)
+            websocket.received.put_nowait(json.dumps({'type': 'stop', 'id': '1'}))
+            websocket.received.put_nowait(json.dumps({'type': 'connection_terminate'}))
+            await serving
+            return websocket.sent
+
+        sent = self.run_async(run_test())
+        self.assertEqual([message['type'] for message in sent], ['connection_ack', 'data', 'complete'])
+        self.assertEqual(sent[1]['payload'], {'data': {'documentsChanged': {'name': 'Luke'}}})
+        self.assertEqual(self.manager.topics, {})
+
+    def test_change_stream_resumes_after_errors(self):
+        connection = self.connect()
+        connection.start('1', {'query': DOCUMENTS_CHANGED})
+        han = model.Document(name='Han', age=30)
+        collection = WatchedCollection([
+            [change('1', 'insert', self.luke), pymongo.errors.AutoReconnect('connection lost')],
+            [pymongo.errors.OperationFailure('not primary')],
+            [change('2', 'update', han)],
+        ])
+        self.manager.backoff = 0.001
+
+        async def run_test():
+            follow = asyncio.ensure_future(self.manager.follow(collection, repo.DocumentRepo()._create_from_document))
+            for _ in range(100):
+                if len(connection.pending) == 2:
+                    break
+                await asyncio.sleep(0.01)
+            follow.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await follow
+
+        self.run_async(run_test())
+
+        self.assertEqual(
+            [message['payload'] for message in data(connection)],
+            [{'data': {'documentsChanged': {'name': 'Luke'}}}, {'data': {'documentsChanged': {'name': 'Han'}}}]
+        )
+        self.assertEqual(collection.resumed_after, [None, {'_data': '1'}, {'_data': '1'}])
+        self.assertEqual(self.manager.stats()['feed_failures'], 2)
@@ -0,0 +1,77 @@
+import app.gqlschema as gql
+import unittest
+import asyncio
+from graphql.execution.executors.asyncio import AsyncioExecutor
+
+from model import model, tracing
+from app.backend import QueryCacheBackend
+from .api_test import InMemoryDocumentRepo, to_dict
+
+
+class TracedDocumentRepo(InMemoryDocumentRepo):
+    find = tracing.traced(InMemoryDocumentRepo.find)
+
+
+class TracingTest(unittest.TestCase):
+    QUERY = """
+    query {
+        documents(first: 2) {
+            edges { node { name childField { name } } }
+        }
+    }
+    """
+
+    def setUp(self):
+        self.document_repo = TracedDocumentRepo()
+        self.document_repo._save(model.Document(name="Anakin Skywalker"))
+        gql.set_repos(_document_repo=self.document_repo)
+        self.backend = QueryCacheBackend()
+
+    def tearDown(self):
+        gql.set_repos(None)
+
+    def execute(self, query, trace=None):
+        token = tracing.start(trace) if trace is not None else None
+        try:
+            fut = gql.schema.execute(
+                query,
+                backend=self.backend,
+                context={},
+                executor=AsyncioExecutor(),
+                return_promise=True,
+            )
+            return asyncio.get_event_loop().run_until_complete(fut)
+        finally:
+            if token is not None:
+                tracing.stop(token)
+
+    def test_untraced(self):
+        result = self.execute(self.QUERY)
+
+        self.assertIsNone(result.errors)
+        self.assertNotIn('tracing', result.extensions or {})
+
+    def test_traced(self):
+        result = self.execute(self.QUERY, tracing.Trace())
+        self.assertIsNone(result.errors)
+
+        trace = to_dict(result.to_dict())['extensions']['tracing']
+        self.assertEqual(trace['version'], 1)
+        self.assertGreater(trace['duration'], 0)
+        self.assertIsNotNone(trace['parsing'])
+        self.assertIsNotNone(trace['validation'])
+
+        resolvers = {tuple(resolver['path']): resolver for resolver in trace['execution']['resolvers']}
+        self.assertEqual(resolvers[('documents',)]['parentType'], 'Query')
+        self.assertEqual(resolvers[('documents', 'edges', 0, 'node', 'name')]['returnType'], 'String')
+
+        # the repo call is nested under the resolver which made it
+        self.assertEqual(
+            [span['name'] for span in resolvers[('documents',)]['spans']],
+            ['InMemoryDocumentRepo.find']
+        )
+
+        # parsing and validation are skipped when the query cache has the document
+        trace = to_dict(self.execute(self.QUERY, tracing.Trace()).to_dict())['extensions']['tracing']
+        self.assertIsNone(trace['parsing'])
+        self.assertTrue(trace['execution']['resolvers'])
@@ -0,0 +1,86 @@
+"""
+Opt-in Apollo tracing for the /graphql route, see model/tracing.py.
+
+A request with the X-GraphQL-Tracing: 1 header, on a service started with GRAPHQL_TRACING, gets the timing of
+parsing, validation and every resolver in extensions.tracing, with the repo calls and decoding they made nested
+under the resolvers. Requests without the header run without any of it.
+"""
+from inspect import isawaitable
+from graphql.execution.middleware import MiddlewareManager
+from promise import Promise, is_thenable
+
+from model.tracing import ResolverSpan, Trace, current_span
+
+from typing import *
+
+
+TRACING_HEADER = 'X-GraphQL-Tracing'
+
+
+def tracing_requested(request) -> bool:
+    return request.headers.get(TRACING_HEADER, '').lower() in ('1', 'true', 'yes')
+
+
+class ResolverTracer:
+    """
+    graphql-core middleware adding a ResolverSpan to trace for every field resolved.
+    """
+
+    def __init__(self, trace: Trace):
+        self.trace = trace
+
+    def resolve(self, next, root, info, **args):
+        span = ResolverSpan(
+            info.field_name,
+            self.trace.now(),
+            path=list(info.path or []),
+            parent_type=info.parent_type.name,
+            return_type=str(info.return_type)
+        )
+        self.trace.resolvers.append(span)
+
+        # the task of an async resolver is created in next() and copies the context, the span becomes its parent
+        parent = current_span.get()
+        current_span.set(span)
+        try:
+            result = next(root, info, **args)
+        finally:
+            current_span.set(parent)
+
+        if is_thenable(result):
+            def rejected(error):
+                self.finish(None, span)
+                raise error
+            return Promise.resolve(result).then(lambda value: self.finish(value, span), rejected)
+        if isawaitable(result):
+            return self.finish_awaitable(result, span)
+        return self.finish(result, span)
+
+    def finish(self, value, span):
+        span.duration = self.trace.now() - span.start
+        return value
+
+    async def finish_awaitable(self, result, span):
+        # the executor runs this in a task of its own, the span stays the parent for the rest of the resolver
+        current_span.set(span)
+        try:
+            return await result
+        finally:
+            self.finish(None, span)
+
+
+def traced_middleware(middleware, trace: Trace) -> List[Any]:
+    """
+    The middleware to execute with when tracing, the tracer innermost so the other middleware is not counted.
+    """
+    if isinstance(middleware, MiddlewareManager):
+        middleware = middleware.middlewares
+    return [ResolverTracer(trace)] + list(middleware or [])
+
+
+__all__ = [
+    'TRACING_HEADER',
+    'tracing_requested',
+    'ResolverTracer',
+    'traced_middleware'
+]
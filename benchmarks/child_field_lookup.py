@@ -0,0 +1,90 @@
+"""
+Compares child field lookups by id and by date on model.Document against the linear scans they replaced.
+
+Each size builds one document with that many child fields and times lookups of random ids and dates, along with
+an edit and a removal followed by an add, so the cost of keeping the indexes up to date is included. Removals stay
+linear in the number of child fields after the removed one, like the list deletion itself.
+
+    python3 -m benchmarks.child_field_lookup --sizes 10 100 1000 10000 --lookups 2000
+"""
+from model.model import Document, ChildField, Date
+
+from typing import *
+from argparse import ArgumentParser
+import random
+import time
+
+
+def linear_index(document, id):
+    """
+    The previous Document.child_field_index: a fresh list of every child id per call.
+    """
+    child_field_ids = [sub.id for sub in document.child_field]
+    try:
+        return child_field_ids.index(id)
+    except ValueError:
+        return None
+
+
+def linear_for_date(document, date):
+    """
+    The previous Document.find_child_field_for_date.
+    """
+    for sub in document.child_field:
+        if sub.date == date:
+            return sub
+
+
+def make_document(size: int) -> Document:
+    document = Document(name="Document %d" % size)
+    for i in range(size):
+        document.add_child_field(ChildField(Date(i % 12 + 1, 2000 + i // 12), "Child %d" % i))
+    return document
+
+
+def per_call_us(fn, arguments) -> float:
+    start = time.perf_counter()
+    for argument in arguments:
+        fn(argument)
+    return (time.perf_counter() - start) / len(arguments) * 1e6
+
+
+def measure(size: int, lookups: int) -> Dict[str, float]:
+    document = make_document(size)
+    rng = random.Random(size)
+    ids = [rng.choice(document.child_field).id for _ in range(lookups)]
+    dates = [rng.choice(document.child_field).date for _ in range(lookups)]
+    # the indexes are built once per document, on the first lookup
+    document.find_child_field_for_date(dates[0])
+
+    def edit(id):
+        document.update_child_field(ChildField(document.find_child_field(id).date, "Edited", id=id))
+
+    def remove_and_add(id):
+        child_field = document.find_child_field(id)
+        document.remove_child_field(id)
+        document.add_child_field(child_field)
+
+    return {
+        'linear_index_us': per_call_us(lambda id: linear_index(document, id), ids),
+        'index_us': per_call_us(document.child_field_index, ids),
+        'linear_date_us': per_call_us(lambda date: linear_for_date(document, date), dates),
+        'date_us': per_call_us(document.find_child_field_for_date, dates),
+        'edit_us': per_call_us(edit, ids),
+        'remove_add_us': per_call_us(remove_and_add, ids),
+    }
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help="child fields")
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    for size in args.sizes:
+        result = measure(size, args.lookups)
+        print(f'{size:>7}', '  '.join(f'{k}={v:.3f}' for k, v in result.items()))
+
+
+if __name__ == "__main__":
+    main()
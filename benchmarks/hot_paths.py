@@ -0,0 +1,169 @@
+"""
+Times the decode, convert and execute hot paths at several document counts and child field sizes.
+
+Decoding is timed per document from the raw mongodb form: munge_object, schema.Document.load after it, and the
+compiled codec.Document.load, along with Document.to_bson for writes and gqlschema.Document.from_model. Every
+operation in sample_graphql_queries/ is executed through gql.schema against a DocumentRepo over an in-memory
+stand-in collection, so decoding and resolving are the real ones and only mongodb is left out. Parsing and
+validation are not counted, the query cache backend holds every operation.
+
+Each result is the best of --repeat runs of as many calls as fit in --min-time seconds. --json writes the results
+for later runs to --compare against, comparing exits with status 1 when a case got slower than --threshold times.
+
+    python3 -m benchmarks.hot_paths --documents 10 1000 --children 5 1000 --json before.json
+    python3 -m benchmarks.hot_paths --documents 10 1000 --children 5 1000 --compare before.json
+"""
+from model import schema, codec
+from model.memory import MemoryCollection, random_document, random_documents
+from model.repo import DocumentRepo, munge_object
+from app import gqlschema as gql
+from app.backend import QueryCacheBackend
+from app.loadtest import load_queries, fill_placeholders
+from graphql.execution.executors.asyncio import AsyncioExecutor
+
+from typing import *
+from argparse import ArgumentParser
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+
+
+def time_per_call(fn: Callable[[], Any], min_time: float, repeat: int) -> float:
+    """
+    Seconds per call of fn, the best of repeat runs which each take at least min_time.
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / elapsed) + 1) if elapsed > 0 else number * 10
+
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def decode_cases(children: int) -> Iterator[Tuple[str, Callable[[], Any]]]:
+    document = random_document(random.Random(children), children)
+    raw = document.to_bson()
+    munged = munge_object(raw)
+
+    yield 'munge_object', lambda: munge_object(raw)
+    yield 'schema.Document.load', lambda: schema.Document.load(munged)
+    yield 'codec.Document.load', lambda: codec.Document.load(raw)
+    yield 'Document.to_bson', document.to_bson
+    yield 'gqlschema.Document.from_model', lambda: gql.Document.from_model(document)
+
+
+def execute_cases(documents: int, children: int, loop) -> Iterator[Tuple[str, Callable[[], Any]]]:
+    models = random_documents(documents, children, seed=documents * 100003 + children)
+    collection = MemoryCollection.of(models)
+    gql.set_repos(_document_repo=DocumentRepo(collection=collection))
+
+    backend = QueryCacheBackend()
+    executor = AsyncioExecutor(loop=loop)
+
+    for name, query in load_queries().items():
+        child_fields = models[0].child_field
+        query = fill_placeholders(query, models[0].id, child_fields[0].id if child_fields else None)
+
+        def execute(query=query):
+            result = loop.run_until_complete(gql.schema.execute(
+                query,
+                backend=backend,
+                context={},
+                executor=executor,
+                return_promise=True
+            ))
+            assert not result.errors, result.errors
+
+        yield 'execute ' + name, execute
+
+
+def run(documents: List[int], children: List[int], min_time: float, repeat: int) -> List[Dict[str, Any]]:
+    results = []
+
+    def measure(name, fn, **sizes):
+        result = dict(name=name, **sizes, us_per_call=time_per_call(fn, min_time, repeat) * 1e6)
+        print(f'{result["name"]:<50}', '  '.join(f'{k}={v}' for k, v in sizes.items()),
+              f'{result["us_per_call"]:.1f}us', file=sys.stderr)
+        results.append(result)
+
+    for size in children:
+        for name, fn in decode_cases(size):
+            measure(name, fn, children=size)
+
+    loop = asyncio.get_event_loop()
+    for count in documents:
+        for size in children:
+            for name, fn in execute_cases(count, size, loop):
+                measure(name, fn, documents=count, children=size)
+    gql.set_repos(None)
+
+    return results
+
+
+def key(result: Dict[str, Any]) -> Tuple:
+    return (result['name'], result.get('documents'), result.get('children'))
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], threshold: float) -> List[Dict[str, Any]]:
+    """
+    Print the ratio of every result to the baseline and return the ones slower than threshold times.
+    """
+    before = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = before.get(key(result))
+        if previous is None:
+            continue
+        ratio = result['us_per_call'] / previous['us_per_call']
+        flag = '  REGRESSION' if ratio > threshold else ''
+        print(f'{result["name"]:<50} {key(result)[1:]} {previous["us_per_call"]:.1f}us -> '
+              f'{result["us_per_call"]:.1f}us  x{ratio:.2f}{flag}')
+        if ratio > threshold:
+            regressions.append(result)
+    return regressions
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--documents', type=int, nargs='+', default=[10, 1000], help="documents in the collection")
+    parser.add_argument('--children', type=int, nargs='+', default=[5, 1000], help="child fields per document")
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds per timing run")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=1.2, help="slowdown which counts as a regression")
+    args = parser.parse_args(argv)
+
+    results = run(args.documents, args.children, args.min_time, args.repeat)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf8') as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Compares the latency of DocumentRepo.create with and without reading the document back after the insert.
+
+The collection is an in-memory stand-in which sleeps for a fixed time on every call to simulate the round trip
+to mongodb, so the numbers show the cost of the extra round trip rather than the speed of a real server.
+
+    python3 -m benchmarks.repo_create --latency-ms 1 --iterations 500
+"""
+from model.repo import DocumentRepo
+
+from typing import *
+from attr import attrs, Factory
+from argparse import ArgumentParser
+from collections import namedtuple
+import asyncio
+import statistics
+import time
+
+
+InsertOneResult = namedtuple('InsertOneResult', 'inserted_id')
+
+
+@attrs(slots=True, auto_attribs=True)
+class LatencyCollection:
+    """
+    Just enough of a motor collection for DocumentRepo.create and find_by_id, with simulated round trip latency.
+    """
+    latency: float
+    data: Dict[Any, Dict] = Factory(dict)
+    round_trips: int = 0
+
+    async def round_trip(self):
+        self.round_trips += 1
+        await asyncio.sleep(self.latency)
+
+    async def insert_one(self, document):
+        await self.round_trip()
+        self.data[document['_id']] = document
+        return InsertOneResult(document['_id'])
+
+    async def find_one(self, criteria, projection=None):
+        await self.round_trip()
+        return self.data.get(criteria['_id'])
+
+
+async def create(repo, i):
+    return await repo.create(name="Document %d" % i, age=i)
+
+
+async def create_and_read_back(repo, i):
+    """
+    The previous behaviour of DocumentRepo.create: insert, then find_by_id on the inserted id.
+    """
+    document = await repo.create(name="Document %d" % i, age=i)
+    return await repo.find_by_id(document.id)
+
+
+async def measure(fn, latency, iterations):
+    collection = LatencyCollection(latency)
+    repo = DocumentRepo(collection=collection)
+
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        await fn(repo, i)
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'round_trips_per_call': collection.round_trips / iterations,
+        'mean_ms': statistics.mean(timings) * 1000,
+        'p50_ms': statistics.median(timings) * 1000,
+        'max_ms': max(timings) * 1000,
+    }
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency-ms', type=float, default=1.0, help="simulated round trip latency")
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    loop = asyncio.get_event_loop()
+    for fn in [create_and_read_back, create]:
+        result = loop.run_until_complete(measure(fn, args.latency_ms / 1000, args.iterations))
+        print(f'{fn.__name__:<22}', '  '.join(f'{k}={v:.3f}' for k, v in result.items()))
+
+
+if __name__ == "__main__":
+    main()
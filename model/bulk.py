@@ -0,0 +1,383 @@
+"""
+Streaming NDJSON import and export of the document collection.
+
+    python3 -m model.bulk export documents.ndjson.gz
+    python3 -m model.bulk import documents.ndjson.gz --batch-size 1000 --concurrency 4
+
+Export writes one document per line in _id order straight from an async cursor. Import validates every line with
+schema.DocumentSchema and upserts them by _id in unordered bulk_write batches, so running it twice is harmless.
+Files ending in .gz are gzipped, - reads stdin or writes stdout.
+
+Both directions can pick up where they stopped. --after skips everything up to and including an _id. --resume
+continues an export after the last complete line of the file, and an import after the input lines a previous run
+got written, which it keeps in a checkpoint file next to the input.
+"""
+from attr import attrs, Factory
+from argparse import ArgumentParser
+from collections import OrderedDict
+from contextlib import contextmanager
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReplaceOne
+import pymongo
+import pymongo.errors
+import asyncio
+import gzip
+import itertools
+import json
+import os
+import sys
+import time
+
+try:
+    from . import schema
+except ImportError:
+    import schema
+
+try:
+    from .repo import munge_object
+except ImportError:
+    from repo import munge_object
+
+from typing import *
+from typing import IO
+
+
+@attrs(slots=True, auto_attribs=True)
+class Progress:
+    """
+    Counts documents and prints the throughput to stderr at most every interval seconds.
+    """
+    label: str
+    interval: float = 1.0
+    out: Any = Factory(lambda: sys.stderr)
+    clock: Callable[[], float] = time.monotonic
+    count: int = 0
+    last_id: Optional[str] = None
+    started: Optional[float] = None
+    reported: float = 0.0
+
+    def advance(self, count: int, last_id: Optional[str]=None) -> None:
+        now = self.clock()
+        if self.started is None:
+            self.started = self.reported = now
+
+        self.count += count
+        if last_id is not None:
+            self.last_id = last_id
+
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report()
+
+    def report(self) -> None:
+        elapsed = self.clock() - self.started if self.started is not None else 0.0
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        print(f'{self.label}: {self.count} documents, {rate:.0f} documents/s, last _id {self.last_id}', file=self.out)
+
+
+@attrs(slots=True, auto_attribs=True)
+class Checkpoint:
+    """
+    The number of leading input lines of an import which are done with, saved to path whenever it grows.
+
+    Batches finish in any order when several are in flight, lines only count as done once every batch before them
+    has been written as well. Lines of a batch whose bulk_write raised are never done, nor is anything after them.
+    """
+    path: Optional[str] = None
+    lines: int = 0
+    # last line number of every batch in flight, in the order they were sent -> whether it was written
+    batches: Dict[int, bool] = Factory(OrderedDict)
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> 'Checkpoint':
+        lines = 0
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf8') as f:
+                lines = json.load(f)['lines']
+        return cls(path, lines)
+
+    def started(self, last_line: int) -> None:
+        self.batches[last_line] = False
+
+    def finished(self, last_line: int) -> None:
+        self.batches[last_line] = True
+
+        lines = self.lines
+        while self.batches:
+            first, written = next(iter(self.batches.items()))
+            if not written:
+                break
+            del self.batches[first]
+            lines = first
+
+        if lines != self.lines:
+            self.lines = lines
+            self.save()
+
+    def save(self) -> None:
+        if self.path is not None:
+            # replaced in one go, an interrupted save leaves the previous checkpoint
+            with open(self.path + '.tmp', 'w', encoding='utf8') as f:
+                json.dump({'lines': self.lines}, f)
+            os.replace(self.path + '.tmp', self.path)
+
+    def remove(self) -> None:
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+@attrs(slots=True, auto_attribs=True)
+class ImportStats:
+    written: int = 0
+    invalid: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+
+@contextmanager
+def open_ndjson(path: str, mode: str):
+    """
+    Open an NDJSON file for reading or writing text, gzipped if path ends in .gz, stdin or stdout for -.
+    """
+    if path == '-':
+        yield sys.stdin if mode == 'r' else sys.stdout
+    elif path.endswith('.gz'):
+        with gzip.open(path, mode + 't', encoding='utf8') as f:
+            yield f
+    else:
+        with open(path, mode, encoding='utf8') as f:
+            yield f
+
+
+def truncate_export(path: str) -> Optional[str]:
+    """
+    Cut an export file back to its last complete line, dropping what an interrupted run left of the line after it,
+    and return the _id on that line, None if there is none.
+
+    A plain file is truncated in place. Appending to a gzipped file adds a gzip member after the one which was cut
+    short, which could not be read past, so a gzipped file with a partial line is rewritten without it instead.
+    """
+    if path == '-' or not os.path.exists(path):
+        return None
+
+    if path.endswith('.gz'):
+        last_line, count, complete = None, 0, True
+        with gzip.open(path, 'rb') as lines:
+            try:
+                for line in lines:
+                    if not line.endswith(b'\n'):
+                        complete = False
+                        break
+                    last_line = line
+                    count += 1
+            except EOFError:
+                # the last gzip member was cut short
+                complete = False
+
+        if not complete:
+            with gzip.open(path, 'rb') as lines, gzip.open(path + '.tmp', 'wb') as out:
+                out.writelines(itertools.islice(lines, count))
+            os.replace(path + '.tmp', path)
+    else:
+        last_line, end = None, 0
+        with open(path, 'rb+') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                last_line = line
+                end += len(line)
+            f.truncate(end)
+
+    if last_line is None:
+        return None
+    try:
+        return json.loads(last_line)['_id']
+    except (ValueError, KeyError):
+        return None
+
+
+async def export_documents(collection,
+                           out: IO[str],
+                           after: Optional[str]=None,
+                           batch_size: int=1000,
+                           progress: Optional[Progress]=None) -> int:
+    """
+    Write the documents with an _id greater than after to out, one json document per line in _id order.
+
+    Only one cursor batch is held in memory at a time. Returns the number of documents written.
+    """
+    criteria = {} if after is None else {'_id': {'$gt': ObjectId(after)}}
+    cursor = collection.find(criteria, sort=[('_id', pymongo.ASCENDING)], batch_size=batch_size)
+
+    count = 0
+    async for document in cursor:
+        out.write(json.dumps(munge_object(document), default=str) + '\n')
+        count += 1
+        if progress is not None:
+            progress.advance(1, str(document['_id']))
+    return count
+
+
+async def import_documents(collection,
+                           lines: Iterable[str],
+                           after: Optional[str]=None,
+                           batch_size: int=1000,
+                           concurrency: int=4,
+                           progress: Optional[Progress]=None,
+                           checkpoint: Optional[Checkpoint]=None) -> ImportStats:
+    """
+    Validate json documents from lines and upsert them by _id, skipping those with an _id up to and including after.
+
+    At most concurrency bulk_write batches of batch_size documents are in flight, reading stops while they are,
+    so memory stays bounded whatever the size of the input. Invalid lines and failed writes are reported on stderr
+    and counted.
+
+    checkpoint skips the lines an earlier import is done with and tracks the lines this one is done with.
+    """
+    stats = ImportStats()
+    checkpoint = checkpoint or Checkpoint()
+    resume_after = checkpoint.lines
+    after = None if after is None else ObjectId(after)
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = set()
+    errors = []
+
+    async def write(ids, operations, last_line):
+        try:
+            try:
+                await collection.bulk_write(operations, ordered=False)
+                failed = 0
+            except pymongo.errors.BulkWriteError as err:
+                write_errors = err.details.get('writeErrors', [])
+                for write_error in write_errors:
+                    print(f'_id {ids[write_error["index"]]}: {write_error.get("errmsg")}', file=sys.stderr)
+                failed = len(write_errors)
+
+            stats.written += len(ids) - failed
+            stats.failed += failed
+            checkpoint.finished(last_line)
+            if progress is not None:
+                progress.advance(len(ids) - failed, str(ids[-1]))
+        finally:
+            semaphore.release()
+
+    async def flush(ids, operations, last_line):
+        await semaphore.acquire()
+        checkpoint.started(last_line)
+        task = asyncio.ensure_future(write(ids, operations, last_line))
+        pending.add(task)
+        task.add_done_callback(done)
+
+    def done(task):
+        pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+
+    ids, operations = [], []
+    number = 0
+    for number, line in enumerate(lines, 1):
+        if number <= resume_after:
+            stats.skipped += 1
+            continue
+        if not line.strip():
+            continue
+
+        try:
+            document, invalid = schema.Document.load(json.loads(line))
+        except ValueError as err:
+            document, invalid = None, str(err)
+        if invalid:
+            print(f'line {number}: {invalid}', file=sys.stderr)
+            stats.invalid += 1
+            continue
+
+        try:
+            data = document.to_bson()
+        except InvalidId as err:
+            print(f'line {number}: {err}', file=sys.stderr)
+            stats.invalid += 1
+            continue
+
+        if after is not None and data['_id'] <= after:
+            stats.skipped += 1
+            continue
+
+        ids.append(data['_id'])
+        operations.append(ReplaceOne({'_id': data['_id']}, data, upsert=True))
+        if len(operations) >= batch_size:
+            await flush(ids, operations, number)
+            ids, operations = [], []
+
+    if operations:
+        await flush(ids, operations, number)
+    elif number > resume_after:
+        # the lines after the last batch wrote nothing, they are done once the batches before them are
+        checkpoint.started(number)
+        checkpoint.finished(number)
+    await asyncio.gather(*pending, return_exceptions=True)
+    if errors:
+        raise errors[0]
+
+    return stats
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+    import motor.motor_asyncio
+
+    load_dotenv()
+
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('direction', choices=['import', 'export'])
+    parser.add_argument('path', help="NDJSON file, .gz for gzip, - for stdin or stdout")
+    parser.add_argument('--host', default=os.getenv("MONGODB_HOST", "localhost"))
+    parser.add_argument('--port', type=int, default=int(os.getenv("MONGODB_PORT", "27017")))
+    parser.add_argument('--db', default=os.getenv("MONGODB_DB_NAME", "TEST"))
+    parser.add_argument('--collection', default=os.getenv("MONGODB_DB_COLLECTION_NAME", "Document"))
+    parser.add_argument('--batch-size', type=int, default=1000, help="documents per cursor batch or bulk_write")
+    parser.add_argument('--concurrency', type=int, default=4, help="bulk_write batches in flight during import")
+    parser.add_argument('--after', help="skip documents up to and including this _id")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue after the last exported line, or the input lines an earlier import wrote")
+    parser.add_argument('--checkpoint',
+                        help="file tracking the input lines an import wrote, PATH.checkpoint by default")
+    args = parser.parse_args(argv)
+
+    loop = asyncio.get_event_loop()
+    collection = motor.motor_asyncio.AsyncIOMotorClient(args.host, args.port, io_loop=loop)[args.db][args.collection]
+    progress = Progress(args.direction)
+
+    after = args.after
+    if args.direction == 'export':
+        if args.resume:
+            last_id = truncate_export(args.path)
+            after = last_id if after is None else after
+        mode = 'a' if args.resume else 'w'
+        print(f'Exporting {args.db}.{args.collection} to {args.path} after _id {after}', file=sys.stderr)
+        with open_ndjson(args.path, mode) as out:
+            loop.run_until_complete(export_documents(collection, out, after, args.batch_size, progress))
+    else:
+        checkpoint_path = args.checkpoint or (None if args.path == '-' else args.path + '.checkpoint')
+        if args.resume and checkpoint_path is None:
+            parser.error('--resume of an import from stdin needs --checkpoint')
+        checkpoint = Checkpoint.load(checkpoint_path) if args.resume else Checkpoint(checkpoint_path)
+        print(f'Importing {args.path} into {args.db}.{args.collection} after _id {after}, '
+              f'line {checkpoint.lines}', file=sys.stderr)
+        with open_ndjson(args.path, 'r') as lines:
+            stats = loop.run_until_complete(import_documents(
+                collection, lines, after, args.batch_size, args.concurrency, progress, checkpoint
+            ))
+        # every line was read and written or reported, a rerun starts from the top
+        checkpoint.remove()
+        progress.report()
+        print(f'Skipped {stats.skipped}, invalid {stats.invalid}, failed {stats.failed}', file=sys.stderr)
+        if stats.invalid or stats.failed:
+            sys.exit(1)
+        return
+
+    progress.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+from attr import attrs, Factory
+
+try:
+    from .eventemitter import EventEmitter
+except ImportError:
+    from eventemitter import EventEmitter
+
+from typing import *
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
+
+
+@attrs(slots=True, auto_attribs=True)
+class LRUCache:
+    """
+    Bounded least recently used cache whose entries expire ttl seconds after they were stored.
+    """
+    maxsize: int = 1024
+    ttl: float = 60.0
+    clock: Callable[[], float] = time.monotonic
+    entries: Dict[Any, Tuple[float, Any]] = Factory(OrderedDict)
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > self.clock():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value) -> None:
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key) -> None:
+        self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+@attrs(slots=True, auto_attribs=True)
+class DocumentCache(LRUCache):
+    """
+    LRUCache of whole documents keyed by id, kept up to date from the events a DocumentRepo emits.
+
+    Cached documents are shared between callers and must be treated as read only.
+
+    Reads from mongodb fill it through reading(), which does not overwrite a document an event stored while the
+    read was in flight with what the read got, since that may be older.
+    """
+    # id -> (reads of it in flight, documents stored for it since the first of them started)
+    reads: Dict[str, Tuple[int, int]] = Factory(dict)
+
+    def attach(self, emitter: EventEmitter) -> None:
+        emitter.on('DocumentCreated', self.store)
+        emitter.on('DocumentSaved', self.store)
+
+    def detach(self, emitter: EventEmitter) -> None:
+        emitter.off('DocumentCreated', self.store)
+        emitter.off('DocumentSaved', self.store)
+
+    def store(self, document) -> None:
+        reads = self.reads.get(document.id)
+        if reads is not None:
+            self.reads[document.id] = (reads[0], reads[1] + 1)
+        self.set(document.id, document)
+
+    @contextmanager
+    def reading(self, ids: Iterable[str]):
+        """
+        Track a read of the documents with ids, yielding fill(document) which caches a document the read returned
+        unless a document with its id was stored since the read started.
+        """
+        started = {}
+        for id in ids:
+            count, generation = self.reads.get(id, (0, 0))
+            self.reads[id] = (count + 1, generation)
+            started[id] = generation
+
+        def fill(document) -> None:
+            if self.reads[document.id][1] == started[document.id]:
+                self.set(document.id, document)
+
+        try:
+            yield fill
+        finally:
+            for id in started:
+                count, generation = self.reads[id]
+                if count > 1:
+                    self.reads[id] = (count - 1, generation)
+                else:
+                    del self.reads[id]
+
+
+__all__ = [
+    'LRUCache',
+    'DocumentCache'
+]
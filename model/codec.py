@@ -0,0 +1,208 @@
+"""
+Compiled decoders from raw mongodb documents to model instances.
+
+The decoder for an attrs class is generated once from its fields and type hints and builds the instance straight
+from the BSON dict, skipping munge_object and marshmallow. Values of the exact type a field expects (plus ObjectId
+for strings) take the fast path; anything else is handed to the equivalent marshmallow field so coercion and
+error messages stay the same as schema.Document.load.
+"""
+from attr import attrs, attrib, fields, NOTHING
+import marshmallow.fields
+
+try:
+    from . import model
+except ImportError:
+    import model.model
+
+from typing import *
+from bson import ObjectId, Decimal128
+
+
+MISSING = object()
+
+# model attribute name -> mongodb field name, matching the Fields config in schema.py
+LOAD_FROM = {'id': '_id'}
+
+
+class Invalid(Exception):
+    def __init__(self, messages):
+        super(Invalid, self).__init__(messages)
+        self.messages = messages
+
+
+def invalid(messages):
+    raise Invalid(messages)
+
+
+def fallback(field, value):
+    """
+    Deserialize value with a marshmallow field, for values which are not already of the expected type.
+    """
+    if isinstance(value, ObjectId):
+        value = str(value)
+    elif isinstance(value, Decimal128):
+        value = value.to_decimal()
+    try:
+        return field.deserialize(value)
+    except marshmallow.ValidationError as exc:
+        raise Invalid(exc.messages)
+
+
+# type -> (fast path expression for the value {v}, marshmallow field for everything else)
+SCALARS = {
+    str: (
+        "{v} if type({v}) is str else str({v}) if type({v}) is ObjectId else fallback({field}, {v})",
+        marshmallow.fields.String
+    ),
+    int: ("{v} if type({v}) is int else fallback({field}, {v})", marshmallow.fields.Integer),
+    bool: ("{v} if type({v}) is bool else fallback({field}, {v})", marshmallow.fields.Boolean),
+    float: ("{v} if type({v}) is float else fallback({field}, {v})", marshmallow.fields.Float),
+}
+
+
+def unwrap_optional(typehint) -> Tuple[Any, bool]:
+    """
+    Optional[X] -> (X, True), X -> (X, False)
+    """
+    args = getattr(typehint, '__args__', None) or ()
+    if getattr(typehint, '__origin__', None) is Union and type(None) in args:
+        args = [a for a in args if a is not type(None)]
+        assert len(args) == 1, "Only Optional unions are supported"
+        return args[0], True
+    return typehint, False
+
+
+@attrs(slots=True, auto_attribs=True)
+class Compiler:
+    """
+    Generates the source of the decode functions for an attrs class and the classes it refers to.
+    """
+    namespace: Dict[str, Any]
+    decoders: Dict[type, str]
+    lines: List[str]
+
+    def name(self, prefix, value) -> str:
+        name = '%s_%d' % (prefix, len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def expression(self, typehint, value: str) -> str:
+        """
+        Expression converting the local variable value to typehint, raising Invalid on errors.
+        """
+        typehint, optional = unwrap_optional(typehint)
+
+        if typehint in SCALARS:
+            template, field = SCALARS[typehint]
+            expression = template.format(v=value, field=self.name('field', field()))
+        elif getattr(typehint, '__origin__', None) in (list, List):
+            item_type, = typehint.__args__
+            expression = '[%s for item in %s] if type(%s) is list else invalid(["Not a valid list."])' % (
+                self.expression(item_type, 'item'),
+                value,
+                value
+            )
+        elif hasattr(typehint, '__attrs_attrs__'):
+            expression = '%s(%s) if isinstance(%s, dict) else invalid({"_schema": ["Invalid input type."]})' % (
+                self.compile(typehint),
+                value,
+                value
+            )
+        else:
+            raise TypeError("Can not generate a decoder for %r" % typehint)
+
+        if optional:
+            return 'None if %s is None else %s' % (value, expression)
+        return 'invalid(["Field may not be null."]) if %s is None else %s' % (value, expression)
+
+    def compile(self, cls) -> str:
+        """
+        Generate the decode function for cls, returning its name.
+        """
+        if cls in self.decoders:
+            return self.decoders[cls]
+
+        name = self.decoders[cls] = 'decode_%s' % cls.__name__
+        self.namespace[cls.__name__] = cls
+
+        body = ['def %s(data):' % name, '    errors = {}', '    kwargs = {}']
+        for field in fields(cls):
+            typehint, optional = unwrap_optional(field.type)
+            key = LOAD_FROM.get(field.name, field.name)
+
+            if field.default is not NOTHING:
+                on_missing = 'pass'
+            elif optional:
+                on_missing = 'kwargs[%r] = None' % field.name
+            else:
+                on_missing = 'errors[%r] = ["Missing data for required field."]' % field.name
+
+            body += [
+                '    value = data.get(%r, MISSING)' % key,
+                '    if value is MISSING:',
+                '        %s' % on_missing,
+                '    else:',
+                '        try:',
+                '            kwargs[%r] = %s' % (field.name, self.expression(field.type, 'value')),
+                '        except Invalid as exc:',
+                '            errors[%r] = exc.messages' % field.name,
+            ]
+        body += [
+            '    if errors:',
+            '        raise Invalid(errors)',
+            '    return %s(**kwargs)' % cls.__name__,
+            '',
+        ]
+
+        self.lines.extend(body)
+        return name
+
+
+@attrs(slots=True, auto_attribs=True)
+class Codec:
+    """
+    Decoder for one attrs class, with the same load() interface as the marshmallow schemas in schema.py.
+    """
+    target: type
+    source: str = attrib(repr=False)
+    decode: Callable[[Dict], Any] = attrib(repr=False)
+
+    @classmethod
+    def compile(cls, target: type) -> 'Codec':
+        compiler = Compiler(
+            namespace={
+                'MISSING': MISSING,
+                'Invalid': Invalid,
+                'invalid': invalid,
+                'fallback': fallback,
+                'ObjectId': ObjectId,
+            },
+            decoders={},
+            lines=[]
+        )
+        name = compiler.compile(target)
+        source = '\n'.join(compiler.lines)
+        exec(compile(source, '<codec %s>' % target.__name__, 'exec'), compiler.namespace)
+        return cls(target, source, compiler.namespace[name])
+
+    def load(self, data: Dict) -> Tuple[Any, Dict]:
+        """
+        Returns (instance, errors) where instance is None if there were errors.
+        """
+        try:
+            return self.decode(data), {}
+        except Invalid as exc:
+            return None, exc.messages
+
+
+Date = Codec.compile(model.Date)
+ChildField = Codec.compile(model.ChildField)
+Document = Codec.compile(model.Document)
+
+
+__all__ = [
+    'Codec',
+    'Date',
+    'ChildField',
+    'Document'
+]
@@ -1,22 +1,232 @@
 from attr import attrs, attrib, Factory
+from attr.validators import in_
+from inspect import isawaitable
+import asyncio
 import collections
 import traceback
 from typing import *
 
 
+OVERFLOW_POLICIES = ('drop', 'block', 'coalesce')
+
+
+@attrs(slots=True, auto_attribs=True)
+class Event:
+    name: str
+    args: Tuple = ()
+    kwargs: Dict[str, Any] = Factory(dict)
+
+
+def document_key(event: Event) -> Optional[Hashable]:
+    """
+    Coalesce key of the repo's events, which carry the document as their first argument.
+    """
+    document_id = getattr(event.args[0], 'id', None) if event.args else None
+    return (event.name, document_id) if document_id is not None else None
+
+
+@attrs(slots=True, auto_attribs=True)
+class Dispatcher:
+    """
+    Delivers events to deferred listeners from a task of its own, so emitting them never waits for the listeners.
+
+    Events are queued up to maxsize and handed out in batches of up to batch_size, after waiting batch_delay seconds
+    for a batch to fill up. Batch listeners are called once per batch with the list of Events of their name, other
+    listeners once per event with its arguments. Listeners run one after another and may be coroutine functions.
+
+    When the queue is full overflow decides what happens to a new event: 'drop' discards it, 'block' makes
+    EventEmitter.publish wait for room and 'coalesce' discards it too, but while queued an event replaces the
+    queued event with the same coalesce_key so listeners only see the latest state of a document.
+    """
+    maxsize: int = 10000
+    batch_size: int = 100
+    batch_delay: float = 0.0
+    overflow: str = attrib(default='drop', validator=in_(OVERFLOW_POLICIES))
+    coalesce_key: Callable[[Event], Optional[Hashable]] = attrib(default=document_key, repr=False)
+    listeners: Dict[str, List[Tuple[Callable[..., Any], bool]]] = attrib(
+        factory=lambda: collections.defaultdict(list),
+        repr=False
+    )
+    queue: Deque[Event] = attrib(factory=collections.deque, repr=False)
+    # coalesce key -> the queued event
+    pending: Dict[Hashable, Event] = attrib(factory=dict, repr=False)
+    task: Optional[asyncio.Future] = attrib(default=None, repr=False)
+    ready: Optional[asyncio.Event] = attrib(default=None, repr=False)
+    space: Optional[asyncio.Event] = attrib(default=None, repr=False)
+    idle: Optional[asyncio.Event] = attrib(default=None, repr=False)
+    closed: bool = False
+    high_water: int = 0
+    queued: int = 0
+    delivered: int = 0
+    dropped: int = 0
+    coalesced: int = 0
+    failed: int = 0
+    batches: int = 0
+
+    def on(self, name: str, cb: Callable[..., Any], batch: bool=False) -> None:
+        self.listeners[name].append((cb, batch))
+
+    def off(self, name: str, cb: Callable[..., Any]) -> None:
+        self.listeners[name] = [(listener, batch) for listener, batch in self.listeners[name] if listener != cb]
+
+    def wants(self, name: str) -> bool:
+        return bool(self.listeners.get(name))
+
+    def put_nowait(self, event: Event) -> bool:
+        """
+        Queue event without waiting, returning False if it was dropped because the queue is full or closed.
+        """
+        if self.closed:
+            self.dropped += 1
+            return False
+
+        key = self.coalesce_key(event) if self.overflow == 'coalesce' else None
+        if key is not None:
+            queued = self.pending.get(key)
+            if queued is not None:
+                queued.args, queued.kwargs = event.args, event.kwargs
+                self.coalesced += 1
+                return True
+
+        if len(self.queue) >= self.maxsize:
+            self.dropped += 1
+            return False
+
+        self.start()
+        self.queue.append(event)
+        if key is not None:
+            self.pending[key] = event
+        self.queued += 1
+        self.high_water = max(self.high_water, len(self.queue))
+        self.idle.clear()
+        self.ready.set()
+        return True
+
+    async def put(self, event: Event) -> bool:
+        """
+        Like put_nowait, but waits for room in a full queue when overflow is 'block'.
+        """
+        if self.overflow == 'block':
+            while len(self.queue) >= self.maxsize and not self.closed:
+                self.start()
+                self.space.clear()
+                await self.space.wait()
+        return self.put_nowait(event)
+
+    def start(self) -> None:
+        if self.task is None:
+            self.ready = asyncio.Event()
+            self.space = asyncio.Event()
+            self.idle = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self) -> None:
+        while True:
+            if not self.queue:
+                self.idle.set()
+                if self.closed:
+                    return
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            if self.batch_delay > 0 and len(self.queue) < self.batch_size and not self.closed:
+                await asyncio.sleep(self.batch_delay)
+
+            batch = []
+            while self.queue and len(batch) < self.batch_size:
+                event = self.queue.popleft()
+                if self.pending:
+                    key = self.coalesce_key(event)
+                    if self.pending.get(key) is event:
+                        del self.pending[key]
+                batch.append(event)
+            self.space.set()
+
+            await self.deliver(batch)
+
+    async def deliver(self, batch: List[Event]) -> None:
+        by_name = collections.OrderedDict()
+        for event in batch:
+            by_name.setdefault(event.name, []).append(event)
+
+        for name, events in by_name.items():
+            for listener, batched in list(self.listeners.get(name, ())):
+                if batched:
+                    await self.call(listener, (events,), {})
+                else:
+                    for event in events:
+                        await self.call(listener, event.args, event.kwargs)
+
+        self.batches += 1
+        self.delivered += len(batch)
+
+    async def call(self, listener: Callable[..., Any], args: Tuple, kwargs: Dict[str, Any]) -> None:
+        try:
+            result = listener(*args, **kwargs)
+            if isawaitable(result):
+                await result
+        except Exception:
+            self.failed += 1
+            traceback.print_exc()
+
+    async def join(self) -> None:
+        """
+        Wait until every queued event has been delivered.
+        """
+        if self.task is not None:
+            await self.idle.wait()
+
+    async def close(self) -> None:
+        """
+        Deliver the queued events and stop, events emitted from now on are dropped.
+        """
+        self.closed = True
+        if self.task is not None:
+            self.ready.set()
+            self.space.set()
+            await self.task
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'depth': len(self.queue),
+            'high_water': self.high_water,
+            'queued': self.queued,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'batches': self.batches,
+        }
+
+
 @attrs(slots=True, auto_attribs=True)
 class EventEmitter:
     """
+    Calls listeners by event name. Inline listeners run in emit, deferred ones are queued on dispatcher.
     """
     events: Dict[str, Callable[..., None]] = Factory(lambda: collections.defaultdict(list))
+    dispatcher: Optional[Dispatcher] = None
 
-    def on(self, name: str, cb: Callable[..., None]) -> None:
-        self.events[name].append(cb)
+    def on(self, name: str, cb: Callable[..., None], deferred: bool=False, batch: bool=False) -> None:
+        """
+        Listen to name events. Coroutine functions and batch listeners, which get lists of Events, are always
+        deferred and run by dispatcher, a default Dispatcher when there is none yet.
+        """
+        if deferred or batch or asyncio.iscoroutinefunction(cb):
+            if self.dispatcher is None:
+                self.dispatcher = Dispatcher()
+            self.dispatcher.on(name, cb, batch)
+        else:
+            self.events[name].append(cb)
 
     def off(self, name, cb: Callable[..., None]) -> None:
-        self.events[name].remove(cb)
+        if cb in self.events[name]:
+            self.events[name].remove(cb)
+        elif self.dispatcher is not None:
+            self.dispatcher.off(name, cb)
 
-    def emit(self, name, *args, **kwds) -> None:
+    def emit_inline(self, name, args, kwds) -> None:
         for cb in self.events[name]:
             try:
                 cb(*args, **kwds)
@@ -24,5 +234,21 @@ class EventEmitter:
                 traceback.print_exc()
                 pass
 
+    def emit(self, name, *args, **kwds) -> None:
+        """
+        Call the inline listeners and queue the event for the deferred ones, dropping it if the queue is full.
+        """
+        self.emit_inline(name, args, kwds)
+        if self.dispatcher is not None and self.dispatcher.wants(name):
+            self.dispatcher.put_nowait(Event(name, args, kwds))
+
+    async def publish(self, name, *args, **kwds) -> None:
+        """
+        Like emit, but waits for room in the queue when the dispatcher's overflow is 'block'.
+        """
+        self.emit_inline(name, args, kwds)
+        if self.dispatcher is not None and self.dispatcher.wants(name):
+            await self.dispatcher.put(Event(name, args, kwds))
+
 
-__all__ = ['EventEmitter']
+__all__ = ['OVERFLOW_POLICIES', 'Event', 'Dispatcher', 'EventEmitter']
@@ -0,0 +1,188 @@
+"""
+Reconciles the indexes declared for a collection, query.INDEXES by default, with the ones it actually has.
+
+reconcile() compares the declarations with list_indexes() and starts building the missing indexes in the background.
+Until an index is built it is left out of usable_indexes(), so the query planner treats queries which need it as
+collection scans instead of running them, and ready() stays false.
+"""
+from attr import attrs, Factory
+import pymongo.errors
+import asyncio
+import time
+
+try:
+    from .query import Index
+except ImportError:
+    from query import Index
+
+from typing import *
+
+
+# mongodb names the index on _id "_id_" rather than "_id_1"
+ID_INDEX_NAME = '_id_'
+
+
+def index_name(index: Index) -> str:
+    """
+    The name mongodb gives an index which is created without one, i.e. name_-1.
+    """
+    return '_'.join('%s_%s' % (field, direction) for field, direction in index.keys)
+
+
+@attrs(slots=True, auto_attribs=True)
+class IndexDrift:
+    """
+    Differences between the declared indexes and the collection, which are matched by their keys.
+    """
+    # declared but not on the collection
+    missing: List[Index] = Factory(list)
+    # on the collection with other options than declared, or with other keys under the declared name, these are
+    # reported but left alone
+    changed: List[Index] = Factory(list)
+    # declared name -> the name of the index on the declared keys, which has another name on the collection
+    renamed: Dict[str, str] = Factory(dict)
+    # on the collection but not declared
+    extra: List[str] = Factory(list)
+
+    def __bool__(self):
+        return bool(self.missing or self.changed or self.renamed or self.extra)
+
+    def report(self) -> str:
+        if not self:
+            return 'indexes up to date'
+        return 'missing %s, changed %s, renamed %s, extra %s' % (
+            [index_name(index) for index in self.missing],
+            [index_name(index) for index in self.changed],
+            self.renamed,
+            self.extra
+        )
+
+
+async def existing_indexes(collection) -> Dict[str, Index]:
+    """
+    The indexes of collection keyed by name.
+    """
+    results = {}
+    async for info in collection.list_indexes():
+        # the mongo shell stores directions as doubles
+        keys = [(field, int(d) if isinstance(d, (int, float)) else d) for field, d in info['key'].items()]
+        results[info['name']] = Index(keys, unique=bool(info.get('unique', False)))
+    return results
+
+
+def diff(declared: Iterable[Index], existing: Dict[str, Index]) -> IndexDrift:
+    """
+    Match the declared indexes with existing by their keys, whatever their names.
+
+    A declared index is missing when there is no index on its keys, unless its name is taken by an index on other
+    keys, which is changed since mongodb would refuse to build it.
+    """
+    drift = IndexDrift()
+    by_keys = {tuple(index.keys): name for name, index in existing.items()}
+    matched = set()
+    for index in declared:
+        name = index_name(index)
+        existing_name = by_keys.get(tuple(index.keys))
+        if existing_name is not None:
+            matched.add(existing_name)
+            if existing[existing_name] != index:
+                drift.changed.append(index)
+            if existing_name != name:
+                drift.renamed[name] = existing_name
+        elif name in existing:
+            matched.add(name)
+            drift.changed.append(index)
+        else:
+            drift.missing.append(index)
+
+    drift.extra = sorted(name for name in existing if name not in matched and name != ID_INDEX_NAME)
+    return drift
+
+
+@attrs(slots=True, auto_attribs=True)
+class IndexReconciler:
+    collection: Any
+    indexes: List[Index]
+    clock: Callable[[], float] = time.monotonic
+    # names of the declared indexes whose keys have an index, None until reconcile() has listed them
+    built: Optional[Set[str]] = None
+    building: Set[str] = Factory(set)
+    # index name -> seconds it took to build, and index name -> the error the build failed with
+    build_times: Dict[str, float] = Factory(dict)
+    failed: Dict[str, str] = Factory(dict)
+    drift: Optional[IndexDrift] = None
+    task: Any = None
+
+    async def reconcile(self, background: bool=True) -> IndexDrift:
+        """
+        Diff the declared indexes against the collection and build the missing ones.
+
+        With background the builds run in a task and reconcile returns as soon as the diff is known, wait()
+        finishes them.
+        """
+        existing = await existing_indexes(self.collection)
+        self.drift = diff(self.indexes, existing)
+        # an index on the declared keys serves the queries which need them, whatever its name and options
+        keys = {tuple(index.keys) for index in existing.values()}
+        self.built = {index_name(index) for index in self.indexes if tuple(index.keys) in keys}
+        missing = {index_name(index) for index in self.drift.missing}
+        print(f'Indexes: {self.drift.report()}')
+
+        if self.drift.missing:
+            self.building = set(missing)
+            self.task = asyncio.ensure_future(self.build(self.drift.missing))
+            if not background:
+                await self.task
+        return self.drift
+
+    async def build(self, indexes: Iterable[Index]) -> None:
+        for index in indexes:
+            name = index_name(index)
+            started = self.clock()
+            try:
+                await self.collection.create_index(index.keys, unique=index.unique, name=name, background=True)
+            except pymongo.errors.PyMongoError as err:
+                self.failed[name] = str(err)
+                print(f'Index {name} failed to build: {err}')
+            else:
+                self.build_times[name] = self.clock() - started
+                self.built.add(name)
+                print(f'Index {name} built in {self.build_times[name]:.3f}s')
+            finally:
+                self.building.discard(name)
+
+    async def wait(self) -> None:
+        if self.task is not None:
+            await self.task
+
+    def cancel(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    def usable_indexes(self) -> List[Index]:
+        """
+        The declared indexes which can serve queries, all of them if reconcile() has not run.
+        """
+        if self.built is None:
+            return list(self.indexes)
+        return [index for index in self.indexes if index_name(index) in self.built]
+
+    def ready(self) -> bool:
+        return self.built is not None and all(index_name(index) in self.built for index in self.indexes)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'ready': self.ready(),
+            'drift': None if self.drift is None else self.drift.report(),
+            'building': sorted(self.building),
+            'build_times': dict(self.build_times),
+            'failed': dict(self.failed),
+        }
+
+
+__all__ = [
+    'index_name',
+    'IndexDrift',
+    'IndexReconciler',
+    'diff'
+]
@@ -0,0 +1,104 @@
+"""
+Read only views over RawBSONDocument which look like the model classes.
+
+With CodecOptions(document_class=RawBSONDocument) mongodb results stay as BSON bytes. The top level fields are
+decoded the first time any of them is touched, nested documents (child fields and their dates) stay raw until a
+resolver asks for them, so fields which are never resolved are never turned into python objects.
+
+The views skip the validation done by schema.py and codec.py, they are meant for read-mostly queries only. Use
+to_model() to get a real model instance.
+"""
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+try:
+    from . import model
+except ImportError:
+    import model.model
+
+from typing import *
+
+
+RAW_BSON_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+
+def lazy_date(raw: Optional[RawBSONDocument]) -> Optional[model.Date]:
+    return None if raw is None else model.Date(raw['month'], raw['year'])
+
+
+class LazyChildField:
+    __slots__ = ('raw',)
+
+    def __init__(self, raw: RawBSONDocument):
+        self.raw = raw
+
+    @property
+    def id(self) -> str:
+        return str(self.raw['_id'])
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.raw.get('name')
+
+    @property
+    def date(self) -> Optional[model.Date]:
+        return lazy_date(self.raw.get('date'))
+
+    def to_model(self) -> model.ChildField:
+        return model.ChildField(date=self.date, name=self.name, id=self.id)
+
+
+class LazyDocument:
+    __slots__ = ('raw', '_child_field')
+
+    def __init__(self, raw: RawBSONDocument):
+        self.raw = raw
+        self._child_field = None
+
+    @property
+    def id(self) -> str:
+        return str(self.raw['_id'])
+
+    @property
+    def name(self) -> str:
+        return self.raw['name']
+
+    @property
+    def age(self) -> Optional[int]:
+        return self.raw.get('age')
+
+    @property
+    def archived(self) -> Optional[bool]:
+        return self.raw.get('archived', False)
+
+    @property
+    def child_field(self) -> List[LazyChildField]:
+        if self._child_field is None:
+            self._child_field = [LazyChildField(raw) for raw in self.raw.get('child_field', [])]
+        return self._child_field
+
+    @property
+    def child_field_count(self) -> Optional[int]:
+        return self.raw.get('child_field_count')
+
+    @property
+    def child_field_offset(self) -> Optional[int]:
+        return self.raw.get('child_field_offset')
+
+    def to_model(self) -> model.Document:
+        return model.Document(
+            name=self.name,
+            age=self.age,
+            archived=self.archived,
+            child_field=[c.to_model() for c in self.child_field],
+            id=self.id,
+            child_field_count=self.child_field_count,
+            child_field_offset=self.child_field_offset
+        )
+
+
+__all__ = [
+    'RAW_BSON_CODEC_OPTIONS',
+    'LazyChildField',
+    'LazyDocument'
+]
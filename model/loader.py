@@ -0,0 +1,78 @@
+from attr import attrs, Factory
+
+try:
+    from . import model
+except ImportError:
+    import model.model
+
+from typing import *
+from bson import ObjectId
+import asyncio
+
+
+@attrs(slots=True, auto_attribs=True)
+class DocumentLoader:
+    """
+    Batches the find_by_id lookups made during one event loop tick into a single repo.find_by_ids call.
+
+    A loader is meant to live for a single request: every (id, fields) pair is fetched at most once and the
+    result is cached for the lifetime of the loader. A batch fetches the union of the fields asked for.
+    """
+    repo: Any
+    cache: Dict[Tuple[str, Optional[FrozenSet[str]]], asyncio.Future] = Factory(dict)
+    # the keys of the pending batch with their futures, which clear() may already have dropped from cache
+    queue: List[Tuple[Tuple[str, Optional[FrozenSet[str]]], asyncio.Future]] = Factory(list)
+
+    def load(self, id: str, fields: Optional[Iterable[str]]=None) -> Awaitable[Optional[model.Document]]:
+        """
+        Can raise an InvalidId error if id is not a valid ObjectId
+
+        fields limits the document fields loaded, None loads the whole document.
+        """
+        key = (str(ObjectId(id)), None if fields is None else frozenset(fields))
+
+        future = self.cache.get(key)
+        if future is not None:
+            return future
+
+        loop = asyncio.get_event_loop()
+        future = self.cache[key] = loop.create_future()
+
+        if not self.queue:
+            loop.call_soon(lambda: asyncio.ensure_future(self.dispatch()))
+        self.queue.append((key, future))
+
+        return future
+
+    def clear(self, id: str) -> None:
+        """
+        Forget the cached results for id, i.e. after the document has been changed.
+        """
+        id = str(ObjectId(id))
+        for key in [key for key in self.cache if key[0] == id]:
+            del self.cache[key]
+
+    async def dispatch(self) -> None:
+        keys, self.queue = self.queue, []
+
+        fields = set()
+        for (_, key_fields), _ in keys:
+            if key_fields is None:
+                fields = None
+                break
+            fields |= key_fields
+
+        try:
+            documents = await self.repo.find_by_ids([id for (id, _), _ in keys], fields=fields)
+        except Exception as exc:
+            for key, future in keys:
+                if self.cache.get(key) is future:
+                    del self.cache[key]
+                future.set_exception(exc)
+            return
+
+        for (id, _), future in keys:
+            future.set_result(documents.get(id))
+
+
+__all__ = ['DocumentLoader']
@@ -0,0 +1,122 @@
+"""
+An in-memory stand-in for the motor collection behind DocumentRepo, for benchmarks and load tests.
+
+It answers the reads DocumentRepo makes without any round trips. Criteria are matched on _id only and writes are
+acknowledged but not applied, so every call sees the same data however many times it runs.
+"""
+from attr import attrs, attrib
+from bson import ObjectId
+from collections import namedtuple
+import random
+import string
+
+try:
+    from . import model
+except ImportError:
+    import model.model
+
+from typing import *
+
+
+InsertOneResult = namedtuple('InsertOneResult', 'inserted_id')
+
+
+def project(document: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    The parts of a mongodb projection that repo.make_projection uses: inclusion, $slice, $literal and $size.
+    """
+    if projection is None:
+        return dict(document)
+
+    result = {'_id': document['_id']}
+    for field, value in projection.items():
+        if isinstance(value, dict) and '$slice' in value:
+            if field in document:
+                skip, limit = value['$slice'] if isinstance(value['$slice'], list) else (0, value['$slice'])
+                result[field] = document[field][skip:skip + limit]
+        elif isinstance(value, dict) and '$literal' in value:
+            result[field] = value['$literal']
+        elif isinstance(value, dict) and '$size' in value:
+            result[field] = len(document.get('child_field') or [])
+        elif field in document:
+            result[field] = document[field]
+    return result
+
+
+@attrs(slots=True, auto_attribs=True)
+class MemoryCollection:
+    data: Dict[ObjectId, Dict[str, Any]] = attrib(factory=dict, repr=False)
+
+    @classmethod
+    def of(cls, documents: Iterable[model.Document]) -> 'MemoryCollection':
+        return cls({ObjectId(document.id): document.to_bson() for document in documents})
+
+    def matches(self, criteria):
+        criteria = criteria.get('_id') if criteria else None
+        if criteria is None:
+            return list(self.data.values())
+        if isinstance(criteria, dict):
+            ids = criteria.get('$in')
+            if ids is not None:
+                return [self.data[id] for id in ids if id in self.data]
+            after = criteria.get('$gt')
+            return [document for id, document in self.data.items() if after is None or id > after]
+        document = self.data.get(criteria)
+        return [document] if document is not None else []
+
+    def with_options(self, **kwargs):
+        return self
+
+    async def find(self, criteria, projection=None, sort=None, limit=0):
+        documents = sorted(self.matches(criteria), key=lambda document: document['_id'])
+        for document in documents[:limit or None]:
+            yield project(document, projection)
+
+    async def find_one(self, criteria, projection=None):
+        documents = self.matches(criteria)
+        return project(documents[0], projection) if documents else None
+
+    async def find_one_and_update(self, criteria, update, return_document=None):
+        return await self.find_one({'_id': criteria['_id']})
+
+    async def find_one_and_replace(self, criteria, replacement, return_document=None):
+        return await self.find_one(criteria)
+
+    async def insert_one(self, document):
+        return InsertOneResult(document['_id'])
+
+    async def insert_many(self, documents, ordered=True):
+        pass
+
+    async def update_many(self, criteria, update):
+        pass
+
+    async def count_documents(self, criteria, limit=0):
+        return len(self.matches(criteria))
+
+
+def random_document(rng: random.Random, children: int) -> model.Document:
+    def text(length):
+        return ''.join(rng.choice(string.ascii_letters) for _ in range(length))
+
+    return model.Document(
+        name=text(20),
+        age=rng.randint(1, 100),
+        archived=rng.random() < 0.1,
+        child_field=[
+            model.ChildField(model.Date(rng.randint(1, 12), rng.randint(2000, 2100)), text(30))
+            for _ in range(children)
+        ]
+    )
+
+
+def random_documents(count: int, children: int, seed: int=0) -> List[model.Document]:
+    rng = random.Random(seed)
+    return [random_document(rng, children) for _ in range(count)]
+
+
+__all__ = [
+    'MemoryCollection',
+    'random_document',
+    'random_documents'
+]
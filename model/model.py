@@ -1,6 +1,7 @@
 from typing import *
 from datetime import datetime
 from attr import attrs, Factory
+from operator import attrgetter
 from bson import Decimal128, ObjectId
 
 
@@ -45,6 +46,113 @@ class ChildField:
         }
 
 
+class ChildFieldList(list):
+    """
+    List of child fields which keeps an id -> position and a (year, month) -> child fields index of itself.
+
+    Child field ids are expected to be unique. The indexes are built on the first lookup and then kept up to date
+    by append, item assignment and deletion of single items, any other change to the list drops them until the next
+    lookup. Changing the id or date of a child field which is already in the list is not noticed, replace it
+    instead.
+    """
+    __slots__ = ('_positions', '_dates')
+
+    def __init__(self, *args):
+        super(ChildFieldList, self).__init__(*args)
+        self._positions = None
+        self._dates = None
+
+    def __reduce__(self):
+        # copies and pickles rebuild the indexes rather than carry them along
+        return (ChildFieldList, (list(self),))
+
+    @staticmethod
+    def _date_key(child_field: ChildField):
+        date = child_field.date
+        return None if date is None else (date.year, date.month)
+
+    def _build(self) -> None:
+        self._positions = dict(zip(map(attrgetter('id'), self), range(len(self))))
+        self._dates = {}
+        for child_field in self:
+            self._dates.setdefault(self._date_key(child_field), []).append(child_field)
+
+    def _invalidate(self) -> None:
+        self._positions = None
+        self._dates = None
+
+    def index_of(self, id: str) -> Optional[int]:
+        if self._positions is None:
+            self._build()
+        return self._positions.get(id)
+
+    def for_date(self, date: Date) -> Optional[ChildField]:
+        if self._dates is None:
+            self._build()
+        child_fields = self._dates.get((date.year, date.month))
+        return child_fields[0] if child_fields else None
+
+    def _unindex(self, child_field: ChildField) -> None:
+        self._positions.pop(child_field.id, None)
+        key = self._date_key(child_field)
+        self._dates[key] = [c for c in self._dates[key] if c is not child_field]
+        if not self._dates[key]:
+            del self._dates[key]
+
+    def append(self, child_field: ChildField) -> None:
+        super(ChildFieldList, self).append(child_field)
+        if self._positions is not None:
+            self._positions[child_field.id] = len(self) - 1
+            self._dates.setdefault(self._date_key(child_field), []).append(child_field)
+
+    def __setitem__(self, index, value):
+        if self._positions is None or not isinstance(index, int):
+            super(ChildFieldList, self).__setitem__(index, value)
+            self._invalidate()
+            return
+
+        position = index % len(self) if -len(self) <= index < len(self) else index
+        self._unindex(self[position])
+        super(ChildFieldList, self).__setitem__(index, value)
+        self._positions[value.id] = position
+        children = self._dates.setdefault(self._date_key(value), [])
+        children.append(value)
+        children.sort(key=lambda c: self._positions.get(c.id, position))
+
+    def __delitem__(self, index):
+        if self._positions is None or not isinstance(index, int):
+            super(ChildFieldList, self).__delitem__(index)
+            self._invalidate()
+            return
+
+        position = index % len(self) if -len(self) <= index < len(self) else index
+        self._unindex(self[position])
+        super(ChildFieldList, self).__delitem__(index)
+        self._positions.update(zip(map(attrgetter('id'), self[position:]), range(position, len(self))))
+
+    def _invalidating(name):
+        method = getattr(list, name)
+
+        def invalidating(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            self._invalidate()
+            return result
+
+        invalidating.__name__ = name
+        return invalidating
+
+    extend = _invalidating('extend')
+    insert = _invalidating('insert')
+    remove = _invalidating('remove')
+    pop = _invalidating('pop')
+    clear = _invalidating('clear')
+    sort = _invalidating('sort')
+    reverse = _invalidating('reverse')
+    __iadd__ = _invalidating('__iadd__')
+    __imul__ = _invalidating('__imul__')
+    del _invalidating
+
+
 @attrs(slots=True, auto_attribs=True)
 class Document:
     name: str
@@ -52,13 +160,22 @@ class Document:
     archived: Optional[bool] = Factory(lambda: False)
     child_field: List[ChildField] = Factory(list)
     id: Optional[str] = Factory(lambda: str(ObjectId()))
+    # number of child fields when only some or none of them were loaded, it is not stored
+    child_field_count: Optional[int] = Factory(lambda: None)
+    # position of the first loaded child field when they were loaded from further in, it is not stored either
+    child_field_offset: Optional[int] = Factory(lambda: None)
+
+    def __attrs_post_init__(self):
+        self._indexed_child_field()
+
+    def _indexed_child_field(self) -> ChildFieldList:
+        # also covers child_field being replaced by a plain list after construction
+        if self.child_field is not None and not isinstance(self.child_field, ChildFieldList):
+            self.child_field = ChildFieldList(self.child_field)
+        return self.child_field
 
     def child_field_index(self, id: str):
-        child_field_ids = [sub.id for sub in self.child_field]
-        try:
-            return child_field_ids.index(id)
-        except ValueError:
-            return None
+        return self._indexed_child_field().index_of(id)
 
     def find_child_field(self, id: str):
         index = self.child_field_index(id)
@@ -89,9 +206,7 @@ class Document:
         self.child_field[index] = child_field
 
     def find_child_field_for_date(self, sub_date: Date) -> Optional[ChildField]:
-        for sub in self.child_field:
-            if sub.date == sub_date:
-                return sub
+        return self._indexed_child_field().for_date(sub_date)
 
     def to_bson(self):
         result = {
@@ -0,0 +1,245 @@
+"""
+Transactional outbox of the repo's DocumentCreated and DocumentSaved events, relayed to a message broker.
+
+DocumentRepo writes one record per event to the outbox collection together with the documents, inside a mongodb
+transaction when the Outbox has a client, so an event is only ever recorded for a write which happened. The
+OutboxRelay claims records in _id order, hands them to a publisher in batches and deletes them once the publisher
+returns, which it only does after the broker confirmed every message. Delivery is at least once, a record whose
+relay died before deleting it is published again after its claim expires. Consumers tell repeats apart by the
+message id, the id of the record.
+"""
+from attr import attrs, Factory
+from bson import ObjectId
+from pymongo import ASCENDING
+import pymongo.errors
+import asyncio
+import random
+import time
+import traceback
+
+try:
+    from . import model
+except ImportError:
+    import model.model
+
+from typing import *
+
+
+T = TypeVar('T')
+
+
+class RetryTransaction(Exception):
+    """
+    Raised by a write given to Outbox.run to be run again in a new transaction, after an error of its own aborted
+    the one it ran in.
+    """
+
+
+def has_error_label(exc: BaseException, label: str) -> bool:
+    return isinstance(exc, pymongo.errors.PyMongoError) and exc.has_error_label(label)
+
+
+def record(name: str, document: model.Document) -> Dict[str, Any]:
+    return {'_id': ObjectId(), 'event': name, 'document': document.to_bson(), 'claimed_until': 0.0}
+
+
+@attrs(slots=True, auto_attribs=True)
+class Outbox:
+    collection: Any
+    # motor client whose sessions the repo's writes run in transactions of, None writes the records right after
+    # the documents, which needs no replica set but loses the events of a worker which dies in between
+    client: Any = None
+    # set whenever records are added, so a relay in this process does not wait for its next poll
+    added: Optional[asyncio.Event] = None
+    # seconds for which transactions which failed with a transient error are run again
+    max_retry_time: float = 120.0
+    clock: Callable[[], float] = time.monotonic
+    # transactions which were run again, or had their commit retried into a failure which ran them again
+    retries: int = 0
+
+    async def check_indices(self) -> None:
+        await self.collection.create_index([('claimed_until', ASCENDING), ('_id', ASCENDING)])
+
+    async def run(self, write: Callable[[Dict[str, Any]], Awaitable[T]]) -> T:
+        """
+        Await write(options), options being the keyword arguments for its collection calls, which hold a session in
+        a transaction when there is a client, and return what it returns.
+
+        Like the with_transaction of later pymongo versions, the whole transaction is run again while it fails with a
+        TransientTransactionError, e.g. a WriteConflict with a concurrent write to the same document, and a commit is
+        retried while its result is unknown, both for up to max_retry_time seconds. write must not have effects
+        other than its collection calls. It raises RetryTransaction to be run again in a new transaction regardless.
+        """
+        if self.client is None:
+            return await write({})
+
+        deadline = self.clock() + self.max_retry_time
+        async with await self.client.start_session() as session:
+            while True:
+                session.start_transaction()
+                try:
+                    result = await write({'session': session})
+                except BaseException as exc:
+                    await session.abort_transaction()
+                    if isinstance(exc, RetryTransaction) or (
+                        has_error_label(exc, 'TransientTransactionError') and self.clock() < deadline
+                    ):
+                        self.retries += 1
+                        continue
+                    raise
+
+                if await self._commit(session, deadline):
+                    return result
+                self.retries += 1
+
+    async def _commit(self, session, deadline: float) -> bool:
+        """
+        Commit the transaction of session, False if it has to be run again.
+        """
+        while True:
+            try:
+                await session.commit_transaction()
+                return True
+            except pymongo.errors.PyMongoError as exc:
+                if self.clock() >= deadline:
+                    raise
+                if exc.has_error_label('UnknownTransactionCommitResult'):
+                    continue
+                if exc.has_error_label('TransientTransactionError'):
+                    return False
+                raise
+
+    async def add(self, events: List[Tuple[str, model.Document]], **options) -> None:
+        """
+        Write a record of every (name, document) event with a single insert, options being those of run().
+        """
+        if not events:
+            return
+        await self.collection.insert_many([record(name, document) for name, document in events], **options)
+        if self.added is not None:
+            self.added.set()
+
+
+@attrs(slots=True, auto_attribs=True)
+class OutboxRelay:
+    """
+    Drains an Outbox through publisher, whose publish(records) coroutine returns once the broker confirmed them all.
+
+    Failed batches are released for a retry after a backoff which doubles from backoff up to max_backoff.
+    """
+    outbox: Outbox
+    publisher: Any
+    batch_size: int = 100
+    # seconds between looks at the outbox when nothing was added in this process
+    poll_interval: float = 1.0
+    # seconds a claim on records lasts before another relay may publish them
+    lease: float = 60.0
+    backoff: float = 0.1
+    max_backoff: float = 30.0
+    clock: Callable[[], float] = time.time
+    # tells the claims of this relay from those of the relays of other workers
+    token: str = Factory(lambda: str(ObjectId()))
+    task: Optional[asyncio.Future] = None
+    published: int = 0
+    batches: int = 0
+    failures: int = 0
+    last_error: Optional[str] = None
+
+    async def relay_once(self) -> int:
+        """
+        Publish and delete the next batch of records, returning how many there were.
+        """
+        collection = self.outbox.collection
+        now = self.clock()
+        ids = [
+            document['_id'] async for document in collection.find(
+                {'claimed_until': {'$lt': now}},
+                {'_id': True},
+                sort=[('_id', ASCENDING)],
+                limit=self.batch_size
+            )
+        ]
+        if not ids:
+            return 0
+
+        await collection.update_many(
+            {'_id': {'$in': ids}, 'claimed_until': {'$lt': now}},
+            {'$set': {'claimed_until': now + self.lease, 'claimed_by': self.token}}
+        )
+        records = [
+            document async for document in collection.find(
+                {'_id': {'$in': ids}, 'claimed_by': self.token},
+                sort=[('_id', ASCENDING)]
+            )
+        ]
+        if not records:
+            return 0
+
+        claimed = [record['_id'] for record in records]
+        try:
+            await self.publisher.publish(records)
+        except BaseException:
+            await collection.update_many(
+                {'_id': {'$in': claimed}, 'claimed_by': self.token},
+                {'$set': {'claimed_until': 0.0}}
+            )
+            raise
+
+        await collection.delete_many({'_id': {'$in': claimed}})
+        self.published += len(records)
+        self.batches += 1
+        return len(records)
+
+    async def run(self) -> None:
+        if self.outbox.added is None:
+            self.outbox.added = asyncio.Event()
+        added = self.outbox.added
+        delay = self.backoff
+
+        while True:
+            added.clear()
+            try:
+                count = await self.relay_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.failures += 1
+                self.last_error = repr(exc)
+                traceback.print_exc()
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, self.max_backoff)
+                continue
+
+            delay = self.backoff
+            if count < self.batch_size:
+                try:
+                    await asyncio.wait_for(added.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        """
+        Stop relaying, records claimed by a batch which was cut short are published again once the claim expires.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'published': self.published,
+            'batches': self.batches,
+            'failures': self.failures,
+            'last_error': self.last_error,
+        }
+
+
+__all__ = ['RetryTransaction', 'Outbox', 'OutboxRelay']
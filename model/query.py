@@ -0,0 +1,240 @@
+"""
+Typed filters and sort orders for DocumentRepo.find, compiled to mongodb queries.
+
+INDEXES are the compound indexes DocumentRepo.check_indices builds for them: equality fields first, then the sort
+keys. plan() works out which of them a filter and sort would use, so combinations which make mongodb sort in memory
+or scan the whole collection are caught before the query is sent.
+"""
+from attr import attrs, Factory
+from bson import ObjectId
+from bson.errors import InvalidId
+import pymongo
+import base64
+import binascii
+import json
+import re
+
+from typing import *
+
+
+# sortable fields -> whether the field is unique, sorts on fields which are not get _id as a tie breaker
+SORT_FIELDS = {
+    '_id': True,
+    'name': True,
+    'age': False,
+}
+
+
+@attrs(slots=True, auto_attribs=True)
+class Index:
+    keys: List[Tuple[str, int]]
+    unique: bool = False
+
+    @property
+    def fields(self) -> List[str]:
+        return [field for field, _ in self.keys]
+
+
+# every collection has this one
+ID_INDEX = Index([('_id', pymongo.ASCENDING)], unique=True)
+
+INDEXES = [
+    Index([('name', pymongo.DESCENDING)], unique=True),
+    Index([('archived', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]),
+    Index([('archived', pymongo.ASCENDING), ('name', pymongo.ASCENDING)]),
+    Index([('archived', pymongo.ASCENDING), ('age', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]),
+    Index([('age', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]),
+]
+
+
+def combine(*criteria: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    And together mongodb criteria, merging them into one dict when their fields do not overlap.
+    """
+    criteria = [c for c in criteria if c]
+    result = {}
+    for c in criteria:
+        if result.keys() & c.keys():
+            return {'$and': criteria}
+        result.update(c)
+    return result
+
+
+@attrs(slots=True, auto_attribs=True)
+class DocumentFilter:
+    """
+    Conditions documents have to meet, None leaves a condition out. archived=False also matches documents whose
+    archived was never set, age bounds are inclusive.
+    """
+    archived: Optional[bool] = None
+    age_min: Optional[int] = None
+    age_max: Optional[int] = None
+    name_prefix: Optional[str] = None
+
+    def equality_fields(self) -> Set[str]:
+        return {'archived'} if self.archived is not None else set()
+
+    def range_fields(self) -> Set[str]:
+        fields = set()
+        if self.age_min is not None or self.age_max is not None:
+            fields.add('age')
+        if self.name_prefix is not None:
+            fields.add('name')
+        return fields
+
+    def to_criteria(self) -> Dict[str, Any]:
+        criteria = {}
+        if self.archived is not None:
+            criteria['archived'] = True if self.archived else {'$in': [False, None]}
+
+        age = {}
+        if self.age_min is not None:
+            age['$gte'] = self.age_min
+        if self.age_max is not None:
+            age['$lte'] = self.age_max
+        if age:
+            criteria['age'] = age
+
+        if self.name_prefix is not None:
+            # an anchored, case sensitive regex is turned into index bounds on name
+            criteria['name'] = {'$regex': '^' + re.escape(self.name_prefix)}
+
+        return criteria
+
+    def matches(self, document) -> bool:
+        """
+        Whether a model.Document (or lazy.LazyDocument) meets the filter, the same way to_criteria does in mongodb.
+        """
+        if self.archived is not None and bool(document.archived) != self.archived:
+            return False
+        if self.age_min is not None and (document.age is None or document.age < self.age_min):
+            return False
+        if self.age_max is not None and (document.age is None or document.age > self.age_max):
+            return False
+        if self.name_prefix is not None and not document.name.startswith(self.name_prefix):
+            return False
+        return True
+
+
+@attrs(slots=True, auto_attribs=True)
+class DocumentSort:
+    """
+    Order of the results of DocumentRepo.find, field being one of SORT_FIELDS and direction a pymongo direction.
+
+    Cursors are the document id when sorting by _id, the sort value and the id otherwise.
+    """
+    field: str = '_id'
+    direction: int = pymongo.ASCENDING
+
+    def __attrs_post_init__(self):
+        if self.field not in SORT_FIELDS:
+            raise ValueError("Can not sort by %s" % self.field)
+
+    def keys(self) -> List[Tuple[str, int]]:
+        keys = [(self.field, self.direction)]
+        if not SORT_FIELDS[self.field]:
+            keys.append(('_id', self.direction))
+        return keys
+
+    def cursor(self, document) -> str:
+        if self.field == '_id':
+            return document.id
+        value = getattr(document, self.field)
+        return base64.urlsafe_b64encode(json.dumps([value, document.id]).encode('utf8')).decode('ascii')
+
+    def after_criteria(self, cursor: str) -> Dict[str, Any]:
+        """
+        Criteria matching the documents which come after cursor in this order.
+
+        Raises InvalidId if cursor was not made by this sort. Missing values sort first, like they do in mongodb.
+        """
+        op = '$gt' if self.direction == pymongo.ASCENDING else '$lt'
+        if self.field == '_id':
+            return {'_id': {op: ObjectId(cursor)}}
+
+        try:
+            value, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+        except (ValueError, TypeError, binascii.Error):
+            raise InvalidId("%r is not a valid cursor" % cursor)
+
+        if SORT_FIELDS[self.field]:
+            return {self.field: {op: value}}
+
+        tie = {self.field: value, '_id': {op: ObjectId(id)}}
+        if value is None:
+            if self.direction == pymongo.ASCENDING:
+                return {'$or': [tie, {self.field: {'$ne': None}}]}
+            return tie
+
+        beyond = [{self.field: {op: value}}]
+        if self.direction == pymongo.DESCENDING:
+            beyond.append({self.field: None})
+        return {'$or': beyond + [tie]}
+
+
+@attrs(slots=True, auto_attribs=True)
+class QueryPlan:
+    """
+    The index a query would use, None for a collection scan, and whether mongodb would have to sort in memory.
+    """
+    index: Optional[Index]
+    blocking_sort: bool = False
+
+    @property
+    def collection_scan(self) -> bool:
+        return self.index is None
+
+
+class QueryPlanError(Exception):
+    """
+    Raised by DocumentRepo.find for a filter and sort which would scan the whole collection.
+    """
+
+
+def provides_sort(index: Index, equality: Set[str], sort: DocumentSort) -> bool:
+    """
+    Whether walking index yields documents in sort order once the equality fields are fixed.
+    """
+    fields = index.fields
+    n = 0
+    while n < len(fields) and fields[n] in equality:
+        n += 1
+    sort_fields = [field for field, _ in sort.keys()]
+    return fields[n:n + len(sort_fields)] == sort_fields
+
+
+def plan(filter: Optional[DocumentFilter],
+         sort: Optional[DocumentSort],
+         indexes: Optional[Iterable[Index]]=None) -> QueryPlan:
+    """
+    Pick the index for a query, preferring one which both bounds the scan and provides the sort order.
+
+    An index bounds the scan when it starts with a filtered field, any index does when there is no filter.
+    indexes defaults to INDEXES.
+    """
+    filter = filter or DocumentFilter()
+    sort = sort or DocumentSort()
+    equality = filter.equality_fields()
+    filtered = equality | filter.range_fields()
+    candidates = [ID_INDEX] + list(INDEXES if indexes is None else indexes)
+
+    bounded = [index for index in candidates if not filtered or index.fields[0] in filtered]
+    for index in bounded:
+        if provides_sort(index, equality, sort):
+            return QueryPlan(index)
+
+    if bounded:
+        return QueryPlan(bounded[0], blocking_sort=True)
+    return QueryPlan(None)
+
+
+__all__ = [
+    'SORT_FIELDS',
+    'Index',
+    'INDEXES',
+    'DocumentFilter',
+    'DocumentSort',
+    'QueryPlan',
+    'QueryPlanError',
+    'plan'
+]
@@ -15,11 +15,45 @@ try:
 except ImportError:
     import schema
 
+try:
+    from . import lazy
+except ImportError:
+    import lazy
+
+try:
+    from . import query
+except ImportError:
+    import query
+
+try:
+    from .indexes import IndexReconciler
+except ImportError:
+    from indexes import IndexReconciler
+
+try:
+    from . import tracing
+except ImportError:
+    import tracing
+
+try:
+    from .outbox import RetryTransaction
+except ImportError:
+    from outbox import RetryTransaction
+
 from typing import *
 from bson import ObjectId, Decimal128
 from pymongo import ReturnDocument
 import pymongo.errors
 from bson.errors import InvalidId
+from contextlib import nullcontext
+import logging
+
+
+DUPLICATE_KEY_ERROR = 11000
+
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
 
 
 def munge_object(v):
@@ -52,6 +86,64 @@ def munge_dict(d):
     return {k: munge_object(v) for k, v in d.items()}
 
 
+@attrs(slots=True, frozen=True, auto_attribs=True)
+class Slice:
+    """
+    Asks make_projection for limit items of an array field from position skip on, instead of all of them.
+    """
+    field: str
+    limit: int
+    skip: int = 0
+
+
+# asks make_projection for the number of child fields, loaded into model.Document.child_field_count
+CHILD_FIELD_COUNT = 'child_field_count'
+
+
+def make_projection(fields: Optional[Iterable[Union[str, Slice]]]) -> Optional[Dict[str, Any]]:
+    """
+    Turn a list of document field names into a mongodb projection, None meaning the whole document.
+
+    name is always included since model.Document can not be built without it, fields which are left out are
+    loaded with their model defaults. A Slice loads part of an array with $slice unless the whole field is asked
+    for as well, slices of the same field load the range which covers all of them. A range which does not start
+    at the first item also loads its start as the field name plus _offset, i.e. model.Document.child_field_offset.
+    A Slice of no items loads nothing, mongodb rejects a $slice whose limit is not positive.
+    CHILD_FIELD_COUNT is computed with $size, which like the offset needs mongodb 4.4 or later.
+    """
+    if fields is None:
+        return None
+
+    projection = {}
+    # field -> (start, end) of the items to load
+    ranges = {}
+    for field in fields:
+        if isinstance(field, Slice):
+            if field.limit <= 0:
+                continue
+            start, end = ranges.get(field.field, (field.skip, field.skip + field.limit))
+            ranges[field.field] = (min(start, field.skip), max(end, field.skip + field.limit))
+        elif field == CHILD_FIELD_COUNT:
+            projection[field] = {'$size': {'$ifNull': ['$child_field', []]}}
+        else:
+            projection[field] = True
+
+    for field, (start, end) in ranges.items():
+        if field not in projection:
+            if start > 0:
+                projection[field] = {'$slice': [start, end - start]}
+                projection[field + '_offset'] = {'$literal': start}
+            else:
+                projection[field] = {'$slice': end}
+
+    projection['name'] = True
+    return projection
+
+
+def is_sliced(fields: Optional[Iterable[Union[str, Slice]]]) -> bool:
+    return fields is not None and any(isinstance(field, Slice) for field in fields)
+
+
 class RepoError(Exception):
     def __init__(self, errors: Dict[str, List[str]]):
         super(RepoError, self).__init__()
@@ -61,68 +153,436 @@ class RepoError(Exception):
 @attrs(slots=True, auto_attribs=True)
 class DocumentRepo(EventEmitter):
     collection: Any = Factory(lambda: None)
+    # decoder with a load() like schema.Document's which takes raw mongodb documents, i.e. codec.Document.
+    # None decodes through munge_object and marshmallow.
+    codec: Any = Factory(lambda: None)
+    # read queries return lazy.LazyDocument views over RawBSONDocuments instead of model.Document
+    raw_bson: bool = False
+    # optional cache.DocumentCache in front of find_by_id and find_by_ids, refreshed from the emitted events.
+    # Reads of a Slice go around it, a cached whole document would not have the positions of the sliced items.
+    cache: Any = Factory(lambda: None)
+    # what find does with a filter and sort no index can serve: 'reject' raises a QueryPlanError, 'warn' runs it
+    collection_scans: str = 'reject'
+    # the indexes check_indices makes sure the collection has
+    indexes: List[query.Index] = Factory(lambda: list(query.INDEXES))
+    index_reconciler: Optional[IndexReconciler] = Factory(lambda: None)
+    # optional outbox.Outbox the events are recorded in along with the writes, for relaying to a message broker
+    outbox: Any = Factory(lambda: None)
+
+    def __attrs_post_init__(self):
+        if self.cache is not None:
+            self.cache.attach(self)
 
-    def check_indices(self):
+    async def check_indices(self, background: bool=True):
         """
-        Confirm all the database indices are as they should be.
+        Compare the collection's indexes with indexes and build the missing ones, returning an indexes.IndexDrift.
+
+        With background the builds carry on after this returns, queries which need an index that is not built yet
+        are planned as collection scans until it is.
+        """
+        self.index_reconciler = IndexReconciler(self.collection, self.indexes)
+        return await self.index_reconciler.reconcile(background)
+
+    async def _write(self, write: Callable[[Dict[str, Any]], Awaitable[T]]) -> T:
         """
-        try:
-            self.collection.create_index(
-                [("name", pymongo.DESCENDING)],
-                unique=True
+        Await write(options), options holding the keyword arguments for its collection calls.
+
+        The outbox may run write in a transaction, and again in a new one after a transient error, so it starts
+        from scratch every time and leaves publishing to after it returned.
+        """
+        if self.outbox is None:
+            return await write({})
+        return await self.outbox.run(write)
+
+    async def _record(self, events: List[Tuple[str, model.Document]], options: Dict[str, Any]) -> None:
+        if self.outbox is not None:
+            await self.outbox.add(events, **options)
+
+    def _check_plan(self, filter: Optional[query.DocumentFilter], sort: Optional[query.DocumentSort]) -> None:
+        """
+        Raise a QueryPlanError for a collection scan, or log it if collection_scans is 'warn'. In memory sorts are
+        only logged.
+        """
+        indexes = self.indexes if self.index_reconciler is None else self.index_reconciler.usable_indexes()
+        plan = query.plan(filter, sort, indexes)
+        if plan.collection_scan:
+            if self.collection_scans == 'reject':
+                raise query.QueryPlanError(
+                    "No index for filter %r sorted by %r, the whole collection would be scanned" % (filter, sort)
+                )
+            # the filter and sort come from requests, they are arguments so the message stays the same
+            logger.warning("No index for filter %r sorted by %r, scanning the whole collection", filter, sort)
+        elif plan.blocking_sort:
+            logger.warning(
+                "Index %r does not provide the order of %r, matching documents are sorted in memory",
+                plan.index.fields,
+                sort
             )
-        except pymongo.errors.DuplicateKeyError as err:
-            pass
 
+    @tracing.traced
     def _create_from_document(self, document):
-        munged = munge_object(document)
-        result, errors = schema.Document.load(munged)
+        if self.codec is not None:
+            result, errors = self.codec.load(document)
+        else:
+            with tracing.span('munge_object'):
+                document = munge_object(document)
+            with tracing.span('schema.Document.load'):
+                result, errors = schema.Document.load(document)
         assert(not errors)
         return result
 
-    async def find_by_id(self, id: str) -> Optional[model.Document]:
+    def _reader(self):
+        """
+        The collection used for read queries, returning RawBSONDocuments in raw_bson mode.
+        """
+        if self.raw_bson:
+            return self.collection.with_options(codec_options=lazy.RAW_BSON_CODEC_OPTIONS)
+        return self.collection
+
+    def _create_from_read(self, document):
+        if self.raw_bson:
+            return lazy.LazyDocument(document)
+        return self._create_from_document(document)
+
+    @staticmethod
+    def _filling(cache, ids: List[str]):
+        """
+        cache.reading(ids), or a fill which does nothing without a cache.
+        """
+        if cache is None:
+            return nullcontext(lambda document: None)
+        return cache.reading(ids)
+
+    @tracing.traced
+    async def find_by_id(self, id: str, fields: Optional[Iterable[str]]=None) -> Optional[model.Document]:
         """
         Can raise an InvalidId error if id is not a valid ObjectId
+
+        fields limits the document fields loaded from mongodb, see make_projection. With a cache fields are
+        ignored, the whole document is loaded on a miss and cached since a cached document is good for any fields.
+        Fields with a Slice are always loaded from mongodb and not cached.
+        """
+        object_id = ObjectId(id)
+        cache = None if is_sliced(fields) else self.cache
+
+        if cache is not None:
+            result = cache.get(str(object_id))
+            if result is not None:
+                return result
+            fields = None
+
+        with self._filling(cache, [str(object_id)]) as fill:
+            document = await self._reader().find_one({'_id': object_id}, make_projection(fields))
+            if document is None:
+                return None
+            result = self._create_from_read(document)
+            fill(result)
+        return result
+
+    @tracing.traced
+    async def find_by_ids(self,
+                          ids: List[str],
+                          fields: Optional[Iterable[str]]=None) -> Dict[str, model.Document]:
+        """
+        Fetch several documents with a single query, keyed by id. Ids which could not be found are left out.
+
+        Can raise an InvalidId error if any of the ids is not a valid ObjectId
+
+        fields is treated as in find_by_id, with a cache only the misses are fetched, as whole documents.
+        """
+        object_ids = {ObjectId(id) for id in ids}
+        results = {}
+        cache = None if is_sliced(fields) else self.cache
+
+        if cache is not None:
+            for object_id in list(object_ids):
+                result = cache.get(str(object_id))
+                if result is not None:
+                    results[result.id] = result
+                    object_ids.discard(object_id)
+
+            if not object_ids:
+                return results
+            fields = None
+
+        query = {'_id': {'$in': list(object_ids)}}
+        with self._filling(cache, [str(object_id) for object_id in object_ids]) as fill:
+            async for document in self._reader().find(query, make_projection(fields)):
+                result = self._create_from_read(document)
+                results[result.id] = result
+                fill(result)
+        return results
+
+    @tracing.traced
+    async def find(self,
+                   criteria=None,
+                   limit: Optional[int]=None,
+                   after: Optional[str]=None,
+                   fields: Optional[Iterable[str]]=None,
+                   filter: Optional[query.DocumentFilter]=None,
+                   sort: Optional[query.DocumentSort]=None) -> Iterator[model.Document]:
         """
-        document = await self.collection.find_one({'_id': ObjectId(id)})
-        return self._create_from_document(document) if document is not None else None
+        Iterate over the documents matching criteria and filter in sort order, _id order by default.
 
-    async def find(self, criteria=None) -> Iterator[model.Document]:
-        criteria = criteria or {}
-        async for document in self.collection.find(criteria):
-            yield self._create_from_document(document)
+        limit caps the number of documents the cursor will fetch, after is the cursor of the last document of the
+        previous page, see query.DocumentSort.cursor. Can raise an InvalidId error if after is not a valid cursor,
+        or a QueryPlanError if no index can serve filter and sort.
 
+        fields limits the document fields loaded from mongodb, see make_projection. The sort field is always loaded
+        so the cursors of the results can be made.
+        """
+        if filter is not None or sort is not None:
+            self._check_plan(filter, sort)
+        sort = sort or query.DocumentSort()
+
+        criteria = query.combine(
+            dict(criteria or {}),
+            filter.to_criteria() if filter is not None else {},
+            sort.after_criteria(after) if after is not None else {}
+        )
+
+        if fields is not None and sort.field != '_id':
+            fields = set(fields) | {sort.field}
+
+        cursor = self._reader().find(
+            criteria,
+            make_projection(fields),
+            sort=sort.keys(),
+            limit=limit or 0
+        )
+        async for document in cursor:
+            yield self._create_from_read(document)
+
+    @tracing.traced
     async def create(self,
                      name: str,
                      age: Optional[int]=None,
                      archived: Optional[bool]=None,
                      child_field: Optional[List]=None) -> model.Document:
-        document = model.Document(name=name, age=age, archived=archived, child_field=child_field or [])
-        try:
-            res = await self.collection.insert_one(document.to_bson())
-        except pymongo.errors.DuplicateKeyError:
-            raise RepoError({'name': ['already exists']})
-
-        result = await self.find_by_id(str(res.inserted_id))
-        self.emit("DocumentCreated", result)
+        """
+        Insert a new document and return it.
+
+        The result is decoded from the data that was inserted rather than read back from mongodb, there are no
+        server side defaults to pick up. Decoding coerces the input the same way a read would, i.e. an archived of
+        "false" comes back as False.
+        """
+        data = model.Document(name=name, age=age, archived=archived, child_field=child_field or []).to_bson()
+        result = self._create_from_document(data)
+
+        async def write(options):
+            try:
+                await self.collection.insert_one(data, **options)
+            except pymongo.errors.DuplicateKeyError:
+                raise RepoError({'name': ['already exists']})
+            await self._record([("DocumentCreated", result)], options)
+
+        await self._write(write)
+        await self.publish("DocumentCreated", result)
+        return result
+
+    @tracing.traced
+    async def create_many(self, documents: Iterable[Dict[str, Any]]) -> List[Union[model.Document, RepoError]]:
+        """
+        Insert several documents with one unordered insert_many, documents holding the keyword arguments of create.
+
+        Returns one entry per document in the same order, the created document or the RepoError it failed with.
+        A failed document does not stop the others from being inserted.
+        """
+        data = [
+            model.Document(
+                name=document['name'],
+                age=document.get('age'),
+                archived=document.get('archived'),
+                child_field=document.get('child_field') or []
+            ).to_bson()
+            for document in documents
+        ]
+        if not data:
+            return []
+
+        results = [self._create_from_document(document) for document in data]
+
+        async def write(options):
+            # a write error aborts a transaction, which then runs again without the documents that failed
+            indices = [index for index, result in enumerate(results) if not isinstance(result, RepoError)]
+            if not indices:
+                return []
+            try:
+                await self.collection.insert_many([data[index] for index in indices], ordered=False, **options)
+            except pymongo.errors.BulkWriteError as err:
+                for write_error in err.details.get('writeErrors', []):
+                    if write_error.get('code') == DUPLICATE_KEY_ERROR:
+                        error = RepoError({'name': ['already exists']})
+                    else:
+                        error = RepoError({'document': [write_error.get('errmsg', 'not created')]})
+                    results[indices[write_error['index']]] = error
+                if 'session' in options:
+                    raise RetryTransaction() from err
+
+            created = [result for result in results if not isinstance(result, RepoError)]
+            await self._record([("DocumentCreated", result) for result in created], options)
+            return created
+
+        created = await self._write(write)
+        for result in created:
+            await self.publish("DocumentCreated", result)
+        return results
+
+    @tracing.traced
+    async def _update(self, criteria, update) -> Optional[model.Document]:
+        """
+        Apply update to the document matching criteria in a single find_one_and_update round trip.
+
+        Returns the updated document, or None if nothing matched criteria.
+        """
+        async def write(options):
+            document = await self.collection.find_one_and_update(
+                criteria,
+                update,
+                return_document=ReturnDocument.AFTER,
+                **options
+            )
+            if document is None:
+                return None
+
+            result = self._create_from_document(document)
+            await self._record([('DocumentSaved', result)], options)
+            return result
+
+        result = await self._write(write)
+        if result is None:
+            return None
+
+        await self.publish('DocumentSaved', result)
+
+        return result
+
+    async def _update_child_field(self,
+                                  document_id: ObjectId,
+                                  child_field_id: str,
+                                  update: Callable[[ObjectId], Dict[str, Any]]) -> Optional[model.Document]:
+        """
+        Like _update but only matches when the document has a child field with child_field_id, update building the
+        update from its ObjectId.
+
+        Raises a KeyError if the document exists but the child field does not, which costs an extra round trip
+        on that error path only. A missing document is reported first, by returning None.
+        """
+        result = None
+        if ObjectId.is_valid(child_field_id):
+            child_field_object_id = ObjectId(child_field_id)
+            result = await self._update(
+                {'_id': document_id, 'child_field._id': child_field_object_id},
+                update(child_field_object_id)
+            )
+
+        if result is None and await self.collection.count_documents({'_id': document_id}, limit=1):
+            raise KeyError("Could not find child field with id %s" % child_field_id)
+
         return result
 
+    async def set_archived(self, id: str, archived: bool) -> Optional[model.Document]:
+        """
+        Can raise an InvalidId error if id is not a valid ObjectId
+        """
+        return await self._update({'_id': ObjectId(id)}, {'$set': {'archived': archived}})
+
+    @tracing.traced
+    async def set_archived_many(self, ids: List[str], archived: bool) -> List[Union[model.Document, RepoError]]:
+        """
+        Set archived on several documents with one update_many, then read them back with one find.
+
+        Returns one entry per id in the same order, the updated document or a RepoError for ids which are invalid
+        or could not be found.
+        """
+        object_ids = {}
+        for id in ids:
+            if ObjectId.is_valid(id):
+                object_ids[id] = ObjectId(id)
+
+        updated = {}
+        if object_ids:
+            criteria = {'_id': {'$in': list(set(object_ids.values()))}}
+
+            async def write(options):
+                await self.collection.update_many(criteria, {'$set': {'archived': archived}}, **options)
+
+                updated = {}
+                async for document in self.collection.find(criteria, **options):
+                    result = self._create_from_document(document)
+                    updated[result.id] = result
+                await self._record([('DocumentSaved', result) for result in updated.values()], options)
+                return updated
+
+            updated = await self._write(write)
+            for result in updated.values():
+                await self.publish('DocumentSaved', result)
+
+        results = []
+        for id in ids:
+            if id not in object_ids:
+                results.append(RepoError({'id': ['invalid']}))
+            elif str(object_ids[id]) not in updated:
+                results.append(RepoError({'id': ['not found']}))
+            else:
+                results.append(updated[str(object_ids[id])])
+        return results
+
+    async def add_child_field(self, id: str, child_field: model.ChildField) -> Optional[model.Document]:
+        """
+        Can raise an InvalidId error if id is not a valid ObjectId
+        """
+        return await self._update({'_id': ObjectId(id)}, {'$push': {'child_field': child_field.to_bson()}})
+
+    async def remove_child_field(self, id: str, child_field_id: str) -> Optional[model.Document]:
+        """
+        Can raise an InvalidId error if id is not a valid ObjectId, or a KeyError if there is no such child field
+        """
+        return await self._update_child_field(
+            ObjectId(id),
+            child_field_id,
+            lambda child_field_id: {'$pull': {'child_field': {'_id': child_field_id}}}
+        )
+
+    async def update_child_field(self, id: str, child_field: model.ChildField) -> Optional[model.Document]:
+        """
+        Replace the child field with the same id as child_field.
+
+        Can raise an InvalidId error if id is not a valid ObjectId, or a KeyError if there is no such child field
+        """
+        return await self._update_child_field(
+            ObjectId(id),
+            child_field.id,
+            lambda child_field_id: {'$set': {'child_field.$': child_field.to_bson()}}
+        )
+
+    @tracing.traced
     async def save(self, document: model.Document) -> None:
         data = document.to_bson()
-        document = await self.collection.find_one_and_replace(
-            {'_id': data.pop('_id')},
-            data,
-            return_document=ReturnDocument.AFTER
-        )
+        id = data.pop('_id')
+
+        async def write(options):
+            document = await self.collection.find_one_and_replace(
+                {'_id': id},
+                data,
+                return_document=ReturnDocument.AFTER,
+                **options
+            )
 
-        result = self._create_from_document(document)
+            result = self._create_from_document(document)
+            await self._record([('DocumentSaved', result)], options)
+            return result
 
-        self.emit('DocumentSaved', result)
+        result = await self._write(write)
+        await self.publish('DocumentSaved', result)
 
         return result
 
 
 __all__ = [
+    'Slice',
+    'CHILD_FIELD_COUNT',
+    'make_projection',
     'RepoError',
     'InvalidId',
     'DocumentRepo'
@@ -0,0 +1,197 @@
+import unittest
+from hypothesis import given, settings
+import hypothesis.strategies as st
+from . import strategies
+
+from model import model, bulk
+
+from attr import attrs, Factory
+from bson import ObjectId
+from typing import *
+import pymongo.errors
+import asyncio
+import gzip
+import io
+import json
+import os
+import tempfile
+
+
+@attrs(slots=True, auto_attribs=True)
+class MockCollection:
+    data: List[Any] = Factory(list)
+    calls: List[Any] = Factory(list)
+    fail: Set[Any] = Factory(set)
+    # ids whose batch fails as a whole, like a lost connection would
+    crash: Set[Any] = Factory(set)
+
+    async def find(self, criteria={}, sort=None, batch_size=0):
+        self.calls.append(('find', criteria, batch_size))
+        data = sorted(self.data, key=lambda d: d['_id'])
+        if '_id' in criteria:
+            data = [d for d in data if d['_id'] > criteria['_id']['$gt']]
+        for d in data:
+            yield d
+
+    async def find_one(self, criteria, projection=None, sort=None):
+        return max(self.data, key=lambda d: d['_id'], default=None)
+
+    async def bulk_write(self, operations, ordered=True):
+        self.calls.append(('bulk_write', len(operations), ordered))
+        await asyncio.sleep(0)
+        if any(operation._doc['_id'] in self.crash for operation in operations):
+            raise pymongo.errors.AutoReconnect('connection lost')
+        errors = []
+        for index, operation in enumerate(operations):
+            document = operation._doc
+            if document['_id'] in self.fail:
+                errors.append({'index': index, 'errmsg': 'duplicate key'})
+                continue
+            self.data = [d for d in self.data if d['_id'] != document['_id']] + [document]
+        if errors:
+            raise pymongo.errors.BulkWriteError({'writeErrors': errors})
+
+
+def dump(documents):
+    return [json.dumps(bulk.munge_object(d.to_bson()), default=str) + '\n' for d in documents]
+
+
+class TestProgress(unittest.TestCase):
+    def test_reports_at_interval(self):
+        now = [0.0]
+        out = io.StringIO()
+        progress = bulk.Progress('export', interval=1.0, out=out, clock=lambda: now[0])
+
+        progress.advance(10, 'a')
+        now[0] = 0.5
+        progress.advance(10, 'b')
+        self.assertEqual(out.getvalue(), '')
+
+        now[0] = 2.0
+        progress.advance(20, 'c')
+        self.assertEqual(out.getvalue(), 'export: 40 documents, 20 documents/s, last _id c\n')
+
+
+class TestExport(unittest.TestCase):
+    @given(st.lists(st.from_type(model.Document), unique_by=lambda d: d.id))
+    def test_export_in_id_order(self, documents):
+        async def run_test():
+            collection = MockCollection([d.to_bson() for d in documents])
+            out = io.StringIO()
+            count = await bulk.export_documents(collection, out, batch_size=5)
+
+            ordered = sorted(documents, key=lambda d: ObjectId(d.id))
+            self.assertEqual(count, len(documents))
+            self.assertEqual(out.getvalue(), ''.join(dump(ordered)))
+            self.assertEqual(collection.calls, [('find', {}, 5)])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    @given(st.lists(st.from_type(model.Document), min_size=1, unique_by=lambda d: d.id))
+    def test_export_after(self, documents):
+        async def run_test():
+            ordered = sorted(documents, key=lambda d: ObjectId(d.id))
+            collection = MockCollection([d.to_bson() for d in documents])
+            out = io.StringIO()
+            count = await bulk.export_documents(collection, out, after=ordered[0].id)
+
+            self.assertEqual(count, len(documents) - 1)
+            self.assertEqual(out.getvalue(), ''.join(dump(ordered[1:])))
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_truncate_export(self):
+        ids = [str(ObjectId()) for _ in range(4)]
+        lines = ''.join(json.dumps({'_id': i}) + '\n' for i in ids[:2])
+        with tempfile.TemporaryDirectory() as directory:
+            for name, open_file in [('documents.ndjson.gz', gzip.open), ('documents.ndjson', open)]:
+                path = os.path.join(directory, name)
+                self.assertEqual(bulk.truncate_export(path), None)
+
+                with open_file(path, 'wt', encoding='utf8') as f:
+                    f.write(lines)
+                self.assertEqual(bulk.truncate_export(path), ids[1])
+
+                # an interrupted write leaves a partial last line
+                with open_file(path, 'at', encoding='utf8') as f:
+                    f.write(json.dumps({'_id': ids[2]})[:10])
+                self.assertEqual(bulk.truncate_export(path), ids[1])
+
+                # so a resumed export appends right after the last complete line
+                with bulk.open_ndjson(path, 'a') as f:
+                    f.write(json.dumps({'_id': ids[3]}) + '\n')
+                with bulk.open_ndjson(path, 'r') as f:
+                    self.assertEqual([json.loads(line)['_id'] for line in f], ids[:2] + ids[3:])
+
+    def test_truncate_cut_gzip_member(self):
+        ids = [str(ObjectId()) for _ in range(3)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'documents.ndjson.gz')
+            with gzip.open(path, 'wt', encoding='utf8') as f:
+                f.write(''.join(json.dumps({'_id': i}) + '\n' for i in ids[:2]))
+            # a resumed run whose gzip member was cut short
+            member = gzip.compress((json.dumps({'_id': ids[2]}) + '\n').encode('utf8'))
+            with open(path, 'ab') as f:
+                f.write(member[:len(member) // 2])
+
+            self.assertEqual(bulk.truncate_export(path), ids[1])
+            with bulk.open_ndjson(path, 'r') as f:
+                self.assertEqual([json.loads(line)['_id'] for line in f], ids[:2])
+
+
+class TestImport(unittest.TestCase):
+    @settings(deadline=None)
+    @given(st.lists(st.from_type(model.Document), unique_by=lambda d: d.id), st.integers(min_value=1, max_value=4))
+    def test_round_trip(self, documents, batch_size):
+        async def run_test():
+            collection = MockCollection()
+            stats = await bulk.import_documents(collection, dump(documents), batch_size=batch_size, concurrency=2)
+
+            self.assertEqual(stats, bulk.ImportStats(written=len(documents)))
+            self.assertEqual(
+                sorted(collection.data, key=lambda d: d['_id']),
+                sorted([d.to_bson() for d in documents], key=lambda d: d['_id'])
+            )
+            writes = [c for c in collection.calls if c[0] == 'bulk_write']
+            self.assertTrue(all(size <= batch_size and not ordered for _, size, ordered in writes))
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_invalid_skipped_and_failed(self):
+        async def run_test():
+            documents = sorted([model.Document(name=str(i), id=str(ObjectId())) for i in range(4)],
+                               key=lambda d: ObjectId(d.id))
+            collection = MockCollection(fail={ObjectId(documents[3].id)})
+            lines = dump(documents[:2]) + ['not json\n', '\n', '{"name": 1}\n'] + dump(documents[2:])
+
+            stats = await bulk.import_documents(collection, lines, after=documents[0].id, batch_size=2)
+
+            self.assertEqual(stats, bulk.ImportStats(written=2, invalid=2, skipped=1, failed=1))
+            self.assertEqual({d['_id'] for d in collection.data}, {ObjectId(documents[1].id), ObjectId(documents[2].id)})
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_resume_from_checkpoint(self):
+        async def run_test():
+            documents = sorted([model.Document(name=str(i), id=str(ObjectId())) for i in range(6)],
+                               key=lambda d: ObjectId(d.id), reverse=True)
+            lines = dump(documents[:2]) + ['not json\n'] + dump(documents[2:])
+
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'documents.ndjson.checkpoint')
+                # the second of three batches is lost while the third, with lower _ids, gets written
+                collection = MockCollection(crash={ObjectId(documents[2].id)})
+                with self.assertRaises(pymongo.errors.AutoReconnect):
+                    await bulk.import_documents(collection, lines, batch_size=2, concurrency=3,
+                                                checkpoint=bulk.Checkpoint(path))
+                self.assertEqual(bulk.Checkpoint.load(path).lines, 2)
+
+                collection.crash.clear()
+                stats = await bulk.import_documents(collection, lines, batch_size=2,
+                                                    checkpoint=bulk.Checkpoint.load(path))
+
+                self.assertEqual(stats, bulk.ImportStats(written=4, invalid=1, skipped=2))
+                self.assertEqual({d['_id'] for d in collection.data}, {ObjectId(d.id) for d in documents})
+                self.assertEqual(bulk.Checkpoint.load(path).lines, len(lines))
+
+        asyncio.get_event_loop().run_until_complete(run_test())
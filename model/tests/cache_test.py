@@ -0,0 +1,152 @@
+import unittest
+from hypothesis import given
+import hypothesis.strategies as st
+from . import strategies
+
+from model import model, repo
+from model.cache import LRUCache, DocumentCache
+from model.memory import MemoryCollection
+from .repo_test import MockCollection
+
+from attr import attrs
+from bson import ObjectId
+import asyncio
+
+
+@attrs(slots=True, auto_attribs=True)
+class FakeClock:
+    now: float = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SlowCollection(MemoryCollection):
+    """
+    Holds reads until released.
+    """
+    __slots__ = ('released',)
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.released = asyncio.Event()
+
+    async def find_one(self, criteria, projection=None):
+        await self.released.wait()
+        return await MemoryCollection.find_one(self, criteria, projection)
+
+    async def find(self, criteria, projection=None, sort=None, limit=0):
+        await self.released.wait()
+        async for document in MemoryCollection.find(self, criteria, projection, sort, limit):
+            yield document
+
+
+class TestLRUCache(unittest.TestCase):
+    @given(st.lists(st.integers(min_value=0, max_value=20)), st.integers(min_value=1, max_value=5))
+    def test_bounded(self, keys, maxsize):
+        cache = LRUCache(maxsize=maxsize)
+        for key in keys:
+            cache.set(key, key)
+
+        # the most recently set keys survive
+        recent = list(dict.fromkeys(reversed(keys)))[:maxsize]
+        self.assertEqual(set(cache.entries), set(recent))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1})
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = LRUCache(ttl=10, clock=clock)
+        cache.set('a', 1)
+
+        clock.now = 9.9
+        self.assertEqual(cache.get('a'), 1)
+        clock.now = 10
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats(), {'size': 0, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+
+class TestDocumentCache(unittest.TestCase):
+    @given(st.from_type(model.Document))
+    def test_read_through(self, document):
+        async def run_test():
+            collection = MockCollection([document.to_bson()], None)
+            cache = DocumentCache()
+            document_repo = repo.DocumentRepo(collection=collection, cache=cache)
+
+            self.assertEqual(await document_repo.find_by_id(document.id), document)
+            self.assertEqual(await document_repo.find_by_id(document.id), document)
+            self.assertEqual(await document_repo.find_by_ids([document.id]), {document.id: document})
+            self.assertEqual([c[0] for c in collection.calls], ['find_one'])
+            self.assertEqual(cache.stats()['hits'], 2)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    @given(st.from_type(model.Document))
+    def test_projected_reads_fill_the_cache(self, document):
+        async def run_test():
+            collection = MemoryCollection.of([document])
+            cache = DocumentCache()
+            document_repo = repo.DocumentRepo(collection=collection, cache=cache)
+
+            # a miss loads the whole document whatever fields are asked for, so it can serve any fields later
+            self.assertEqual(await document_repo.find_by_id(document.id, fields=['age']), document)
+            self.assertEqual(await document_repo.find_by_ids([document.id], fields=['name']), {document.id: document})
+            self.assertEqual(cache.stats(), {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    @given(st.from_type(model.Document))
+    def test_refreshed_on_save(self, document):
+        archived = model.Document(document.name, document.age, not document.archived, document.child_field,
+                                  document.id)
+
+        async def run_test():
+            collection = MockCollection([document.to_bson()], archived.to_bson())
+            document_repo = repo.DocumentRepo(collection=collection, cache=DocumentCache())
+
+            await document_repo.find_by_id(document.id)
+            await document_repo.set_archived(document.id, archived.archived)
+
+            self.assertEqual(await document_repo.find_by_id(document.id), archived)
+            self.assertEqual([c[0] for c in collection.calls], ['find_one', 'find_one_and_update'])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_store_during_read_is_not_overwritten(self):
+        document = model.Document(name='Luke', age=18)
+        saved = model.Document(name='Luke', age=19, id=document.id)
+
+        async def run_test(read):
+            collection = SlowCollection({ObjectId(document.id): document.to_bson()})
+            cache = DocumentCache()
+            document_repo = repo.DocumentRepo(collection=collection, cache=cache)
+
+            pending = asyncio.ensure_future(read(document_repo))
+            await asyncio.sleep(0)
+            # a save in this worker reaches the cache through the DocumentSaved listener
+            cache.store(saved)
+            collection.released.set()
+            await pending
+
+            self.assertEqual(cache.get(document.id), saved)
+            self.assertEqual(cache.reads, {})
+
+            # reads which start after the save fill the cache again
+            cache.clear()
+            await read(document_repo)
+            self.assertEqual(cache.get(document.id), document)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(run_test(lambda document_repo: document_repo.find_by_id(document.id)))
+        loop.run_until_complete(run_test(lambda document_repo: document_repo.find_by_ids([document.id])))
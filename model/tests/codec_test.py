@@ -0,0 +1,62 @@
+import unittest
+from hypothesis import given
+import hypothesis.strategies as st
+from . import strategies
+
+from model import model, codec, schema
+from model.repo import munge_object
+
+from bson import ObjectId, Decimal128
+
+
+class TestCodec(unittest.TestCase):
+    @given(st.from_type(model.Document))
+    def test_load_matches_schema(self, document):
+        bson = document.to_bson()
+
+        result, errors = codec.Document.load(bson)
+        expected, expected_errors = schema.Document.load(munge_object(bson))
+
+        self.assertEqual(errors, {})
+        self.assertEqual(expected_errors, {})
+        self.assertEqual(result, expected)
+        self.assertEqual(result, document)
+
+    @given(st.from_type(model.Document), st.sampled_from(['age', 'archived', 'child_field']))
+    def test_load_partial_document(self, document, missing):
+        bson = document.to_bson()
+        del bson[missing]
+
+        result, errors = codec.Document.load(bson)
+        expected, expected_errors = schema.Document.load(munge_object(bson))
+
+        self.assertEqual(errors, {})
+        self.assertEqual(result, expected)
+
+    def test_load_coerces_like_schema(self):
+        data = {'_id': ObjectId(), 'name': 'Yoda', 'age': Decimal128('900'), 'archived': 'true'}
+
+        result, errors = codec.Document.load(data)
+        expected, expected_errors = schema.Document.load(munge_object(data))
+
+        self.assertEqual(errors, {})
+        self.assertEqual(result, expected)
+        self.assertEqual((result.age, result.archived), (900, True))
+
+    def test_load_invalid(self):
+        cases = [
+            {'age': 1},
+            {'name': None},
+            {'name': 5},
+            {'name': 'Yoda', 'age': 'old'},
+            {'name': 'Yoda', 'child_field': None},
+            {'name': 'Yoda', 'child_field': ['not a child field']},
+            {'name': 'Yoda', 'child_field': [{'_id': ObjectId(), 'date': {'month': 'May', 'year': 2010}}]},
+        ]
+
+        for data in cases:
+            result, errors = codec.Document.load(data)
+            expected, expected_errors = schema.Document.load(munge_object(data))
+
+            self.assertIsNone(result)
+            self.assertEqual(set(errors), set(expected_errors), data)
@@ -0,0 +1,140 @@
+import unittest
+import asyncio
+
+from model import model, repo
+from model.eventemitter import Dispatcher, Event, EventEmitter
+from model.memory import MemoryCollection
+
+
+class TestEventEmitter(unittest.TestCase):
+    def test_inline(self):
+        emitter = EventEmitter()
+        seen = []
+        emitter.on('DocumentSaved', seen.append)
+        emitter.emit('DocumentSaved', 1)
+        emitter.off('DocumentSaved', seen.append)
+        emitter.emit('DocumentSaved', 2)
+
+        self.assertEqual(seen, [1])
+        self.assertIsNone(emitter.dispatcher)
+
+    def test_deferred(self):
+        emitter = EventEmitter()
+        seen, batches = [], []
+
+        async def listener(value, extra=None):
+            await asyncio.sleep(0)
+            seen.append((value, extra))
+
+        emitter.on('DocumentSaved', listener)
+        emitter.on('DocumentSaved', batches.append, batch=True)
+
+        async def run_test():
+            emitter.emit('DocumentSaved', 1, extra='a')
+            await emitter.publish('DocumentSaved', 2)
+            self.assertEqual(seen, [])
+
+            await emitter.dispatcher.join()
+            self.assertEqual(seen, [(1, 'a'), (2, None)])
+            self.assertEqual(batches, [[Event('DocumentSaved', (1,), {'extra': 'a'}), Event('DocumentSaved', (2,))]])
+
+            await emitter.dispatcher.close()
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEqual(emitter.dispatcher.stats()['delivered'], 2)
+
+    def test_batch_size(self):
+        dispatcher = Dispatcher(batch_size=2)
+        batches = []
+        dispatcher.on('DocumentSaved', lambda events: batches.append([event.args[0] for event in events]), batch=True)
+
+        async def run_test():
+            for value in range(5):
+                dispatcher.put_nowait(Event('DocumentSaved', (value,)))
+            await dispatcher.close()
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+
+    def test_drop(self):
+        dispatcher = Dispatcher(maxsize=2)
+        seen = []
+        dispatcher.on('DocumentSaved', seen.append)
+
+        async def run_test():
+            self.assertEqual([dispatcher.put_nowait(Event('DocumentSaved', (n,))) for n in range(3)],
+                             [True, True, False])
+            await dispatcher.close()
+            self.assertFalse(dispatcher.put_nowait(Event('DocumentSaved', (3,))))
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEqual(seen, [0, 1])
+        self.assertEqual(dispatcher.stats()['dropped'], 2)
+        self.assertEqual(dispatcher.stats()['high_water'], 2)
+
+    def test_block(self):
+        dispatcher = Dispatcher(maxsize=1, overflow='block')
+        seen = []
+        dispatcher.on('DocumentSaved', seen.append)
+
+        async def run_test():
+            for n in range(3):
+                self.assertTrue(await dispatcher.put(Event('DocumentSaved', (n,))))
+            await dispatcher.close()
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEqual(seen, [0, 1, 2])
+
+    def test_coalesce(self):
+        dispatcher = Dispatcher(overflow='coalesce')
+        seen = []
+        dispatcher.on('DocumentSaved', lambda document: seen.append((document.name, document.age)))
+        luke, leia = model.Document(name='Luke', age=19), model.Document(name='Leia', age=19)
+
+        async def run_test():
+            dispatcher.put_nowait(Event('DocumentSaved', (luke,)))
+            dispatcher.put_nowait(Event('DocumentSaved', (leia,)))
+            dispatcher.put_nowait(Event('DocumentSaved', (model.Document(luke.name, 20, id=luke.id),)))
+            await dispatcher.join()
+            # once delivered an event no longer absorbs newer ones
+            dispatcher.put_nowait(Event('DocumentSaved', (model.Document(luke.name, 21, id=luke.id),)))
+            await dispatcher.close()
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEqual(seen, [('Luke', 20), ('Leia', 19), ('Luke', 21)])
+        self.assertEqual(dispatcher.stats()['coalesced'], 1)
+
+    def test_failures_are_counted(self):
+        dispatcher = Dispatcher()
+        seen = []
+        dispatcher.on('DocumentSaved', lambda value: 1 / value)
+        dispatcher.on('DocumentSaved', seen.append)
+
+        async def run_test():
+            dispatcher.put_nowait(Event('DocumentSaved', (0,)))
+            await dispatcher.close()
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEqual(seen, [0])
+        self.assertEqual(dispatcher.stats()['failed'], 1)
+
+    def test_mutations_do_not_wait_for_listeners(self):
+        release = None
+
+        async def slow(document):
+            await release.wait()
+
+        async def run_test():
+            nonlocal release
+            release = asyncio.Event()
+            document_repo = repo.DocumentRepo(collection=MemoryCollection())
+            document_repo.on('DocumentCreated', slow)
+
+            await asyncio.wait_for(document_repo.create(name='Luke'), 1)
+            self.assertEqual(document_repo.dispatcher.stats()['delivered'], 0)
+
+            release.set()
+            await document_repo.dispatcher.close()
+            self.assertEqual(document_repo.dispatcher.stats()['delivered'], 1)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
@@ -0,0 +1,141 @@
+import unittest
+
+from model import query, repo
+from model.indexes import IndexReconciler, diff, index_name
+from model.query import Index
+
+from attr import attrs, Factory
+from typing import *
+import pymongo
+import pymongo.errors
+import asyncio
+
+
+@attrs(slots=True, auto_attribs=True)
+class MockCollection:
+    indexes: Dict[str, Dict[str, Any]] = Factory(dict)
+    fail: Set[str] = Factory(set)
+    calls: List[Any] = Factory(list)
+    started: Any = Factory(asyncio.Event)
+    release: Any = Factory(asyncio.Event)
+
+    async def list_indexes(self):
+        yield {'name': '_id_', 'key': {'_id': 1}}
+        for info in self.indexes.values():
+            yield info
+
+    async def create_index(self, keys, unique=False, name=None, background=False):
+        self.calls.append(('create_index', name, background))
+        self.started.set()
+        await self.release.wait()
+        if name in self.fail:
+            raise pymongo.errors.DuplicateKeyError('duplicate key error')
+        self.indexes[name] = {'name': name, 'key': dict(keys), 'unique': unique}
+
+
+NAME = Index([('name', pymongo.DESCENDING)], unique=True)
+AGE = Index([('age', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+
+
+class TestIndexes(unittest.TestCase):
+    def test_index_name(self):
+        self.assertEqual(index_name(NAME), 'name_-1')
+        self.assertEqual(index_name(AGE), 'age_1__id_1')
+
+    def test_diff(self):
+        existing = {
+            'name_-1': Index([('name', -1)]),
+            'stale_1': Index([('stale', 1)]),
+            '_id_': Index([('_id', 1)]),
+        }
+        drift = diff([NAME, AGE], existing)
+
+        self.assertEqual(drift.missing, [AGE])
+        self.assertEqual(drift.changed, [NAME])
+        self.assertEqual(drift.extra, ['stale_1'])
+        self.assertFalse(diff([], {'_id_': Index([('_id', 1)])}))
+
+    def test_diff_matches_keys(self):
+        existing = {
+            'by_name': Index([('name', -1)], unique=True),
+            'age_1__id_1': Index([('name', 1)]),
+        }
+        drift = diff([NAME, AGE], existing)
+
+        self.assertEqual(drift.missing, [])
+        self.assertEqual(drift.changed, [AGE])
+        self.assertEqual(drift.renamed, {'name_-1': 'by_name'})
+        self.assertEqual(drift.extra, [])
+        self.assertEqual(drift.report(), "missing [], changed ['age_1__id_1'], renamed {'name_-1': 'by_name'}, extra []")
+
+    def test_reconcile_in_background(self):
+        async def run_test():
+            collection = MockCollection({'name_-1': {'name': 'name_-1', 'key': {'name': -1.0}, 'unique': True}})
+            reconciler = IndexReconciler(collection, [NAME, AGE])
+            self.assertEqual(reconciler.usable_indexes(), [NAME, AGE])
+
+            drift = await reconciler.reconcile()
+            self.assertEqual(drift.missing, [AGE])
+            await collection.started.wait()
+
+            self.assertFalse(reconciler.ready())
+            self.assertEqual(reconciler.usable_indexes(), [NAME])
+            self.assertEqual(reconciler.stats()['building'], ['age_1__id_1'])
+
+            collection.release.set()
+            await reconciler.wait()
+
+            self.assertTrue(reconciler.ready())
+            self.assertEqual(reconciler.usable_indexes(), [NAME, AGE])
+            self.assertEqual(list(reconciler.build_times), ['age_1__id_1'])
+            self.assertEqual(collection.calls, [('create_index', 'age_1__id_1', True)])
+
+            # nothing is left to build the second time round
+            self.assertFalse(await IndexReconciler(collection, [NAME, AGE]).reconcile())
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_failed_build(self):
+        async def run_test():
+            collection = MockCollection(fail={'name_-1'})
+            collection.release.set()
+            reconciler = IndexReconciler(collection, [NAME])
+
+            await reconciler.reconcile(background=False)
+
+            self.assertFalse(reconciler.ready())
+            self.assertEqual(list(reconciler.failed), ['name_-1'])
+            self.assertEqual(reconciler.stats()['building'], [])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_renamed_index_is_ready(self):
+        async def run_test():
+            collection = MockCollection({'by_name': {'name': 'by_name', 'key': {'name': -1}, 'unique': True}})
+            reconciler = IndexReconciler(collection, [NAME])
+
+            drift = await reconciler.reconcile(background=False)
+
+            self.assertEqual(drift.renamed, {'name_-1': 'by_name'})
+            self.assertTrue(reconciler.ready())
+            self.assertEqual(reconciler.usable_indexes(), [NAME])
+            # nothing is built under the declared name, which mongodb would refuse with IndexOptionsConflict
+            self.assertEqual(collection.calls, [])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_repo_plans_with_built_indexes(self):
+        async def run_test():
+            collection = MockCollection()
+            document_repo = repo.DocumentRepo(collection=collection, indexes=[AGE])
+            await document_repo.check_indices()
+            await collection.started.wait()
+
+            with self.assertRaises(query.QueryPlanError):
+                document_repo._check_plan(query.DocumentFilter(age_min=18), None)
+
+            collection.release.set()
+            await document_repo.index_reconciler.wait()
+            document_repo._check_plan(query.DocumentFilter(age_min=18), query.DocumentSort('age'))
+
+        asyncio.get_event_loop().run_until_complete(run_test())
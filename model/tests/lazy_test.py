@@ -0,0 +1,41 @@
+import unittest
+from hypothesis import given
+import hypothesis.strategies as st
+from . import strategies
+
+from model import model, lazy
+
+from bson import BSON, ObjectId
+from bson.raw_bson import RawBSONDocument
+
+
+def to_raw(document):
+    return RawBSONDocument(BSON.encode(document.to_bson()), lazy.RAW_BSON_CODEC_OPTIONS)
+
+
+class TestLazyDocument(unittest.TestCase):
+    @given(st.from_type(model.Document))
+    def test_fields(self, document):
+        result = lazy.LazyDocument(to_raw(document))
+
+        self.assertEqual(result.id, document.id)
+        self.assertEqual(result.name, document.name)
+        self.assertEqual(result.age, document.age)
+        self.assertEqual(result.archived, document.archived)
+        self.assertEqual([c.to_model() for c in result.child_field], document.child_field)
+        self.assertEqual(result.to_model(), document)
+
+    @given(st.from_type(model.Document))
+    def test_child_fields_stay_raw(self, document):
+        result = lazy.LazyDocument(to_raw(document))
+
+        for child_field in result.child_field:
+            self.assertIsInstance(child_field.raw, RawBSONDocument)
+
+    def test_partial_document(self):
+        document = model.Document(name="Yoda")
+        raw = RawBSONDocument(BSON.encode({'_id': ObjectId(document.id), 'name': document.name}))
+
+        result = lazy.LazyDocument(raw)
+
+        self.assertEqual(result.to_model(), document)
@@ -0,0 +1,92 @@
+import unittest
+
+from hypothesis import given
+import hypothesis.strategies as st
+from . import strategies
+
+from model import model
+from model.loader import DocumentLoader
+from model.repo import InvalidId
+
+from typing import *
+from attr import attrs, Factory
+from bson import ObjectId
+import asyncio
+
+
+@attrs(slots=True, auto_attribs=True)
+class CountingRepo:
+    documents: Dict[str, model.Document]
+    calls: List[List[str]] = Factory(list)
+
+    async def find_by_ids(self, ids, fields=None):
+        self.calls.append((list(ids), fields))
+        return {id: self.documents[id] for id in ids if id in self.documents}
+
+
+class TestDocumentLoader(unittest.TestCase):
+    @given(st.lists(st.from_type(model.Document), min_size=1, unique_by=lambda d: d.id))
+    def test_load_batches_and_dedupes(self, documents):
+        repo = CountingRepo({d.id: d for d in documents})
+        missing = str(ObjectId())
+        ids = [d.id for d in documents] * 2 + [missing]
+
+        async def run_test():
+            loader = DocumentLoader(repo)
+            return await asyncio.gather(*[loader.load(id) for id in ids])
+
+        results = asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(results, documents * 2 + [None])
+        self.assertEqual(len(repo.calls), 1)
+        self.assertEqual(sorted(repo.calls[0][0]), sorted([d.id for d in documents] + [missing]))
+
+    def test_load_merges_fields(self):
+        document = model.Document(name="Obi-Wan Kenobi")
+        repo = CountingRepo({document.id: document})
+
+        async def run_test():
+            loader = DocumentLoader(repo)
+            await asyncio.gather(loader.load(document.id, ['age']), loader.load(document.id, ['archived']))
+            await loader.load(document.id, ['age'])
+            await asyncio.gather(loader.load(document.id, ['age']), loader.load(document.id))
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(repo.calls, [
+            ([document.id, document.id], {'age', 'archived'}),
+            ([document.id], None),
+        ])
+
+    def test_load_invalid_id(self):
+        loader = DocumentLoader(CountingRepo({}))
+
+        with self.assertRaises(InvalidId):
+            loader.load('not an id')
+
+    def test_clear(self):
+        document = model.Document(name="Obi-Wan Kenobi")
+        repo = CountingRepo({document.id: document})
+
+        async def run_test():
+            loader = DocumentLoader(repo)
+            await loader.load(document.id)
+            await loader.load(document.id)
+            loader.clear(document.id)
+            await loader.load(document.id)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(len(repo.calls), 2)
+
+    def test_clear_while_pending(self):
+        document = model.Document(name="Obi-Wan Kenobi")
+        repo = CountingRepo({document.id: document})
+
+        async def run_test():
+            loader = DocumentLoader(repo)
+            pending = loader.load(document.id)
+            loader.clear(document.id)
+            return await asyncio.wait_for(pending, 1)
+
+        self.assertEqual(asyncio.get_event_loop().run_until_complete(run_test()), document)
@@ -7,6 +7,7 @@ from model import model
 
 from bson import Decimal128, ObjectId
 from bson.decimal128 import create_decimal128_context
+from copy import deepcopy
 
 
 class TestChildField(unittest.TestCase):
@@ -75,3 +76,38 @@ class TestDocument(unittest.TestCase):
         document.add_child_field(child_field)
         document.update_child_field(new_child_field)
         self.assertEqual(document.find_child_field(child_field.id), new_child_field)
+
+    @given(st.from_type(model.Document), st.lists(st.from_type(model.ChildField), min_size=1), st.data())
+    def test_child_field_indexes(self, document, child_fields, data):
+        for child_field in child_fields:
+            document.add_child_field(child_field)
+
+        removed = data.draw(st.sampled_from(child_fields))
+        document.remove_child_field(removed.id)
+        remaining = [c for c in child_fields if c is not removed]
+
+        if remaining:
+            replaced = data.draw(st.sampled_from(remaining))
+            replacement = data.draw(st.from_type(model.ChildField))
+            replacement.id = replaced.id
+            document.update_child_field(replacement)
+            remaining[remaining.index(replaced)] = replacement
+
+        for child_field in document.child_field:
+            self.assertIs(document.find_child_field(child_field.id), child_field)
+            self.assertEqual(document.child_field_index(child_field.id), document.child_field.index(child_field))
+            expected = next(c for c in document.child_field if c.date == child_field.date)
+            self.assertIs(document.find_child_field_for_date(child_field.date), expected)
+        self.assertIsNone(document.find_child_field(removed.id))
+        self.assertEqual(document.child_field[-len(remaining):] if remaining else [], remaining)
+
+    @given(st.from_type(model.Document))
+    def test_child_field_indexes_after_copy(self, document):
+        child_field = model.ChildField(model.Date(1, 2000))
+        document.add_child_field(child_field)
+        self.assertIs(document.find_child_field(child_field.id), child_field)
+
+        copied = deepcopy(document)
+        self.assertEqual(copied, document)
+        self.assertEqual(copied.find_child_field(child_field.id), child_field)
+        self.assertIsNot(copied.find_child_field(child_field.id), child_field)
@@ -0,0 +1,304 @@
+from attr import attrs, Factory
+import pymongo.errors
+import unittest
+import asyncio
+
+from model import model, repo
+from bson import ObjectId
+from model.memory import MemoryCollection
+from model.outbox import Outbox, OutboxRelay
+from model.repo import DUPLICATE_KEY_ERROR
+
+from typing import *
+
+
+def matches(document, criteria):
+    for field, condition in criteria.items():
+        value = document.get(field)
+        if isinstance(condition, dict):
+            if '$in' in condition and value not in condition['$in']:
+                return False
+            if '$lt' in condition and not value < condition['$lt']:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+@attrs(slots=True, auto_attribs=True)
+class OutboxCollection:
+    """
+    The queries the outbox makes, applied to a list.
+    """
+    data: List[Dict[str, Any]] = Factory(list)
+
+    async def insert_many(self, documents, **options):
+        self.data.extend(dict(document) for document in documents)
+
+    async def find(self, criteria, projection=None, sort=None, limit=0):
+        found = sorted((d for d in self.data if matches(d, criteria)), key=lambda d: d['_id'])
+        for document in found[:limit or None]:
+            yield dict(document)
+
+    async def update_many(self, criteria, update):
+        for document in self.data:
+            if matches(document, criteria):
+                document.update(update['$set'])
+
+    async def delete_many(self, criteria):
+        self.data = [d for d in self.data if not matches(d, criteria)]
+
+
+@attrs(slots=True, auto_attribs=True)
+class Session:
+    """
+    Records the transaction calls, commit_failures being errors for the next commits to raise.
+    """
+    calls: List[str] = Factory(list)
+    commit_failures: List[Exception] = Factory(list)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def start_transaction(self):
+        self.calls.append('start')
+
+    async def commit_transaction(self):
+        self.calls.append('commit')
+        if self.commit_failures:
+            raise self.commit_failures.pop(0)
+
+    async def abort_transaction(self):
+        self.calls.append('abort')
+
+
+@attrs(slots=True, auto_attribs=True)
+class Client:
+    session: Session = Factory(Session)
+
+    async def start_session(self):
+        return self.session
+
+
+class TransactionCollection(MemoryCollection):
+    """
+    Fails the next write with each of failures, write errors carrying the index of the document with a taken name.
+    """
+    __slots__ = ('failures', 'taken', 'writes')
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.failures = []
+        self.taken = set()
+        self.writes = 0
+
+    def fail(self):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.writes += 1
+
+    async def find_one_and_update(self, criteria, update, return_document=None, **options):
+        self.fail()
+        return await MemoryCollection.find_one_and_update(self, criteria, update, return_document)
+
+    async def insert_many(self, documents, ordered=True, **options):
+        errors = [
+            {'index': index, 'code': DUPLICATE_KEY_ERROR, 'errmsg': 'duplicate key'}
+            for index, document in enumerate(documents) if document['name'] in self.taken
+        ]
+        if errors:
+            # a transaction stops at the first write error
+            raise pymongo.errors.BulkWriteError({'writeErrors': errors[:1]})
+        self.fail()
+
+
+def transient(label):
+    return pymongo.errors.OperationFailure('WriteConflict', 112, {'errorLabels': [label]})
+
+
+@attrs(slots=True, auto_attribs=True)
+class Publisher:
+    batches: List[List[Tuple[str, str]]] = Factory(list)
+    failures: int = 0
+
+    async def publish(self, records):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('broker unavailable')
+        self.batches.append([(record['event'], record['document']['name']) for record in records])
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.yoda = model.Document(name='Yoda')
+        self.outbox = Outbox(OutboxCollection())
+        self.document_repo = repo.DocumentRepo(collection=MemoryCollection.of([self.yoda]), outbox=self.outbox)
+
+    def test_writes_record_events(self):
+        async def run_test():
+            await self.document_repo.create(name='Luke')
+            await self.document_repo.create_many([{'name': 'Leia'}, {'name': 'Han'}])
+            await self.document_repo.save(self.yoda)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(
+            [(record['event'], record['document']['name']) for record in self.outbox.collection.data],
+            [('DocumentCreated', 'Luke'), ('DocumentCreated', 'Leia'), ('DocumentCreated', 'Han'),
+             ('DocumentSaved', 'Yoda')]
+        )
+
+    def test_relay(self):
+        publisher = Publisher()
+        relay = OutboxRelay(self.outbox, publisher, batch_size=2)
+
+        async def run_test():
+            await self.document_repo.create_many([{'name': 'Luke'}, {'name': 'Leia'}, {'name': 'Han'}])
+            self.assertEqual(await relay.relay_once(), 2)
+            self.assertEqual(await relay.relay_once(), 1)
+            self.assertEqual(await relay.relay_once(), 0)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(publisher.batches, [
+            [('DocumentCreated', 'Luke'), ('DocumentCreated', 'Leia')],
+            [('DocumentCreated', 'Han')]
+        ])
+        self.assertEqual(self.outbox.collection.data, [])
+
+    def test_claims_keep_other_relays_off(self):
+        publisher = Publisher()
+
+        async def run_test():
+            await self.document_repo.create(name='Luke')
+            # claimed at 100 by a relay which died before publishing
+            await self.outbox.collection.update_many({}, {'$set': {'claimed_until': 160.0, 'claimed_by': 'dead'}})
+
+            self.assertEqual(await OutboxRelay(self.outbox, publisher, clock=lambda: 120.0).relay_once(), 0)
+            # until the claim expires
+            self.assertEqual(await OutboxRelay(self.outbox, publisher, clock=lambda: 200.0).relay_once(), 1)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+        self.assertEqual(publisher.batches, [[('DocumentCreated', 'Luke')]])
+
+    def test_retries_with_backoff(self):
+        publisher = Publisher(failures=2)
+        relay = OutboxRelay(self.outbox, publisher, backoff=0.001, poll_interval=0.01)
+
+        async def run_test():
+            relay.start()
+            await self.document_repo.create(name='Luke')
+            for _ in range(100):
+                if publisher.batches:
+                    break
+                await asyncio.sleep(0.01)
+            await relay.stop()
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(publisher.batches, [[('DocumentCreated', 'Luke')]])
+        self.assertEqual(relay.stats()['failures'], 2)
+        self.assertEqual(self.outbox.collection.data, [])
+
+
+    def test_stop_while_publishing(self):
+        started = asyncio.Event()
+
+        class Stuck(Publisher):
+            async def publish(self, records):
+                started.set()
+                await asyncio.Event().wait()
+
+        relay = OutboxRelay(self.outbox, Stuck())
+
+        async def run_test():
+            await self.document_repo.create(name='Luke')
+            relay.start()
+            await started.wait()
+            await asyncio.wait_for(relay.stop(), 1.0)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(relay.stats()['failures'], 0)
+        self.assertEqual(self.outbox.collection.data[0]['claimed_until'], 0.0)
+
+
+class TestTransactions(unittest.TestCase):
+    def setUp(self):
+        self.yoda = model.Document(name='Yoda')
+        self.collection = TransactionCollection({ObjectId(self.yoda.id): self.yoda.to_bson()})
+        self.client = Client()
+        self.outbox = Outbox(OutboxCollection(), self.client)
+        self.document_repo = repo.DocumentRepo(collection=self.collection, outbox=self.outbox)
+
+    def events(self):
+        return [(record['event'], record['document']['name']) for record in self.outbox.collection.data]
+
+    def test_transient_error_runs_the_transaction_again(self):
+        self.collection.failures.append(transient('TransientTransactionError'))
+
+        async def run_test():
+            return await self.document_repo.set_archived(self.yoda.id, True)
+
+        result = asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(result.name, 'Yoda')
+        self.assertEqual(self.collection.writes, 1)
+        self.assertEqual(self.client.session.calls, ['start', 'abort', 'start', 'commit'])
+        self.assertEqual(self.events(), [('DocumentSaved', 'Yoda')])
+        self.assertEqual(self.outbox.retries, 1)
+
+    def test_unknown_commit_result_commits_again(self):
+        self.client.session.commit_failures.append(transient('UnknownTransactionCommitResult'))
+
+        async def run_test():
+            await self.document_repo.set_archived(self.yoda.id, True)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(self.collection.writes, 1)
+        self.assertEqual(self.client.session.calls, ['start', 'commit', 'commit'])
+        self.assertEqual(self.events(), [('DocumentSaved', 'Yoda')])
+
+    def test_gives_up_after_max_retry_time(self):
+        # 0.4 seconds pass between looks at the clock
+        ticks = iter(range(100))
+        self.outbox.clock = lambda: next(ticks) * 0.4
+        self.outbox.max_retry_time = 1.0
+        self.collection.failures.extend(transient('TransientTransactionError') for _ in range(5))
+
+        async def run_test():
+            with self.assertRaises(pymongo.errors.OperationFailure):
+                await self.document_repo.set_archived(self.yoda.id, True)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(self.client.session.calls, ['start', 'abort'] * 3)
+        self.assertEqual(self.events(), [])
+
+    def test_other_errors_abort(self):
+        self.collection.failures.append(pymongo.errors.OperationFailure('not authorized', 13))
+
+        async def run_test():
+            with self.assertRaises(pymongo.errors.OperationFailure):
+                await self.document_repo.set_archived(self.yoda.id, True)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(self.client.session.calls, ['start', 'abort'])
+
+    def test_write_errors_rerun_without_the_failed_documents(self):
+        self.collection.taken.update({'Leia', 'Han'})
+
+        async def run_test():
+            return await self.document_repo.create_many([{'name': 'Luke'}, {'name': 'Leia'}, {'name': 'Han'}])
+
+        results = asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(results[0].name, 'Luke')
+        self.assertEqual([result.errors for result in results[1:]], [{'name': ['already exists']}] * 2)
+        self.assertEqual(self.client.session.calls, ['start', 'abort', 'start', 'abort', 'start', 'commit'])
+        self.assertEqual(self.events(), [('DocumentCreated', 'Luke')])
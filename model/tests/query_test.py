@@ -0,0 +1,113 @@
+import unittest
+from hypothesis import given
+import hypothesis.strategies as st
+
+from model import query
+from model.query import DocumentFilter, DocumentSort, Index, plan
+
+from bson import ObjectId
+from bson.errors import InvalidId
+import pymongo
+
+
+class TestDocumentFilter(unittest.TestCase):
+    def test_to_criteria(self):
+        self.assertEqual(DocumentFilter().to_criteria(), {})
+        self.assertEqual(
+            DocumentFilter(archived=False, age_min=18, age_max=30, name_prefix='Sky.').to_criteria(),
+            {
+                'archived': {'$in': [False, None]},
+                'age': {'$gte': 18, '$lte': 30},
+                'name': {'$regex': r'^Sky\.'}
+            }
+        )
+        self.assertEqual(DocumentFilter(archived=True).to_criteria(), {'archived': True})
+
+    def test_fields(self):
+        document_filter = DocumentFilter(archived=True, age_max=30, name_prefix='Sky')
+        self.assertEqual(document_filter.equality_fields(), {'archived'})
+        self.assertEqual(document_filter.range_fields(), {'age', 'name'})
+
+
+class TestDocumentSort(unittest.TestCase):
+    def test_keys(self):
+        self.assertEqual(DocumentSort().keys(), [('_id', pymongo.ASCENDING)])
+        self.assertEqual(DocumentSort('name', pymongo.DESCENDING).keys(), [('name', pymongo.DESCENDING)])
+        self.assertEqual(
+            DocumentSort('age', pymongo.DESCENDING).keys(),
+            [('age', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+        )
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            DocumentSort('child_field')
+
+    @given(st.one_of(st.none(), st.integers()), st.sampled_from([pymongo.ASCENDING, pymongo.DESCENDING]))
+    def test_after_age_cursor(self, age, direction):
+        id = ObjectId()
+
+        class Document:
+            pass
+        document = Document()
+        document.id = str(id)
+        document.age = age
+
+        sort = DocumentSort('age', direction)
+        op = '$gt' if direction == pymongo.ASCENDING else '$lt'
+        tie = {'age': age, '_id': {op: id}}
+
+        criteria = sort.after_criteria(sort.cursor(document))
+        if age is None and direction == pymongo.ASCENDING:
+            self.assertEqual(criteria, {'$or': [tie, {'age': {'$ne': None}}]})
+        elif age is None:
+            self.assertEqual(criteria, tie)
+        elif direction == pymongo.ASCENDING:
+            self.assertEqual(criteria, {'$or': [{'age': {op: age}}, tie]})
+        else:
+            self.assertEqual(criteria, {'$or': [{'age': {op: age}}, {'age': None}, tie]})
+
+    def test_after_id_cursor(self):
+        id = ObjectId()
+        self.assertEqual(DocumentSort().after_criteria(str(id)), {'_id': {'$gt': id}})
+        self.assertEqual(DocumentSort(direction=pymongo.DESCENDING).after_criteria(str(id)), {'_id': {'$lt': id}})
+
+    def test_invalid_cursor(self):
+        for sort in [DocumentSort(), DocumentSort('name'), DocumentSort('age')]:
+            with self.assertRaises(InvalidId):
+                sort.after_criteria('not-a-cursor')
+
+
+class TestCombine(unittest.TestCase):
+    def test_combine(self):
+        self.assertEqual(query.combine({}, {'age': 1}, {'_id': 2}), {'age': 1, '_id': 2})
+        self.assertEqual(
+            query.combine({'age': 1}, {'$or': [{'age': 2}]}, {'age': 3}),
+            {'$and': [{'age': 1}, {'$or': [{'age': 2}]}, {'age': 3}]}
+        )
+
+
+class TestPlan(unittest.TestCase):
+    def test_indexed(self):
+        cases = [
+            (None, None),
+            (DocumentFilter(archived=False), None),
+            (DocumentFilter(archived=True), DocumentSort('name', pymongo.DESCENDING)),
+            (DocumentFilter(archived=True, age_min=18), DocumentSort('age')),
+            (DocumentFilter(age_min=18, age_max=30), DocumentSort('age', pymongo.DESCENDING)),
+            (DocumentFilter(name_prefix='Sky'), DocumentSort('name')),
+            (None, DocumentSort('age')),
+        ]
+        for document_filter, sort in cases:
+            result = plan(document_filter, sort)
+            self.assertFalse(result.collection_scan, (document_filter, sort))
+            self.assertFalse(result.blocking_sort, (document_filter, sort))
+
+    def test_blocking_sort(self):
+        result = plan(DocumentFilter(name_prefix='Sky'), DocumentSort('age'))
+        self.assertEqual(result.index.fields, ['name'])
+        self.assertTrue(result.blocking_sort)
+
+    def test_collection_scan(self):
+        indexes = [Index([('name', pymongo.ASCENDING)], unique=True)]
+        self.assertTrue(plan(DocumentFilter(age_min=18), None, indexes).collection_scan)
+        self.assertFalse(plan(None, DocumentSort('name'), indexes).collection_scan)
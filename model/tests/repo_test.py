@@ -15,7 +15,7 @@ try:
 except(ModuleNotFoundError):
     from model import repo
 
-from model import model
+from model import model, codec, lazy, query
 
 try:
     import schema
@@ -24,6 +24,9 @@ except(ModuleNotFoundError):
 
 from typing import *
 from attr import attrs, attrib, Factory
+from bson import BSON, ObjectId
+from bson.raw_bson import RawBSONDocument
+import pymongo.errors
 import asyncio
 
 
@@ -31,14 +34,65 @@ import asyncio
 class MockCollection:
     data: List[Any]
     find_one_and_update_response: Optional[Any]
+    calls: List[Any] = Factory(list)
 
-    async def find(self, criteria={}):
-        for d in self.data:
+    async def find(self, criteria={}, projection=None, sort=None, limit=0):
+        data = self.data
+        if projection is not None:
+            data = [{k: v for k, v in d.items() if k == '_id' or k in projection} for d in data]
+        if '_id' in criteria and '$gt' in criteria['_id']:
+            data = [d for d in data if d['_id'] > criteria['_id']['$gt']]
+        if '_id' in criteria and '$in' in criteria['_id']:
+            data = [d for d in data if d['_id'] in criteria['_id']['$in']]
+        if sort is not None:
+            data = sorted(data, key=lambda d: d['_id'])
+        for d in data[:limit or None]:
             yield d
 
-    async def find_one_and_update(self, id, update, upsert):
+    async def find_one_and_update(self, criteria, update, return_document=None):
+        self.calls.append(('find_one_and_update', criteria, update))
         return self.find_one_and_update_response
 
+    def with_options(self, codec_options):
+        return MockCollection(
+            [RawBSONDocument(BSON.encode(d), codec_options) for d in self.data],
+            self.find_one_and_update_response,
+            self.calls
+        )
+
+    async def find_one(self, criteria, projection=None):
+        self.calls.append(('find_one', criteria))
+        for d in self.data:
+            if d['_id'] == criteria['_id']:
+                return d
+
+    async def insert_one(self, document):
+        self.calls.append(('insert_one', document))
+        self.data.append(document)
+
+    async def insert_many(self, documents, ordered=True):
+        self.calls.append(('insert_many', documents, ordered))
+        write_errors = []
+        names = {d['name'] for d in self.data}
+        for index, document in enumerate(documents):
+            if document['name'] in names:
+                write_errors.append({'index': index, 'code': 11000, 'errmsg': 'duplicate key error'})
+            else:
+                names.add(document['name'])
+                self.data.append(document)
+        if write_errors:
+            raise pymongo.errors.BulkWriteError({'writeErrors': write_errors})
+
+    async def update_many(self, criteria, update):
+        self.calls.append(('update_many', criteria, update))
+        for d in self.data:
+            if d['_id'] in criteria['_id']['$in']:
+                d.update(update['$set'])
+
+    async def count_documents(self, criteria, limit=0):
+        self.calls.append(('count_documents', criteria))
+        return len([d for d in self.data if d['_id'] == criteria['_id']][:limit or None])
+
 
 class TestDocumentRepo(unittest.TestCase):
     @given(st.lists(st.from_type(model.Document)))
@@ -56,9 +110,270 @@ class TestDocumentRepo(unittest.TestCase):
             async for item in document_repo.find():
                 results.append(item)
 
-            for result, expected in zip(results, documents):
+            self.assertEqual(len(results), len(documents))
+            for result, expected in zip(results, sorted(documents, key=lambda d: ObjectId(d.id))):
                 if result != expected:
                     print(result, expected)
                 self.assertEqual(result, expected)
 
         asyncio.get_event_loop().run_until_complete(run_test())
+
+    @given(st.lists(st.from_type(model.Document), min_size=1, unique_by=lambda d: d.id), st.integers(min_value=1, max_value=5))
+    def test_find_paginated(self, documents, limit):
+        _documents = [ c.to_bson() for c in documents ]
+        expected = sorted(documents, key=lambda d: ObjectId(d.id))
+
+        async def run_test():
+            document_repo = repo.DocumentRepo(collection=MockCollection(_documents, None))
+
+            results = []
+            after = None
+            while True:
+                page = []
+                async for item in document_repo.find(limit=limit, after=after):
+                    page.append(item)
+                self.assertTrue(len(page) <= limit)
+                if not page:
+                    break
+                results.extend(page)
+                after = page[-1].id
+
+            self.assertEqual(results, expected)
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    @given(st.lists(st.from_type(model.Document)))
+    def test_find_projection(self, documents):
+        _documents = [ c.to_bson() for c in documents ]
+
+        async def run_test():
+            document_repo = repo.DocumentRepo(collection=MockCollection(_documents, None))
+
+            results = []
+            async for item in document_repo.find(fields=['age']):
+                results.append(item)
+
+            expected = sorted(documents, key=lambda d: ObjectId(d.id))
+            self.assertEqual(
+                [(r.id, r.name, r.age, r.archived, r.child_field) for r in results],
+                [(d.id, d.name, d.age, False, []) for d in expected]
+            )
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_make_projection(self):
+        self.assertEqual(repo.make_projection(None), None)
+        self.assertEqual(repo.make_projection(['age']), {'age': True, 'name': True})
+        self.assertEqual(
+            repo.make_projection([repo.Slice('child_field', 20), repo.Slice('child_field', 5), repo.CHILD_FIELD_COUNT]),
+            {
+                'child_field': {'$slice': 20},
+                'child_field_count': {'$size': {'$ifNull': ['$child_field', []]}},
+                'name': True
+            }
+        )
+        self.assertEqual(
+            repo.make_projection(['child_field', repo.Slice('child_field', 20)]),
+            {'child_field': True, 'name': True}
+        )
+        # only the range covering every slice is loaded, along with where it starts
+        self.assertEqual(
+            repo.make_projection([repo.Slice('child_field', 3, 40), repo.Slice('child_field', 5, 30)]),
+            {'child_field': {'$slice': [30, 13]}, 'child_field_offset': {'$literal': 30}, 'name': True}
+        )
+        # first: 0 asks for no children, which does not stretch the range of the others either
+        self.assertEqual(repo.make_projection([repo.Slice('child_field', 0, 1)]), {'name': True})
+        self.assertEqual(
+            repo.make_projection([repo.Slice('child_field', 0, 40), repo.Slice('child_field', 2)]),
+            {'child_field': {'$slice': 2}, 'name': True}
+        )
+
+    def test_find_filtered(self):
+        documents = [model.Document(name="Clone %d" % i, age=i) for i in range(3)]
+
+        async def run_test():
+            collection = MockCollection([d.to_bson() for d in documents], None)
+            document_repo = repo.DocumentRepo(collection=collection)
+
+            results = []
+            async for item in document_repo.find(filter=query.DocumentFilter(age_min=1), fields=['name']):
+                results.append(item)
+            self.assertEqual(len(results), 3)
+
+            document_repo.indexes = []
+            with self.assertRaises(query.QueryPlanError):
+                async for item in document_repo.find(filter=query.DocumentFilter(age_min=1)):
+                    pass
+
+            document_repo.collection_scans = 'warn'
+            with self.assertLogs('model.repo', 'WARNING') as logs:
+                async for item in document_repo.find(filter=query.DocumentFilter(age_min=1)):
+                    pass
+            self.assertEqual([record.msg for record in logs.records], [
+                "No index for filter %r sorted by %r, scanning the whole collection"
+            ])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    @given(st.from_type(model.Document), st.from_type(model.ChildField))
+    def test_add_child_field(self, document, child_field):
+        expected = model.Document(document.name, document.age, document.archived,
+                                  document.child_field + [child_field], document.id)
+
+        async def run_test():
+            collection = MockCollection([document.to_bson()], expected.to_bson())
+            document_repo = repo.DocumentRepo(collection=collection)
+            saved = []
+            document_repo.on('DocumentSaved', saved.append)
+
+            result = await document_repo.add_child_field(document.id, child_field)
+
+            self.assertEqual(result, expected)
+            self.assertEqual(saved, [expected])
+            self.assertEqual(collection.calls, [(
+                'find_one_and_update',
+                {'_id': ObjectId(document.id)},
+                {'$push': {'child_field': child_field.to_bson()}}
+            )])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    @given(st.from_type(model.Document))
+    def test_remove_child_field_not_found(self, document):
+        child_field_id = str(ObjectId())
+
+        async def run_test():
+            collection = MockCollection([document.to_bson()], None)
+            document_repo = repo.DocumentRepo(collection=collection)
+
+            with self.assertRaises(KeyError):
+                await document_repo.remove_child_field(document.id, child_field_id)
+
+            self.assertIsNone(await document_repo.remove_child_field(str(ObjectId()), child_field_id))
+
+            with self.assertRaises(repo.InvalidId):
+                await document_repo.remove_child_field('not an id', child_field_id)
+
+            # the missing document is reported before the invalid child field id
+            with self.assertRaises(KeyError):
+                await document_repo.remove_child_field(document.id, 'not an id')
+            self.assertIsNone(await document_repo.remove_child_field(str(ObjectId()), 'not an id'))
+            self.assertIsNone(await document_repo.update_child_field(
+                str(ObjectId()),
+                model.ChildField(id='not an id', name='Lightsaber', date=model.Date(month=1, year=2000))
+            ))
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    @given(st.text(), st.integers(), st.booleans())
+    def test_create(self, name, age, archived):
+        async def run_test():
+            collection = MockCollection([], None)
+            document_repo = repo.DocumentRepo(collection=collection)
+            created = []
+            document_repo.on('DocumentCreated', created.append)
+
+            result = await document_repo.create(name=name, age=age, archived=archived)
+
+            self.assertEqual((result.name, result.age, result.archived, result.child_field), (name, age, archived, []))
+            self.assertEqual(created, [result])
+            # a single round trip, the document is not read back after the insert
+            self.assertEqual(collection.calls, [('insert_one', result.to_bson())])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_create_many(self):
+        async def run_test():
+            collection = MockCollection([model.Document(name='Anakin Skywalker').to_bson()], None)
+            document_repo = repo.DocumentRepo(collection=collection)
+            created = []
+            document_repo.on('DocumentCreated', created.append)
+
+            results = await document_repo.create_many([
+                {'name': 'Luke Skywalker', 'age': 19},
+                {'name': 'Anakin Skywalker'},
+                {'name': 'Leia Organa', 'archived': True},
+            ])
+
+            self.assertEqual([r.name for r in created], ['Luke Skywalker', 'Leia Organa'])
+            self.assertEqual(results[0], created[0])
+            self.assertEqual(results[1].errors, {'name': ['already exists']})
+            self.assertEqual((results[2].name, results[2].archived), ('Leia Organa', True))
+            # one unordered round trip for the whole batch
+            self.assertEqual([(c[0], len(c[1]), c[2]) for c in collection.calls], [('insert_many', 3, False)])
+
+            self.assertEqual(await document_repo.create_many([]), [])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_create_coerces_input(self):
+        async def run_test():
+            collection = MockCollection([], None)
+            document_repo = repo.DocumentRepo(collection=collection)
+            created = []
+            document_repo.on('DocumentCreated', created.append)
+
+            # archived comes in as a string from CreateDocumentInput, results read as if they came from mongodb
+            result = await document_repo.create(name='Luke Skywalker', archived='false')
+            results = await document_repo.create_many([
+                {'name': 'Leia Organa', 'archived': 'true'},
+                {'name': 'Han Solo', 'archived': 'false'},
+            ])
+
+            self.assertIs(result.archived, False)
+            self.assertEqual([r.archived for r in results], [True, False])
+            self.assertEqual([r.archived for r in created], [False, True, False])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    def test_set_archived_many(self):
+        async def run_test():
+            documents = [model.Document(name='Anakin Skywalker'), model.Document(name='Luke Skywalker')]
+            collection = MockCollection([d.to_bson() for d in documents], None)
+            document_repo = repo.DocumentRepo(collection=collection)
+            saved = []
+            document_repo.on('DocumentSaved', saved.append)
+
+            missing = str(ObjectId())
+            results = await document_repo.set_archived_many([documents[1].id, missing, 'not an id'], True)
+
+            self.assertEqual(results[0].id, documents[1].id)
+            self.assertTrue(results[0].archived)
+            self.assertEqual(results[1].errors, {'id': ['not found']})
+            self.assertEqual(results[2].errors, {'id': ['invalid']})
+            self.assertEqual(saved, [results[0]])
+            self.assertEqual(collection.calls[0][0], 'update_many')
+            self.assertFalse(collection.data[0]['archived'])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    @given(st.lists(st.from_type(model.Document)))
+    def test_find_with_codec(self, documents):
+        _documents = [ c.to_bson() for c in documents ]
+
+        async def run_test():
+            document_repo = repo.DocumentRepo(collection=MockCollection(_documents, None), codec=codec.Document)
+
+            results = []
+            async for item in document_repo.find():
+                results.append(item)
+
+            self.assertEqual(results, sorted(documents, key=lambda d: ObjectId(d.id)))
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+    @given(st.lists(st.from_type(model.Document)))
+    def test_find_raw_bson(self, documents):
+        _documents = [ c.to_bson() for c in documents ]
+
+        async def run_test():
+            document_repo = repo.DocumentRepo(collection=MockCollection(_documents, None), raw_bson=True)
+
+            results = []
+            async for item in document_repo.find():
+                self.assertIsInstance(item, lazy.LazyDocument)
+                results.append(item.to_model())
+
+            self.assertEqual(results, sorted(documents, key=lambda d: ObjectId(d.id)))
+
+        asyncio.get_event_loop().run_until_complete(run_test())
@@ -0,0 +1,83 @@
+import unittest
+import asyncio
+
+from model import tracing
+
+
+class Traced:
+    @tracing.traced
+    def decode(self, value):
+        with tracing.span('inner'):
+            return value
+
+    @tracing.traced
+    async def fetch(self, value):
+        await asyncio.sleep(0)
+        return self.decode(value)
+
+    @tracing.traced
+    async def iterate(self, values):
+        for value in values:
+            yield self.decode(value)
+
+
+def names(spans):
+    return [(span.name, names(span.children)) for span in spans]
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.ticks = iter(range(0, 10 ** 6, 10))
+        self.trace = tracing.Trace(clock=lambda: next(self.ticks))
+        self.token = tracing.start(self.trace)
+
+    def tearDown(self):
+        tracing.stop(self.token)
+
+    def test_spans_nest(self):
+        with tracing.span('outer') as outer:
+            with tracing.span('first'):
+                pass
+            with tracing.span('second'):
+                pass
+
+        self.assertEqual(names(self.trace.spans), [('outer', [('first', []), ('second', [])])])
+        self.assertEqual((outer.start, outer.duration), (10, 50))
+        self.assertIsNone(tracing.current_span.get())
+
+    def test_traced(self):
+        traced = Traced()
+
+        async def run_test():
+            self.assertEqual(await traced.fetch(1), 1)
+            self.assertEqual([value async for value in traced.iterate([2, 3])], [2, 3])
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        decode = ('Traced.decode', [('inner', [])])
+        self.assertEqual(names(self.trace.spans), [
+            ('Traced.fetch', [decode]),
+            ('Traced.iterate', [decode, decode]),
+        ])
+
+    def test_tasks_nest_under_their_parent(self):
+        async def child():
+            with tracing.span('child'):
+                await asyncio.sleep(0)
+
+        async def run_test():
+            with tracing.span('parent'):
+                task = asyncio.ensure_future(child())
+            await task
+
+        asyncio.get_event_loop().run_until_complete(run_test())
+
+        self.assertEqual(names(self.trace.spans), [('parent', [('child', [])])])
+
+    def test_off(self):
+        tracing.stop(self.token)
+        self.token = tracing.current_trace.set(None)
+
+        self.assertIs(tracing.span('nothing'), tracing.NO_SPAN)
+        self.assertEqual(Traced().decode(4), 4)
+        self.assertEqual(self.trace.spans, [])
@@ -0,0 +1,249 @@
+"""
+Per-request traces in the format of Apollo tracing, https://github.com/apollographql/apollo-tracing.
+
+The trace of the request being served is held in a context variable, so the backend, the repo and the decoders can
+record spans without it being passed down to them. asyncio tasks copy the context they are created in, the spans of
+a resolver's task nest under that resolver. With no trace active, span() is one context variable lookup returning a
+shared no-op context manager, and a function decorated with traced is called straight through.
+"""
+from attr import attrs, Factory
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from functools import wraps
+import inspect
+import time
+
+from typing import *
+
+
+@attrs(slots=True, auto_attribs=True)
+class Span:
+    name: str
+    # nanoseconds since the start of the trace
+    start: int
+    duration: Optional[int] = None
+    children: List['Span'] = Factory(list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {'name': self.name, 'startOffset': self.start, 'duration': self.duration}
+        if self.children:
+            result['spans'] = [child.to_dict() for child in self.children]
+        return result
+
+
+@attrs(slots=True, auto_attribs=True)
+class ResolverSpan(Span):
+    path: List[Union[str, int]] = Factory(list)
+    parent_type: str = ''
+    return_type: str = ''
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {
+            'path': self.path,
+            'parentType': self.parent_type,
+            'fieldName': self.name,
+            'returnType': self.return_type,
+            'startOffset': self.start,
+            'duration': self.duration,
+        }
+        if self.children:
+            result['spans'] = [child.to_dict() for child in self.children]
+        return result
+
+
+# the Trace of the request being served and the innermost open span of the running task, the parent of new spans
+current_trace = ContextVar('current_trace', default=None)
+current_span = ContextVar('current_span', default=None)
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+@attrs(slots=True, auto_attribs=True)
+class Trace:
+    clock: Callable[[], int] = time.perf_counter_ns
+    start_time: datetime = Factory(utc_now)
+    end_time: Optional[datetime] = None
+    started: Optional[int] = None
+    ended: Optional[int] = None
+    parsing: Optional[Span] = None
+    validation: Optional[Span] = None
+    resolvers: List[ResolverSpan] = Factory(list)
+    # spans which were not opened inside a resolver
+    spans: List[Span] = Factory(list)
+
+    def __attrs_post_init__(self):
+        if self.started is None:
+            self.started = self.clock()
+
+    def now(self) -> int:
+        return self.clock() - self.started
+
+    def add(self, span: Span) -> Span:
+        parent = current_span.get()
+        (parent.children if parent is not None else self.spans).append(span)
+        return span
+
+    def finish(self) -> None:
+        self.ended = self.clock()
+        self.end_time = utc_now()
+
+    def to_dict(self) -> Dict[str, Any]:
+        def phase(span):
+            return {'startOffset': span.start, 'duration': span.duration} if span is not None else None
+
+        return {
+            'version': 1,
+            'startTime': self.start_time.isoformat(),
+            'endTime': self.end_time.isoformat() if self.end_time is not None else None,
+            'duration': self.ended - self.started if self.ended is not None else None,
+            'parsing': phase(self.parsing),
+            'validation': phase(self.validation),
+            'execution': {
+                'resolvers': [resolver.to_dict() for resolver in self.resolvers],
+                'spans': [span.to_dict() for span in self.spans],
+            },
+        }
+
+
+class SpanContext:
+    """
+    Records a span of the active trace from __enter__ to __exit__ and makes it the parent of the spans opened in
+    between.
+    """
+    __slots__ = ('trace', 'span', 'parent')
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.span = Span(name, 0)
+
+    def __enter__(self) -> Span:
+        self.span.start = self.trace.now()
+        self.trace.add(self.span)
+        self.parent = current_span.get()
+        current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc_info):
+        self.span.duration = self.trace.now() - self.span.start
+        # set rather than reset, the exit of an async generator can run in another task's context
+        current_span.set(self.parent)
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name: str) -> Union[SpanContext, NoSpan]:
+    """
+    with span('DocumentRepo.find'): ... records a span when a trace is active.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return NO_SPAN
+    return SpanContext(trace, name)
+
+
+class PhaseContext:
+    """
+    Records the parsing or validation phase of the active trace.
+    """
+    __slots__ = ('trace', 'name', 'span')
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self) -> Span:
+        self.span = Span(self.name, self.trace.now())
+        setattr(self.trace, self.name, self.span)
+        return self.span
+
+    def __exit__(self, *exc_info):
+        self.span.duration = self.trace.now() - self.span.start
+
+
+def phase(name: str) -> Union[PhaseContext, NoSpan]:
+    """
+    with phase('parsing'): ... records the parsing or validation of the active trace's operation.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return NO_SPAN
+    return PhaseContext(trace, name)
+
+
+async def _traced_coroutine(context: SpanContext, coroutine):
+    with context:
+        return await coroutine
+
+
+async def _traced_generator(context: SpanContext, generator):
+    with context:
+        async for item in generator:
+            yield item
+
+
+def traced(function):
+    """
+    Decorator recording a span named after the function for every call made while a trace is active.
+
+    Works on functions, coroutine functions and async generator functions, the span of the latter two covers the
+    awaiting or iterating rather than the call.
+    """
+    name = function.__qualname__
+
+    if inspect.isasyncgenfunction(function):
+        wrap = _traced_generator
+    elif inspect.iscoroutinefunction(function):
+        wrap = _traced_coroutine
+    else:
+        wrap = None
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        trace = current_trace.get()
+        if trace is None:
+            return function(*args, **kwargs)
+        if wrap is not None:
+            return wrap(SpanContext(trace, name), function(*args, **kwargs))
+        with SpanContext(trace, name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def start(trace: Optional[Trace]=None) -> Any:
+    """
+    Make trace, a new one by default, the active trace of the current context and return the token for stop().
+    """
+    return current_trace.set(trace if trace is not None else Trace())
+
+
+def stop(token) -> None:
+    current_trace.reset(token)
+    current_span.set(None)
+
+
+__all__ = [
+    'Span',
+    'ResolverSpan',
+    'Trace',
+    'current_trace',
+    'current_span',
+    'span',
+    'phase',
+    'traced',
+    'start',
+    'stop'
+]